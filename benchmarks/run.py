@@ -0,0 +1,271 @@
+"""
+Benchmark suite for the PPM and KWZ parsers.
+
+Generates a synthetic corpus (see synthetic.py) in a temporary directory,
+times each benchmark on both formats and on both backends (the native
+libugomemo decoder when it is available, and the pure Python decoder), and
+writes the results as JSON:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+
+Each benchmark is timed --repeat times per corpus file. Setup (opening the
+note, where the benchmark isn't about opening) is not timed. Times are in
+seconds.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Benchmark the checkout this script lives in rather than an installed copy
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "src"))
+
+import numpy as np
+
+import flipnote
+from flipnote import _native
+from flipnote import formats
+
+import synthetic
+
+FORMATS = ("ppm", "kwz")
+BACKENDS = ("native", "python")
+TRACK_COUNTS = {"ppm": 4, "kwz": 5}
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class Note:
+    """One corpus file, opened with a chosen backend."""
+
+    def __init__(self, fmt, path):
+        self.fmt = fmt
+        self.path = path
+
+    def open(self, backend):
+        try:
+            return formats.parser_class(self.fmt).open(self.path, backend=backend)
+        except ValueError as e:
+            if backend == "native":
+                raise BackendUnavailable(str(e))
+            raise
+
+
+# -- Benchmarks ---------------------------------------------------------------
+#
+# A benchmark takes (note, backend) and returns (prepare, ops). prepare() is
+# called before every timed run and returns (run, parser): run() is the timed
+# body and parser, if not None, is unloaded afterwards. ops is the number of
+# operations (files, frames, tracks) in one run.
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+@benchmark("open")
+def bench_open(note, backend):
+    def run():
+        note.open(backend).unload()
+    return lambda: (run, None), 1
+
+
+@benchmark("metadata")
+def bench_metadata(note, backend):
+    def run():
+        parser = note.open(backend)
+        (parser.frame_count, parser.framerate, parser.current_author_name,
+         parser.root_author_id, parser.current_filename)
+        parser.unload()
+    return lambda: (run, None), 1
+
+
+def _frame_benchmark(note, backend, order):
+    parser = note.open(backend)
+    frames = list(order(parser.frame_count))
+    parser.unload()
+
+    def prepare():
+        # A fresh parser each time, so diff replay is part of the measurement
+        parser = note.open(backend)
+
+        def run():
+            for index in frames:
+                parser.decode_frame(index)
+        return run, parser
+    return prepare, len(frames)
+
+
+@benchmark("decode_sequential")
+def bench_decode_sequential(note, backend):
+    return _frame_benchmark(note, backend, range)
+
+
+@benchmark("decode_random")
+def bench_decode_random(note, backend):
+    return _frame_benchmark(note, backend, lambda count: random.Random(count).sample(range(count), count))
+
+
+@benchmark("decode_backward")
+def bench_decode_backward(note, backend):
+    return _frame_benchmark(note, backend, lambda count: range(count - 1, -1, -1))
+
+
+@benchmark("thumbnail")
+def bench_thumbnail(note, backend):
+    def prepare():
+        parser = note.open(backend)
+        return (parser.decode_thumbnail if note.fmt == "ppm" else parser.get_thumbnail), parser
+    return prepare, 1
+
+
+@benchmark("audio")
+def bench_audio(note, backend):
+    tracks = list(range(TRACK_COUNTS[note.fmt]))
+
+    def prepare():
+        parser = note.open(backend)
+
+        def run():
+            for track in tracks:
+                parser.decode_audio_track(track)
+        return run, parser
+    return prepare, len(tracks)
+
+
+# -- Runner -------------------------------------------------------------------
+
+
+def time_benchmark(name, notes, backend, repeat):
+    """Time one benchmark over notes; return a result dict."""
+    times = []
+    ops = 0
+    for note in notes:
+        prepare, note_ops = BENCHMARKS[name](note, backend)
+        ops += note_ops
+        for i in range(repeat):
+            run, parser = prepare()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            if parser is not None:
+                parser.unload()
+            if len(times) <= i:
+                times.append(0.0)
+            times[i] += elapsed
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "ops": ops,
+        "per_op_min": min(times) / ops if ops else None,
+        "times": times,
+    }
+
+
+def run_suite(directory, count, frames, density, repeat, names, backends, seed=0):
+    paths = synthetic.write_corpus(directory, count, frames, density, seed)
+    notes = {fmt: [Note(fmt, p) for p in paths if p.endswith("." + fmt)] for fmt in FORMATS}
+
+    results = []
+    for backend in backends:
+        for fmt in FORMATS:
+            for name in names:
+                entry = {"benchmark": name, "format": fmt, "backend": backend}
+                try:
+                    entry.update(time_benchmark(name, notes[fmt], backend, repeat))
+                except BackendUnavailable as e:
+                    entry["skipped"] = str(e)
+                results.append(entry)
+                _print_result(entry)
+    return results
+
+
+def environment(args):
+    return {
+        "flipnote": flipnote.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "native_available": _native.NATIVE_AVAILABLE,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "corpus": {"notes_per_format": args.notes, "frames": args.frames,
+                   "density": args.density, "seed": args.seed},
+        "repeat": args.repeat,
+    }
+
+
+def _key(entry):
+    return entry["benchmark"], entry["format"], entry["backend"]
+
+
+def _print_result(entry):
+    label = "%-18s %-3s %-6s" % _key(entry)
+    if "skipped" in entry:
+        print("%s  skipped: %s" % (label, entry["skipped"]))
+    else:
+        print("%s  min %10.6f s  median %10.6f s  (%d ops)" % (label, entry["min"], entry["median"], entry["ops"]))
+
+
+def compare(results, baseline):
+    """Print the median time of each result relative to a previous run."""
+    previous = {_key(entry): entry for entry in baseline["results"] if "median" in entry}
+    print("\n%-18s %-3s %-6s  %10s %10s %8s" % ("benchmark", "fmt", "backend", "before", "after", "ratio"))
+    for entry in results:
+        old = previous.get(_key(entry))
+        if old is None or "median" not in entry:
+            continue
+        print("%-18s %-3s %-6s  %10.6f %10.6f %7.2fx"
+              % (_key(entry) + (old["median"], entry["median"], entry["median"] / old["median"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the flipnote PPM and KWZ parsers.")
+    parser.add_argument("--output", "-o", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--notes", type=int, default=2, help="synthetic notes per format")
+    parser.add_argument("--frames", type=int, default=32)
+    parser.add_argument("--density", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=BACKENDS, action="append",
+                        help="backend to run (repeatable; default: both)")
+    parser.add_argument("--benchmark", choices=sorted(BENCHMARKS), action="append",
+                        help="benchmark to run (repeatable; default: all)")
+    args = parser.parse_args()
+
+    names = args.benchmark or list(BENCHMARKS)
+    backends = args.backend or list(BACKENDS)
+    with tempfile.TemporaryDirectory(prefix="flipnote-bench-") as directory:
+        results = run_suite(directory, args.notes, args.frames, args.density,
+                            args.repeat, names, backends, args.seed)
+
+    report = {"environment": environment(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
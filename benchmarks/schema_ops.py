@@ -0,0 +1,108 @@
+"""
+Micro-benchmarks for the FSID and filename helpers in flipnote.schema.
+
+Each operation is timed three ways over the same synthetic IDs: the single
+value function called in a loop, its batch variant on a list, and its batch
+variant on a NumPy string array. Memoization caches are cleared before every
+timed run unless --warm is given. --unique sets how many distinct values the
+--count inputs are drawn from, since real catalogues repeat IDs heavily.
+
+    python benchmarks/schema_ops.py --count 1000000 --unique 50000
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "src"))
+
+import numpy as np
+
+from flipnote import schema
+
+KWZ_FILENAME_ALPHABET = "cwmfjordvegbalksnthpyxquiz012345"
+
+
+def _ppm_fsid(rng):
+    return rng.choice("0159") + "%015X" % rng.getrandbits(60)
+
+
+def _kwz_fsid(rng):
+    return schema.convertPPMtoKWZ(_ppm_fsid(rng))
+
+
+def _kwz_filename(rng):
+    return "".join(rng.choice(KWZ_FILENAME_ALPHABET) for _ in range(28))
+
+
+# name: (single function, batch function, input generator, caches to clear)
+OPERATIONS = {
+    "verifyPPMFSID": (schema.verifyPPMFSID, schema.verifyPPMFSIDs, _ppm_fsid, ()),
+    "convertKWZFSIDToPPM": (schema.convertKWZFSIDToPPM, schema.convertKWZFSIDsToPPM, _kwz_fsid,
+                            (schema._kwz_fsid_to_ppm,)),
+    "convertPPMtoKWZ": (schema.convertPPMtoKWZ, schema.convertPPMFSIDsToKWZ, _ppm_fsid,
+                        (schema._ppm_fsid_to_kwz,)),
+    "unpackKWZFilename": (schema.unpackKWZFilename, schema.unpackKWZFilenames, _kwz_filename,
+                          (schema._unpack_kwz_filename,)),
+}
+
+
+def time_operation(name, count, unique, repeat, warm, seed=0):
+    single, batch, generate, caches = OPERATIONS[name]
+    rng = random.Random(seed)
+    pool = [generate(rng) for _ in range(unique)]
+    values = [rng.choice(pool) for _ in range(count)]
+    array = np.array(values)
+
+    variants = {
+        "single": lambda: [single(v) for v in values],
+        "batch_list": lambda: batch(values),
+        "batch_array": lambda: batch(array),
+    }
+    results = {}
+    for variant, run in variants.items():
+        times = []
+        for _ in range(repeat):
+            if not warm:
+                for cache in caches:
+                    cache.cache_clear()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        results[variant] = {"min": min(times), "median": statistics.median(times),
+                            "per_item_min": min(times) / count}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark flipnote.schema single and batch helpers.")
+    parser.add_argument("--count", type=int, default=200000, help="values per run")
+    parser.add_argument("--unique", type=int, default=20000, help="distinct values among them")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warm", action="store_true", help="keep memoization caches between runs")
+    parser.add_argument("--operation", choices=sorted(OPERATIONS), action="append",
+                        help="operation to run (repeatable; default: all)")
+    parser.add_argument("--output", "-o", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    report = {}
+    for name in args.operation or list(OPERATIONS):
+        report[name] = time_operation(name, args.count, args.unique, args.repeat, args.warm)
+        for variant, result in report[name].items():
+            print("%-20s %-12s min %9.6f s  (%7.1f ns/item)"
+                  % (name, variant, result["min"], result["per_item_min"] * 1e9))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"count": args.count, "unique": args.unique, "repeat": args.repeat,
+                       "warm": args.warm, "results": report}, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Deterministic synthetic PPM and KWZ notes for benchmarking.
+
+The notes are structurally valid and exercise every encoding the decoders
+handle (all four PPM line encodings and frame translation; all eight KWZ
+tile types, keyframes and diff layers; ADPCM audio on every track), but
+their content is pseudo-random. The same seed always produces the same
+bytes, so benchmark runs are comparable without shipping real notes.
+Random frame bitstreams are added to flipnote.encode's encoders as
+already-compressed frames, so the containers are written by the same code
+as encoded notes.
+
+    python benchmarks/synthetic.py out_dir --count 4
+"""
+
+import argparse
+import os
+import random
+import struct
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Use the checkout this script lives in rather than an installed copy
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "src"))
+
+from flipnote import encode
+from flipnote import kwz
+from flipnote import ppm
+
+# 4-line-pattern tile indices are < 6561 (3 ** 8), "common line" indices < 32
+KWZ_LINE_INDEX_LIMIT = 6561
+KWZ_COMMON_INDEX_LIMIT = 32
+
+
+def _random_bytes(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+# -- PPM ----------------------------------------------------------------------
+
+
+def _ppm_layer(rng, density):
+    """(line encoding table, line data) for one 256x192 layer."""
+    encodings = bytearray(48)
+    data = bytearray()
+    for y in range(192):
+        encoding = rng.choice((1, 1, 2, 3)) if rng.random() < density else 0
+        encodings[y // 4] |= encoding << ((y % 4) * 2)
+        if encoding in (1, 2):
+            # 32 chunk flags (dense-ish), then one byte per set flag
+            flags = rng.getrandbits(32) & rng.getrandbits(32)
+            data += struct.pack(">I", flags)
+            data += _random_bytes(rng, bin(flags).count("1"))
+        elif encoding == 3:
+            data += _random_bytes(rng, 32)
+    return bytes(encodings), bytes(data)
+
+
+def make_ppm(seed=0, frames=32, density=0.5, audio_bytes=8192):
+    """Build a synthetic .ppm note.
+
+    Args:
+        seed: random seed; equal seeds give identical files
+        frames: number of frames (1-999)
+        density: fraction of lines that carry pixel data in each layer
+        audio_bytes: size of the BGM track; sound effects get a quarter each
+    """
+    rng = random.Random(seed)
+    encoder = encode.PPMEncoder(
+        frame_speed=6,
+        root_author_name="Root",
+        parent_author_name="Parent",
+        current_author_name="Current",
+        root_author_id="59A643D0A30FD688",
+        parent_author_id="59A643D0A30FD688",
+        current_author_id="59A643D0A30FD688",
+        parent_filename="F3A1B2_%013d_000" % seed,
+        current_filename="F3A1B2_%013d_001" % seed,
+        root_filename_fragment="F3A1B2_%010d" % seed,
+        timestamp=ppm.DSI_EPOCH + 400000000 + seed,
+    )
+
+    for i in range(frames):
+        keyframe = i == 0 or rng.random() < 0.2
+        translate = not keyframe and rng.random() < 0.3
+        header = (0x80 if keyframe else 0) | (0x20 if translate else 0)
+        header |= (rng.randrange(4) << 3) | (rng.randrange(4) << 1) | rng.randrange(2)
+        blob = bytearray((header,))
+        if translate:
+            blob += struct.pack("<bb", rng.randint(-16, 16), rng.randint(-16, 16))
+        encodings_1, data_1 = _ppm_layer(rng, density)
+        encodings_2, data_2 = _ppm_layer(rng, density)
+        encoder.add_encoded_frame(blob + encodings_1 + encodings_2 + data_1 + data_2, sfx=rng.randrange(8))
+
+    track_sizes = [audio_bytes] + [audio_bytes // 4] * (encode.PPM_TRACK_COUNT - 1)
+    for track, size in enumerate(track_sizes):
+        encoder.set_track(track, adpcm=_random_bytes(rng, size))
+    encoder.set_thumbnail([[rng.randrange(16) for _ in range(ppm.PPM_THUMBNAIL_WIDTH)]
+                           for _ in range(ppm.PPM_THUMBNAIL_HEIGHT)])
+    return encoder.tobytes()
+
+
+# -- KWZ ----------------------------------------------------------------------
+
+
+def _kwz_layer(rng, is_diff, density):
+    """Bitstream for one 320x240 layer, covering all 1200 8x8 tiles."""
+    writer = encode._BitWriter()
+    tile = 0
+    while tile < kwz.KWZ_TILE_COUNT:
+        if rng.random() >= density:
+            if is_diff and rng.random() < 0.7:
+                # Type 5: skip a run of tiles (unchanged from the previous frame)
+                run = rng.randint(0, min(31, kwz.KWZ_TILE_COUNT - 1 - tile))
+                writer.write(5, 3)
+                writer.write(run, 5)
+                tile += run + 1
+            else:
+                # Type 6: no-op
+                writer.write(6, 3)
+                tile += 1
+            continue
+
+        tile_type = rng.choice((0, 1, 2, 3, 4, 7))
+        writer.write(tile_type, 3)
+        if tile_type in (0, 2):
+            writer.write(rng.randrange(KWZ_COMMON_INDEX_LIMIT), 5)
+        elif tile_type in (1, 3):
+            writer.write(rng.randrange(KWZ_LINE_INDEX_LIMIT), 13)
+        elif tile_type == 4:
+            flags = rng.getrandbits(8)
+            writer.write(flags, 8)
+            for row in range(8):
+                if flags & (1 << row):
+                    writer.write(rng.randrange(KWZ_COMMON_INDEX_LIMIT), 5)
+                else:
+                    writer.write(rng.randrange(KWZ_LINE_INDEX_LIMIT), 13)
+        else:
+            writer.write(rng.randrange(4), 2)
+            common = rng.randrange(2)
+            writer.write(common, 1)
+            bits = 5 if common else 13
+            limit = KWZ_COMMON_INDEX_LIMIT if common else KWZ_LINE_INDEX_LIMIT
+            writer.write(rng.randrange(limit), bits)
+            writer.write(rng.randrange(limit), bits)
+        tile += 1
+    return writer.getvalue()
+
+
+def make_kwz(seed=0, frames=32, density=0.5, audio_bytes=16384):
+    """Build a synthetic .kwz note.
+
+    Args:
+        seed: random seed; equal seeds give identical files
+        frames: number of frames
+        density: fraction of tiles that carry pixel data in each layer
+        audio_bytes: size of the BGM track; sound effects get a quarter each
+    """
+    rng = random.Random(seed)
+    fsid = "00A45FDC21928E8CC700"
+    filename = (b"synth%023d" % seed)[:28]
+    # Looping, speed 8 (20 fps), all layers visible
+    encoder = encode.KWZEncoder(
+        frame_speed=8,
+        creation_timestamp=kwz.DSI_EPOCH + 600000000 + seed,
+        modified_timestamp=kwz.DSI_EPOCH + 600000000 + seed,
+        root_fsid=fsid,
+        parent_fsid=fsid,
+        current_fsid=fsid,
+        root_username="Root",
+        parent_username="Parent",
+        current_username="Current",
+        root_filename=filename,
+        parent_filename=filename,
+        current_filename=filename,
+    )
+
+    for i in range(frames):
+        # Paper colour, then two drawable colours (1-6) per layer
+        flags = rng.randrange(6)
+        for slot in range(6):
+            flags |= (1 + rng.randrange(6)) << (8 + 4 * slot)
+        if i == 0 or rng.random() < 0.2:
+            flags |= 0x70  # every layer is a keyframe
+        else:
+            flags |= rng.choice((0, 0x10, 0x20, 0x40))
+        layers = [_kwz_layer(rng, not flags & (0x10 << layer), density) for layer in range(3)]
+        encoder.add_encoded_frame(flags, layers)
+
+    track_sizes = [audio_bytes] + [audio_bytes // 4] * (encode.KWZ_TRACK_COUNT - 1)
+    for track, size in enumerate(track_sizes):
+        encoder.set_track(track, adpcm=_random_bytes(rng, size))
+    return encoder.tobytes()
+
+
+def write_corpus(directory, count=4, frames=32, density=0.5, seed=0):
+    """Write count PPM and count KWZ notes to directory; return their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        for ext, make in (("ppm", make_ppm), ("kwz", make_kwz)):
+            path = os.path.join(directory, "synthetic_%03d.%s" % (i, ext))
+            with open(path, "wb") as f:
+                f.write(make(seed + i, frames=frames, density=density))
+            paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--count", type=int, default=4, help="notes per format")
+    parser.add_argument("--frames", type=int, default=32)
+    parser.add_argument("--density", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for path in write_corpus(args.directory, args.count, args.frames, args.density, args.seed):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
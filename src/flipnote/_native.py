@@ -4,6 +4,13 @@ Optional ctypes wrapper for libugomemo C library.
 If the shared library is available, NATIVE_AVAILABLE is True and the
 native_* functions delegate to C for performance. Otherwise everything
 falls back to pure Python.
+
+A native decode that fails returns None and is recorded in flipnote.metrics
+as a fallback, with the reason.
+
+The parsers take a backend option: "auto" uses the native library when it
+can and falls back to Python otherwise, "native" requires it and "python"
+never uses it. FrameVerifier implements their verify option.
 """
 
 import ctypes
@@ -11,6 +18,11 @@ import ctypes.util
 import os
 import sys
 import platform
+import time
+
+from flipnote import metrics
+
+BACKENDS = ("auto", "native", "python")
 
 NATIVE_AVAILABLE = False
 _lib = None
@@ -85,6 +97,132 @@ def _init():
     NATIVE_AVAILABLE = True
 
 
+def _fallback(operation, reason):
+    """Record why a native call is falling back to Python; returns None."""
+    metrics.fallback(operation, reason)
+    return None
+
+
+def _unavailable_reason():
+    return "native library not available" if not NATIVE_AVAILABLE else "no native context"
+
+
+def open_context(fmt, path, backend="auto", verify=0):
+    """Open a native context for a .ppm or .kwz file according to backend.
+
+    Returns (ctx, reason, verifier): ctx is None when the Python decoder is
+    to be used, and reason says why it is a fallback (None for
+    backend="python", which asked for it). With backend="native", raises
+    ValueError instead of falling back. verifier is a FrameVerifier for a
+    non-zero verify fraction, else None; when backend="auto" falls back,
+    nothing is checked and its report gives the reason as "skipped".
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend %r (expected one of %s)" % (backend, ", ".join(BACKENDS)))
+    verifier = FrameVerifier(fmt, verify) if verify else None
+    if backend == "python":
+        if verifier is not None:
+            raise ValueError("verify compares both backends and can't be used with backend='python'")
+        return None, None, None
+
+    if not NATIVE_AVAILABLE:
+        reason = "native library not available"
+    elif path is None:
+        reason = "loaded without a file path"
+    else:
+        ctx = (native_ppm_open if fmt == "ppm" else native_kwz_open)(path)
+        if ctx is not None:
+            return ctx, None, verifier
+        reason = "native open failed"
+
+    if backend == "native":
+        raise ValueError("Native backend unavailable: %s" % reason)
+    if verifier is not None:
+        verifier.skip(reason)
+    return None, reason, verifier
+
+
+class FrameVerifier:
+    """Differential check of the native frame decoder against the Python one.
+
+    A fixed, evenly spread fraction of frame indices is sampled; the first
+    time a sampled frame is decoded it is decoded by both backends, timed,
+    and compared pixel for pixel. Results are kept for report() and also
+    go to flipnote.metrics as <fmt>.verify.* counters and timings.
+    """
+
+    def __init__(self, fmt, fraction):
+        if not 0 <= fraction <= 1:
+            raise ValueError("verify must be a fraction between 0 and 1, got %r" % (fraction,))
+        self.fmt = fmt
+        self.fraction = fraction
+        self._threshold = int(fraction * (1 << 32))
+        self._checked = set()
+        self.mismatches = []
+        self.failures = []
+        self.native_time = 0.0
+        self.python_time = 0.0
+        self.skipped = None
+
+    def skip(self, reason):
+        """Record that no frames will be checked because there is no native
+        context, and why."""
+        self.skipped = reason
+        metrics.fallback(self.fmt + ".verify", reason)
+
+    def wants(self, index):
+        """True if frame index is sampled and hasn't been checked yet."""
+        # Multiplicative hashing spreads the sample evenly over the frames
+        return (index * 2654435761) & 0xFFFFFFFF < self._threshold and index not in self._checked
+
+    def check(self, index, native_decode, python_decode):
+        """Decode frame index with both backends; return the native RGB frame,
+        or the Python one if the native decode failed."""
+        self._checked.add(index)
+        start = time.perf_counter()
+        native = native_decode()
+        middle = time.perf_counter()
+        python = python_decode()
+        end = time.perf_counter()
+
+        prefix = self.fmt + ".verify."
+        metrics.count(prefix + "frames")
+        if native is None:
+            self.failures.append(index)
+            metrics.count(prefix + "failures")
+            return python
+
+        self.native_time += middle - start
+        self.python_time += end - middle
+        metrics.add_time(prefix + "native", middle - start)
+        metrics.add_time(prefix + "python", end - middle)
+        differing = int((native != python).any(axis=2).sum())
+        if differing:
+            self.mismatches.append({"index": index, "pixels": differing})
+            metrics.count(prefix + "mismatches")
+        return native
+
+    def report(self):
+        """Results so far as a dict.
+
+        frames: frames checked; failures: indices the native decoder failed
+        on; mismatches: [{"index", "pixels"}] for frames whose pixels differ;
+        native_time / python_time: seconds spent by each backend on the
+        compared frames; speedup: python_time / native_time; skipped: why
+        nothing is being checked (the native decoder is unavailable), or None.
+        """
+        return {
+            "fraction": self.fraction,
+            "skipped": self.skipped,
+            "frames": len(self._checked),
+            "failures": list(self.failures),
+            "mismatches": list(self.mismatches),
+            "native_time": self.native_time,
+            "python_time": self.python_time,
+            "speedup": self.python_time / self.native_time if self.native_time else None,
+        }
+
+
 # Convenience functions
 
 def native_ppm_open(path):
@@ -99,39 +237,41 @@ def native_ppm_close(ctx):
         _lib.ppm_close(ctx)
 
 
+@metrics.timed("ppm.decode_frame.native")
 def native_ppm_decode_frame(ctx, index, width=256, height=192):
     """Decode a PPM frame via C. Returns numpy array (H, W, 3) uint8 or None."""
     if not NATIVE_AVAILABLE or not ctx:
-        return None
+        return _fallback("ppm.decode_frame", _unavailable_reason())
     try:
         import numpy as np
         pixels = _lib.ppm_decode_frame_alloc(ctx, index)
         if not pixels:
-            return None
+            return _fallback("ppm.decode_frame", "native decoder returned NULL")
         buf = (ctypes.c_uint8 * (width * height * 3)).from_address(ctypes.addressof(pixels.contents))
         result = np.frombuffer(buf, dtype=np.uint8).reshape((height, width, 3)).copy()
         _libc.free(pixels)
         return result
-    except Exception:
-        return None
+    except Exception as e:
+        return _fallback("ppm.decode_frame", "%s raised" % type(e).__name__)
 
 
+@metrics.timed("ppm.decode_audio.native")
 def native_ppm_decode_track(ctx, track):
     """Decode a PPM audio track via C. Returns numpy array of int16 or None."""
     if not NATIVE_AVAILABLE or not ctx:
-        return None
+        return _fallback("ppm.decode_audio", _unavailable_reason())
     try:
         import numpy as np
         count = ctypes.c_uint32(0)
         samples = _lib.ppm_decode_track_alloc(ctx, track, ctypes.byref(count))
         if not samples:
-            return None
+            return _fallback("ppm.decode_audio", "native decoder returned NULL")
         buf = (ctypes.c_int16 * count.value).from_address(ctypes.addressof(samples.contents))
         result = np.frombuffer(buf, dtype=np.int16).copy()
         _libc.free(samples)
         return result
-    except Exception:
-        return None
+    except Exception as e:
+        return _fallback("ppm.decode_audio", "%s raised" % type(e).__name__)
 
 
 def native_kwz_open(path):
@@ -146,39 +286,41 @@ def native_kwz_close(ctx):
         _lib.kwz_cleanup(ctx)
 
 
+@metrics.timed("kwz.decode_frame.native")
 def native_kwz_decode_frame(ctx, index, width=320, height=240):
     """Decode a KWZ frame via C. Returns numpy array (H, W, 3) uint8 or None."""
     if not NATIVE_AVAILABLE or not ctx:
-        return None
+        return _fallback("kwz.decode_frame", _unavailable_reason())
     try:
         import numpy as np
         pixels = _lib.kwz_decode_frame_alloc(ctx, index)
         if not pixels:
-            return None
+            return _fallback("kwz.decode_frame", "native decoder returned NULL")
         buf = (ctypes.c_uint8 * (width * height * 3)).from_address(ctypes.addressof(pixels.contents))
         result = np.frombuffer(buf, dtype=np.uint8).reshape((height, width, 3)).copy()
         _libc.free(pixels)
         return result
-    except Exception:
-        return None
+    except Exception as e:
+        return _fallback("kwz.decode_frame", "%s raised" % type(e).__name__)
 
 
+@metrics.timed("kwz.decode_audio.native")
 def native_kwz_decode_track(ctx, track, step_index=-1):
     """Decode a KWZ audio track via C. Returns numpy array of int16 or None."""
     if not NATIVE_AVAILABLE or not ctx:
-        return None
+        return _fallback("kwz.decode_audio", _unavailable_reason())
     try:
         import numpy as np
         count = ctypes.c_uint32(0)
         samples = _lib.kwz_decode_track_alloc(ctx, track, step_index, ctypes.byref(count))
         if not samples:
-            return None
+            return _fallback("kwz.decode_audio", "native decoder returned NULL")
         buf = (ctypes.c_int16 * count.value).from_address(ctypes.addressof(samples.contents))
         result = np.frombuffer(buf, dtype=np.int16).copy()
         _libc.free(samples)
         return result
-    except Exception:
-        return None
+    except Exception as e:
+        return _fallback("kwz.decode_audio", "%s raised" % type(e).__name__)
 
 
 # Initialize on import
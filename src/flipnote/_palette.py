@@ -0,0 +1,63 @@
+"""
+Helpers for palette-indexed frames shared by the PPM and KWZ parsers.
+"""
+
+import numpy as np
+
+
+def palette_array(colors):
+    """Convert a list of RGB tuples to an (N, 3) uint8 lookup table."""
+    return np.array(colors, dtype=np.uint8)
+
+
+def rgb_to_indices(rgb, palette):
+    """Map an RGB frame (H, W, 3) back to indices into palette.
+
+    Used when the native decoder hands back RGB but an indexed frame is
+    wanted. Colours that are not in the palette map to 0.
+    """
+    keys = (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+    indices = np.zeros(keys.shape, dtype=np.uint8)
+    for i, (r, g, b) in enumerate(palette):
+        indices[keys == ((r << 16) | (g << 8) | b)] = i
+    return indices
+
+
+def check_region(region, width, height):
+    """Validate an (x, y, w, h) crop rectangle against the frame size."""
+    try:
+        x, y, w, h = (int(v) for v in region)
+    except (TypeError, ValueError):
+        raise ValueError("region must be an (x, y, w, h) tuple, got %r" % (region,))
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height:
+        raise ValueError("region %r is empty or outside the %dx%d frame" % (region, width, height))
+    return x, y, w, h
+
+
+def check_scale(scale):
+    """Validate an integer upscaling factor."""
+    if isinstance(scale, bool) or not isinstance(scale, (int, np.integer)) or scale < 1:
+        raise ValueError("scale must be a positive integer, got %r" % (scale,))
+    return int(scale)
+
+
+def upscale_indices(indices, scale):
+    """Enlarge an (H, W) index frame by an integer factor (nearest neighbour)."""
+    if scale == 1:
+        return indices
+    h, w = indices.shape
+    return np.broadcast_to(indices[:, None, :, None], (h, scale, w, scale)).reshape(h * scale, w * scale)
+
+
+def indices_to_rgb(indices, palette, scale=1, out=None):
+    """Look up an (H, W) index frame in an (N, 3) palette, upscaling by scale.
+
+    The index plane is enlarged (nearest neighbour) before the colour lookup,
+    so no full-size RGB intermediate is made. Writes into out, an
+    (H * scale, W * scale, 3) uint8 array, if given.
+    """
+    indices = upscale_indices(indices, scale)
+    if out is None:
+        return palette[indices]
+    np.take(palette, indices, axis=0, out=out)
+    return out
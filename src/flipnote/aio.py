@@ -0,0 +1,136 @@
+"""
+asyncio front-end for the PPM and KWZ parsers.
+
+Parsing and decoding are CPU-bound (or block inside libugomemo), so every
+call is offloaded to a shared thread pool. The pool size is the concurrency
+limit: at most that many notes are being parsed or decoded at once, which
+keeps the native library from being oversubscribed by a busy server.
+
+    from flipnote import aio
+
+    note = await aio.open("animation.kwz")
+    async for frame in note.aiter_frames():
+        ...
+    audio = await aio.decode_audio_track(note, 0)
+
+Cancelling the awaiting task drops any call that has not started yet;
+aiter_frames() checks for cancellation between frames, so a long note can be
+abandoned part way through.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flipnote import formats
+
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+_executor = None
+_max_workers = DEFAULT_MAX_WORKERS
+_executor_lock = threading.Lock()
+
+
+def set_max_workers(count):
+    """Set the size of the shared executor (the global concurrency limit)."""
+    global _executor, _max_workers
+    if count < 1:
+        raise ValueError("max_workers must be at least 1, got %d" % count)
+    with _executor_lock:
+        _max_workers = count
+        old, _executor = _executor, None
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_max_workers,
+                                           thread_name_prefix="flipnote-aio")
+        return _executor
+
+
+async def _run(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or _get_executor(),
+                                      functools.partial(func, *args, **kwargs))
+
+
+class AsyncParser:
+    """Wraps a ppm.Parser or kwz.Parser with awaitable decode methods.
+
+    Metadata attributes are read straight from the wrapped parser. Parsers
+    keep frame-diffing state, so calls on one note are serialized even when
+    several tasks share it. Tasks wait for the note on the event loop rather
+    than in the pool, so a busy note never holds up a worker that other
+    notes could use.
+    """
+
+    def __init__(self, parser, executor=None):
+        self.parser = parser
+        self._executor = executor
+        self._queue_lock = None  # asyncio.Lock, created on the running loop
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+    def _locked(self, func, *args, **kwargs):
+        with self._lock:
+            return func(*args, **kwargs)
+
+    async def call(self, name, *args, **kwargs):
+        """Run any parser method by name on the executor."""
+        if self._queue_lock is None:
+            self._queue_lock = asyncio.Lock()
+        async with self._queue_lock:
+            # The thread lock only waits if a cancelled call is still running
+            return await _run(self._executor, self._locked, getattr(self.parser, name), *args, **kwargs)
+
+    async def decode_frame(self, index, **kwargs):
+        """Decode a frame to an RGB numpy array without blocking the loop."""
+        return await self.call("decode_frame", index, **kwargs)
+
+    async def aiter_frames(self, start=0, stop=None, **kwargs):
+        """Asynchronously iterate decoded RGB frames from start to stop."""
+        if stop is None:
+            stop = self.parser.frame_count
+        for index in range(start, stop):
+            yield await self.decode_frame(index, **kwargs)
+
+    async def decode_audio_track(self, track, *args, **kwargs):
+        """Decode an audio track to int16 PCM without blocking the loop."""
+        return await self.call("decode_audio_track", track, *args, **kwargs)
+
+    async def close(self):
+        """Release the parser's stream and native resources."""
+        await self.call("unload")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+async def open(path, executor=None):
+    """Open a .ppm or .kwz file on the executor. Returns an AsyncParser."""
+    parser = await _run(executor, formats.open_note, path)
+    return AsyncParser(parser, executor)
+
+
+async def load(data, executor=None):
+    """Parse an in-memory note on the executor. Returns an AsyncParser."""
+    parser = await _run(executor, formats.load_note, data)
+    return AsyncParser(parser, executor)
+
+
+async def decode_audio_track(parser, track, *args, **kwargs):
+    """Decode an audio track of an AsyncParser (or a plain parser)."""
+    if not isinstance(parser, AsyncParser):
+        parser = AsyncParser(parser)
+    return await parser.decode_audio_track(track, *args, **kwargs)
@@ -0,0 +1,178 @@
+"""
+Read PPM and KWZ notes straight out of tar and zip archives.
+
+Members are read one at a time in archive order and recognised by their
+magic bytes, so names and extensions don't matter and nothing is extracted
+to disk. Tar archives are read as a stream (compressed or not, from a path
+or any binary file object, including pipes); zip archives need a path or a
+seekable file object.
+
+    from flipnote import archive
+
+    for name, note in archive.iter_notes("notes.tar.gz"):
+        print(name, note.frame_count)
+
+    # Parse and summarise on a process pool, at most 64 members in flight
+    for name, meta in archive.map_notes("notes.zip", workers=8, max_pending=64):
+        print(name, meta["current_author_id"])
+"""
+
+import collections
+import os
+import struct
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from flipnote import formats
+
+# Members larger than this are skipped without being read (the largest real
+# notes are around 1 MiB)
+MAX_MEMBER_SIZE = 8 * 1024 * 1024
+
+# Errors that mean a member is not a parseable note
+PARSE_ERRORS = (ValueError, IndexError, KeyError, struct.error, UnicodeDecodeError)
+
+Member = collections.namedtuple("Member", "name format size mtime data")
+Member.__doc__ = """A note read from an archive: member name, "ppm" or "kwz",
+size in bytes, modification time (Unix seconds) and the file contents."""
+
+
+def _is_zip(archive):
+    if hasattr(archive, "read"):
+        if not archive.seekable():
+            return False
+        position = archive.tell()
+        try:
+            return zipfile.is_zipfile(archive)
+        finally:
+            archive.seek(position)
+    return zipfile.is_zipfile(archive)
+
+
+def _tar_members(archive, max_size, select):
+    if hasattr(archive, "read"):
+        tar = tarfile.open(fileobj=archive, mode="r|*")
+    else:
+        tar = tarfile.open(archive, mode="r|*")
+    with tar:
+        for info in tar:
+            if not info.isfile() or info.size < 4 or info.size > max_size:
+                continue
+            if select is not None and not select(info.name, info.size, info.mtime):
+                continue
+            f = tar.extractfile(info)
+            head = f.read(4)
+            fmt = formats.detect_format(head)
+            if fmt is not None:
+                yield Member(info.name, fmt, info.size, info.mtime, head + f.read())
+
+
+def _zip_mtime(info):
+    # Zip timestamps are in local time
+    return int(time.mktime(info.date_time + (0, 0, -1)))
+
+
+def _zip_members(archive, max_size, select):
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or info.file_size < 4 or info.file_size > max_size:
+                continue
+            mtime = _zip_mtime(info)
+            if select is not None and not select(info.filename, info.file_size, mtime):
+                continue
+            with zf.open(info) as f:
+                head = f.read(4)
+                fmt = formats.detect_format(head)
+                if fmt is not None:
+                    yield Member(info.filename, fmt, info.file_size, mtime, head + f.read())
+
+
+def iter_members(archive, max_size=MAX_MEMBER_SIZE, select=None):
+    """Yield a Member for each PPM or KWZ file in a tar or zip archive.
+
+    archive is a path or a binary file object. Members that are not regular
+    files, are larger than max_size or don't start with PPM/KWZ magic are
+    skipped. select, if given, is called as select(name, size, mtime) before
+    a member is read and skips it when it returns False (e.g. to only read
+    members that changed since a previous scan).
+
+    Only the member being yielded is held in memory.
+    """
+    if _is_zip(archive):
+        return _zip_members(archive, max_size, select)
+    return _tar_members(archive, max_size, select)
+
+
+def iter_notes(archive, max_size=MAX_MEMBER_SIZE, select=None, skip_invalid=False):
+    """Yield (member name, parser) for each note in a tar or zip archive.
+
+    Each member is parsed in memory with formats.load_note. With
+    skip_invalid, members that fail to parse are skipped instead of raising.
+    See iter_members for the other arguments.
+    """
+    for member in iter_members(archive, max_size, select):
+        try:
+            parser = formats.load_note(member.data)
+        except PARSE_ERRORS:
+            if skip_invalid:
+                continue
+            raise
+        yield member.name, parser
+
+
+def iter_metadata(archive, max_size=MAX_MEMBER_SIZE, select=None, skip_invalid=False):
+    """Yield a formats.note_metadata dict for each note in a tar or zip archive,
+    with the member's name, size and mtime added."""
+    for member in iter_members(archive, max_size, select):
+        parsed, record = _parse_member(formats.note_metadata, member.data, skip_invalid)
+        if parsed:
+            record.update(name=member.name, size=member.size, mtime=member.mtime)
+            yield record
+
+
+def _parse_member(func, data, skip_invalid):
+    """Parse one note; return (True, func(parser)), or (False, None) if it
+    fails to parse and skip_invalid is set."""
+    try:
+        parser = formats.load_note(data)
+    except PARSE_ERRORS:
+        if skip_invalid:
+            return False, None
+        raise
+    try:
+        return True, func(parser)
+    finally:
+        parser.unload()
+
+
+def map_notes(archive, func=formats.note_metadata, workers=None, max_pending=None,
+              max_size=MAX_MEMBER_SIZE, select=None, skip_invalid=False):
+    """Apply func(parser) to each note of an archive on a process pool.
+
+    Members are read sequentially in this process and parsed in the workers;
+    yields (member name, result) in archive order. func must be picklable
+    (a module-level function) and so must its result. At most max_pending
+    members (default 2 * workers) are read ahead, which bounds memory. By
+    default func is formats.note_metadata. skip_invalid drops members that
+    fail to parse; see iter_members for the other arguments.
+    """
+    workers = workers or os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        members = iter_members(archive, max_size, select)
+        while True:
+            if len(pending) < max_pending:
+                member = next(members, None)
+                if member is not None:
+                    pending.append((member.name, pool.submit(_parse_member, func, member.data, skip_invalid)))
+                    continue
+            if not pending:
+                break
+            name, future = pending.popleft()
+            parsed, result = future.result()
+            if parsed:
+                yield name, result
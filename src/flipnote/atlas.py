@@ -0,0 +1,234 @@
+"""
+Sprite sheets and contact sheets.
+
+frame_sheet lays out frames of one note on a grid; contact_sheet lays out
+one image per note (the PPM thumbnail, the KWZ thumbnail frame, or a chosen
+frame) for many files. Both decode straight into slots of one preallocated
+palette-indexed atlas, and Atlas.save_png writes it as an indexed PNG with
+a small built-in zlib writer:
+
+    from flipnote.atlas import contact_sheet
+
+    contact_sheet(paths, columns=10, workers=4).save_png("gallery.png")
+"""
+
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from flipnote import formats
+from flipnote import kwz
+from flipnote import ppm
+from flipnote._palette import check_scale, upscale_indices
+
+DEFAULT_BACKGROUND = (0xFF, 0xFF, 0xFF)
+
+# KWZ thumbnails are JPEGs; contact sheets sample the thumbnail frame instead,
+# every 5th pixel from the centre of each 5x5 block (320x240 -> 64x48)
+KWZ_THUMBNAIL_STEP = 5
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_ROWS_PER_CHUNK = 64
+
+
+# -- PNG writer ---------------------------------------------------------------
+
+
+def _png_chunk(kind, data):
+    crc = zlib.crc32(data, zlib.crc32(kind)) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+
+def _pack_rows(rows, bits):
+    """Pack (n, width) index rows to the PNG bit depth, each prefixed with filter type 0."""
+    if bits < 8:
+        per_byte = 8 // bits
+        pad = (-rows.shape[1]) % per_byte
+        if pad:
+            rows = np.pad(rows, ((0, 0), (0, pad)))
+        groups = rows.reshape(rows.shape[0], -1, per_byte)
+        packed = np.zeros(groups.shape[:2], dtype=np.uint8)
+        # Leftmost pixel in the most significant bits
+        for k in range(per_byte):
+            packed |= groups[:, :, k] << (8 - bits * (k + 1))
+        rows = packed
+    out = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 1:] = rows
+    return out.tobytes()
+
+
+def write_png(path, indices, palette, compress_level=6):
+    """Write a (height, width) uint8 index array as a palette PNG.
+
+    The bit depth is the smallest (1, 2, 4 or 8) that fits the palette.
+    Rows are compressed and written PNG_ROWS_PER_CHUNK at a time.
+    """
+    palette = np.asarray(palette, dtype=np.uint8)
+    if not 1 <= len(palette) <= 256:
+        raise ValueError("PNG palettes hold 1-256 colours, got %d" % len(palette))
+    height, width = indices.shape
+    bits = next(b for b in (1, 2, 4, 8) if len(palette) <= (1 << b))
+
+    def write(fp):
+        fp.write(PNG_SIGNATURE)
+        fp.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bits, 3, 0, 0, 0)))
+        fp.write(_png_chunk(b"PLTE", palette.tobytes()))
+        compressor = zlib.compressobj(compress_level)
+        for y in range(0, height, PNG_ROWS_PER_CHUNK):
+            data = compressor.compress(_pack_rows(indices[y:y + PNG_ROWS_PER_CHUNK], bits))
+            if data:
+                fp.write(_png_chunk(b"IDAT", data))
+        fp.write(_png_chunk(b"IDAT", compressor.flush()))
+        fp.write(_png_chunk(b"IEND", b""))
+
+    if hasattr(path, "write"):
+        write(path)
+    else:
+        with open(path, "wb") as f:
+            write(f)
+
+
+# -- Atlas --------------------------------------------------------------------
+
+
+class Atlas:
+    """A grid of equally sized, palette-indexed slots in one array.
+
+    pixels indexes into palette, which is the background colour followed by
+    each source palette in turn. Content smaller than a slot is centred.
+    Slots are disjoint views, so different threads may fill different slots.
+    """
+
+    def __init__(self, count, tile_width, tile_height, columns, palettes,
+                 background=DEFAULT_BACKGROUND, padding=0):
+        if count < 1:
+            raise ValueError("An atlas needs at least one slot")
+        self.count = count
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.columns = max(1, min(columns, count))
+        self.rows = -(-count // self.columns)
+        self.padding = padding
+
+        colors = [np.array([background], dtype=np.uint8)]
+        self._offsets = {}
+        offset = 1
+        for palette in palettes:
+            palette = np.asarray(palette, dtype=np.uint8)
+            key = palette.tobytes()
+            if key not in self._offsets:
+                self._offsets[key] = offset
+                colors.append(palette)
+                offset += len(palette)
+        self.palette = np.concatenate(colors)
+
+        self.pixels = np.zeros((self.rows * (tile_height + padding) + padding,
+                                self.columns * (tile_width + padding) + padding), dtype=np.uint8)
+
+    def slot(self, i):
+        """View of slot i (row-major)."""
+        if i < 0 or i >= self.count:
+            raise IndexError("Slot %d out of range [0, %d)" % (i, self.count))
+        row, col = divmod(i, self.columns)
+        y = self.padding + row * (self.tile_height + self.padding)
+        x = self.padding + col * (self.tile_width + self.padding)
+        return self.pixels[y:y + self.tile_height, x:x + self.tile_width]
+
+    def place(self, i, indices, palette):
+        """Write an index frame (into one of the atlas's source palettes) to slot i."""
+        offset = self._offsets[np.asarray(palette, dtype=np.uint8).tobytes()]
+        h, w = indices.shape
+        if h > self.tile_height or w > self.tile_width:
+            raise ValueError("%dx%d image does not fit a %dx%d slot" % (w, h, self.tile_width, self.tile_height))
+        y = (self.tile_height - h) // 2
+        x = (self.tile_width - w) // 2
+        np.add(indices, np.uint8(offset), out=self.slot(i)[y:y + h, x:x + w])
+
+    def to_rgb(self):
+        """The whole atlas as an RGB (height, width, 3) uint8 array."""
+        return self.palette[self.pixels]
+
+    def save_png(self, path, compress_level=6):
+        """Write the atlas as an indexed PNG; see write_png."""
+        write_png(path, self.pixels, self.palette, compress_level)
+
+
+def frame_sheet(parser, frames=None, columns=8, scale=1, padding=0,
+                background=DEFAULT_BACKGROUND, skip_hidden=None):
+    """Lay out frames of one note (default: all of them) on a grid."""
+    scale = check_scale(scale)
+    frames = list(range(parser.frame_count) if frames is None else frames)
+    if not frames:
+        raise ValueError("No frames selected")
+
+    palette = parser.indexed_palette
+    atlas = None
+    for i, index in enumerate(frames):
+        indices = upscale_indices(parser.decode_frame_indexed(index, skip_hidden), scale)
+        if atlas is None:
+            height, width = indices.shape
+            atlas = Atlas(len(frames), width, height, columns, [palette], background, padding)
+        atlas.place(i, indices, palette)
+    return atlas
+
+
+def _sniff(path):
+    with open(path, "rb") as f:
+        fmt = formats.detect_format(f.read(4))
+    if fmt is None:
+        raise ValueError("Not a PPM or KWZ file: %r" % (path,))
+    return fmt
+
+
+def _contact_image(fmt, parser, frame, skip_hidden):
+    """(indices, palette) for one note's contact-sheet slot."""
+    if frame is not None:
+        return parser.decode_frame_indexed(frame, skip_hidden), parser.indexed_palette
+    if fmt == "ppm":
+        return parser.get_thumbnail_pixels(), ppm.THUMBNAIL_PALETTE_ARRAY
+    start = KWZ_THUMBNAIL_STEP // 2
+    indices = parser.decode_frame_indexed(parser.thumbnail_index, skip_hidden)
+    return indices[start::KWZ_THUMBNAIL_STEP, start::KWZ_THUMBNAIL_STEP], kwz.PALETTE_ARRAY
+
+
+def contact_sheet(paths, columns=8, frame=None, workers=1, padding=0,
+                  background=DEFAULT_BACKGROUND, skip_hidden=None):
+    """Lay out one image per note file on a grid.
+
+    With frame=None each slot shows the note's thumbnail (64x48); otherwise
+    it shows that frame index. workers > 1 opens and decodes files on a
+    thread pool, each filling its own slot of the shared atlas.
+    """
+    paths = list(paths)
+    fmts = [_sniff(path) for path in paths]
+
+    if frame is None:
+        palettes = {"ppm": ppm.THUMBNAIL_PALETTE_ARRAY, "kwz": kwz.PALETTE_ARRAY}
+        width, height = ppm.PPM_THUMBNAIL_WIDTH, ppm.PPM_THUMBNAIL_HEIGHT
+    else:
+        palettes = {"ppm": ppm.FRAME_PALETTE_ARRAY, "kwz": kwz.PALETTE_ARRAY}
+        sizes = {"ppm": (ppm.PPM_FRAME_WIDTH, ppm.PPM_FRAME_HEIGHT),
+                 "kwz": (kwz.KWZ_FRAME_WIDTH, kwz.KWZ_FRAME_HEIGHT)}
+        width = max(sizes[fmt][0] for fmt in fmts)
+        height = max(sizes[fmt][1] for fmt in fmts)
+
+    used = [fmt for fmt in ("ppm", "kwz") if fmt in fmts]
+    atlas = Atlas(len(paths), width, height, columns, [palettes[fmt] for fmt in used], background, padding)
+
+    def fill(i):
+        parser = formats.parser_class(fmts[i]).open(paths[i])
+        try:
+            indices, palette = _contact_image(fmts[i], parser, frame, skip_hidden)
+            atlas.place(i, indices, palette)
+        finally:
+            parser.unload()
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flipnote-atlas") as pool:
+            list(pool.map(fill, range(len(paths))))
+    else:
+        for i in range(len(paths)):
+            fill(i)
+    return atlas
@@ -0,0 +1,394 @@
+"""
+Decoded-frame caches.
+
+FrameCache is an in-process LRU cache bounded by a byte budget. Attach one to
+a parser (``parser.frame_cache = FrameCache()``) or share a single instance
+between many parsers; entries are keyed by (note digest, frame index, mode),
+so identical notes opened twice share their frames.
+
+Frames are stored compactly: palette-indexed frames with at most 2, 4 or 16
+distinct values are bit-packed to 1, 2 or 4 bits per pixel, and RGB frames
+with few colours are stored as a small palette plus packed indices.
+
+DiskFrameCache persists every indexed frame of a note as one memory-mappable
+.npy file named after the note's animation digest, so later runs (or other
+processes) skip decoding entirely.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 1024 * 1024 * 1024
+DISK_FORMAT_VERSION = 1
+# Age after which prune deletes a temporary file left by an interrupted write
+DISK_TMP_MAX_AGE = 60 * 60
+
+
+# -- Compact storage ----------------------------------------------------------
+
+
+def _pack_bits(values, bits):
+    """Pack uint8 values < 2**bits into bytes, 8 // bits values per byte."""
+    per_byte = 8 // bits
+    flat = values.reshape(-1)
+    pad = (-flat.size) % per_byte
+    if pad:
+        flat = np.concatenate([flat, np.zeros(pad, dtype=np.uint8)])
+    groups = flat.reshape(-1, per_byte)
+    packed = np.zeros(groups.shape[0], dtype=np.uint8)
+    for k in range(per_byte):
+        packed |= groups[:, k] << (k * bits)
+    return packed
+
+
+def _unpack_bits(packed, bits, count):
+    per_byte = 8 // bits
+    mask = (1 << bits) - 1
+    values = np.empty((packed.size, per_byte), dtype=np.uint8)
+    for k in range(per_byte):
+        values[:, k] = (packed >> (k * bits)) & mask
+    return values.reshape(-1)[:count]
+
+
+def _bits_for(max_value):
+    for bits in (1, 2, 4):
+        if max_value < (1 << bits):
+            return bits
+    return None
+
+
+def _pack(array):
+    """Return a compact (kind, payload, shape, palette) tuple for an array."""
+    if array.dtype == np.uint8 and array.ndim == 3 and array.shape[2] == 3:
+        keys = (array[..., 0].astype(np.uint32) << 16) | (array[..., 1].astype(np.uint32) << 8) | array[..., 2]
+        palette, inverse = np.unique(keys, return_inverse=True)
+        bits = _bits_for(len(palette) - 1)
+        if bits is not None:
+            return "rgb", _pack_bits(inverse.astype(np.uint8), bits), array.shape, (palette, bits)
+    elif array.dtype == np.uint8 and array.size:
+        bits = _bits_for(int(array.max()))
+        if bits is not None:
+            return "indexed", _pack_bits(array, bits), array.shape, bits
+    return "raw", array.copy(), array.shape, None
+
+
+def _unpack(entry):
+    kind, payload, shape, extra = entry
+    count = int(np.prod(shape))
+    if kind == "rgb":
+        palette, bits = extra
+        count //= 3
+        keys = palette[_unpack_bits(payload, bits, count)]
+        rgb = np.empty((count, 3), dtype=np.uint8)
+        rgb[:, 0] = keys >> 16
+        rgb[:, 1] = keys >> 8
+        rgb[:, 2] = keys
+        return rgb.reshape(shape)
+    if kind == "indexed":
+        return _unpack_bits(payload, extra, count).reshape(shape)
+    return payload.copy()
+
+
+def _entry_size(entry):
+    kind, payload, _shape, extra = entry
+    size = payload.nbytes
+    if kind == "rgb":
+        size += extra[0].nbytes
+    return size
+
+
+# -- In-memory LRU ------------------------------------------------------------
+
+
+class FrameCache:
+    """Thread-safe LRU cache of decoded frames with a byte budget."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, compact=True):
+        self.max_bytes = max_bytes
+        self.compact = compact
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return a copy of the cached array for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return _unpack(entry)
+
+    def put(self, key, array):
+        """Store an array, evicting least recently used entries to fit."""
+        if self.compact:
+            entry = _pack(array)
+        else:
+            entry = ("raw", array.copy(), array.shape, None)
+        size = _entry_size(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= _entry_size(old)
+            self._entries[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _key, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= _entry_size(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry (statistics are kept)."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Hit/miss/eviction counters and current usage as a dict."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+# -- On-disk store ------------------------------------------------------------
+
+
+def _crc32(array):
+    return zlib.crc32(memoryview(np.ascontiguousarray(array)).cast("B")) & 0xFFFFFFFF
+
+
+class DiskFrameCache:
+    """Persistent per-note cache of indexed frames in a directory.
+
+    Each note is stored as ``<digest>.<mode>.npy`` holding a (frame_count,
+    height, width) uint8 array of palette indices, with a JSON sidecar that
+    records its shape and CRC32. Writes go to a temporary file that is then
+    renamed into place, so readers never see a partial entry. Entries are
+    loaded with ``np.load(mmap_mode="r")``; a damaged entry is deleted and
+    treated as a miss. The directory is kept under max_bytes by removing the
+    least recently used entries (by modification time, refreshed on every hit);
+    temporary files left by interrupted writes are removed once they are
+    DISK_TMP_MAX_AGE seconds old.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_DISK_MAX_BYTES, verify=True):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.corrupt = 0
+        self._open = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _paths(self, digest, mode):
+        base = os.path.join(self.directory, "%s.%s" % (digest, mode))
+        return base + ".npy", base + ".json"
+
+    def _discard(self, digest, mode):
+        self._open.pop((digest, mode), None)
+        for path in self._paths(digest, mode):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get_frames(self, parser, mode="indexed"):
+        """Return the note's cached frames as a read-only memmap, or None."""
+        digest = parser.animation_digest
+        data_path, meta_path = self._paths(digest, mode)
+        with self._lock:
+            frames = self._open.get((digest, mode))
+        if frames is not None:
+            try:
+                os.utime(data_path)
+            except OSError:
+                # Removed by another process: reload (and miss) below
+                with self._lock:
+                    self._open.pop((digest, mode), None)
+            else:
+                with self._lock:
+                    self.hits += 1
+                return frames
+
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if not isinstance(meta, dict):
+                raise ValueError("Sidecar is not a JSON object")
+            frames = np.load(data_path, mmap_mode="r", allow_pickle=False)
+            os.utime(data_path)
+        except (OSError, ValueError):
+            if os.path.exists(data_path) or os.path.exists(meta_path):
+                self.corrupt += 1
+                self._discard(digest, mode)
+            self.misses += 1
+            return None
+
+        valid = (meta.get("version") == DISK_FORMAT_VERSION
+                 and frames.dtype == np.uint8
+                 and list(frames.shape) == meta.get("shape")
+                 and frames.shape[0] == parser.frame_count)
+        if valid and self.verify:
+            valid = _crc32(frames) == meta.get("crc32")
+        if not valid:
+            del frames
+            self.corrupt += 1
+            self.misses += 1
+            self._discard(digest, mode)
+            return None
+
+        with self._lock:
+            self._open[(digest, mode)] = frames
+            self.hits += 1
+        return frames
+
+    def put_frames(self, parser, frames, mode="indexed"):
+        """Atomically store a (frame_count, H, W) uint8 array for a note."""
+        frames = np.ascontiguousarray(frames, dtype=np.uint8)
+        digest = parser.animation_digest
+        data_path, meta_path = self._paths(digest, mode)
+        meta = {
+            "version": DISK_FORMAT_VERSION,
+            "shape": list(frames.shape),
+            "crc32": _crc32(frames),
+        }
+
+        tmp_data = tmp_meta = None
+        try:
+            fd, tmp_data = tempfile.mkstemp(dir=self.directory, suffix=".npy.tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, frames, allow_pickle=False)
+            fd, tmp_meta = tempfile.mkstemp(dir=self.directory, suffix=".json.tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(meta, f)
+            # Data first: an entry only counts once its sidecar exists
+            os.replace(tmp_data, data_path)
+            os.replace(tmp_meta, meta_path)
+        except BaseException:
+            for path in (tmp_data, tmp_meta):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            raise
+
+        with self._lock:
+            self._open.pop((digest, mode), None)
+        self.prune()
+
+    def frames(self, parser, skip_hidden=None):
+        """Return every indexed frame of a note, decoding and storing on a miss.
+
+        skip_hidden is as in decode_frame; frames with hidden layers skipped
+        are stored apart from frames with every layer drawn.
+        """
+        if skip_hidden is None:
+            skip_hidden = not parser.uses_native
+        mode = "indexed" if skip_hidden else "indexed-all"
+        frames = self.get_frames(parser, mode)
+        if frames is None:
+            count = parser.frame_count
+            first = parser.decode_frame_indexed(0, skip_hidden)
+            decoded = np.empty((count,) + first.shape, dtype=np.uint8)
+            decoded[0] = first
+            for index in range(1, count):
+                decoded[index] = parser.decode_frame_indexed(index, skip_hidden)
+            self.put_frames(parser, decoded, mode)
+            frames = self.get_frames(parser, mode)
+            if frames is None:
+                frames = decoded
+        return frames
+
+    def decode_frame(self, parser, index, skip_hidden=None):
+        """Return frame index of a note as RGB, served from the disk cache."""
+        return parser.indexed_palette[self.frames(parser, skip_hidden)[index]]
+
+    def prune(self):
+        """Delete least recently used entries until the directory fits max_bytes,
+        and stale temporary files."""
+        entries = []
+        total = 0
+        stale = time.time() - DISK_TMP_MAX_AGE
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                try:
+                    if os.stat(path).st_mtime < stale:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if not name.endswith(".npy"):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        for _mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            digest, mode = name[:-len(".npy")].rsplit(".", 1)
+            with self._lock:
+                self._discard(digest, mode)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        """Remove every entry from the directory."""
+        for name in os.listdir(self.directory):
+            if name.endswith((".npy", ".json")):
+                os.remove(os.path.join(self.directory, name))
+        with self._lock:
+            self._open.clear()
+
+    def stats(self):
+        """Hit/miss/eviction/corruption counters and current disk usage."""
+        size = 0
+        count = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                count += 1
+                size += os.path.getsize(os.path.join(self.directory, name))
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "corrupt": self.corrupt,
+            "entries": count,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,310 @@
+"""
+SQLite catalogue of note metadata for large collections.
+
+Scans a directory tree or a tar/zip archive (see flipnote.archive), parses
+every PPM/KWZ note once and stores formats.note_metadata records in an
+indexed table, so questions like "all notes by this FSID" don't need the
+files re-parsed:
+
+    from flipnote.catalog import Catalog
+
+    with Catalog("notes.sqlite") as catalog:
+        catalog.scan("/srv/flipnotes")          # incremental on later runs
+        catalog.scan("/srv/archive-2013.tar")
+        for note in catalog.by_author("59A643D0A30FD688"):
+            print(note["path"], note["current_filename"])
+
+Rescans only parse files whose size or mtime changed and drop rows for
+files that are gone. Rows are written in batches inside transactions, with
+the database in WAL mode so readers aren't blocked by a running scan.
+"""
+
+import json
+import os
+import sqlite3
+
+from flipnote import archive
+from flipnote import formats
+from flipnote.schema import convertKWZFSIDToPPM, verifyPPMFilename
+
+# Rows written per transaction during a scan
+BATCH_SIZE = 500
+
+_COLUMNS = (
+    "source", "path", "size", "mtime", "format",
+    "current_author_name", "parent_author_name", "root_author_name",
+    "current_author_id", "parent_author_id", "root_author_id",
+    "current_author_fsid", "parent_author_fsid", "root_author_fsid",
+    "current_filename", "parent_filename", "root_filename",
+    "timestamp", "creation_timestamp", "frame_count", "framerate", "lock",
+    "track_sizes", "track_digests",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    format TEXT NOT NULL,
+    current_author_name TEXT,
+    parent_author_name TEXT,
+    root_author_name TEXT,
+    current_author_id TEXT,
+    parent_author_id TEXT,
+    root_author_id TEXT,
+    current_author_fsid TEXT,
+    parent_author_fsid TEXT,
+    root_author_fsid TEXT,
+    current_filename TEXT,
+    parent_filename TEXT,
+    root_filename TEXT,
+    timestamp INTEGER,
+    creation_timestamp INTEGER,
+    frame_count INTEGER,
+    framerate REAL,
+    lock INTEGER,
+    track_sizes TEXT,
+    track_digests TEXT,
+    UNIQUE (source, path)
+);
+CREATE INDEX IF NOT EXISTS notes_current_author_fsid ON notes (current_author_fsid);
+CREATE INDEX IF NOT EXISTS notes_parent_author_fsid ON notes (parent_author_fsid);
+CREATE INDEX IF NOT EXISTS notes_root_author_fsid ON notes (root_author_fsid);
+CREATE INDEX IF NOT EXISTS notes_current_filename ON notes (current_filename);
+CREATE INDEX IF NOT EXISTS notes_parent_filename ON notes (parent_filename);
+CREATE INDEX IF NOT EXISTS notes_root_filename ON notes (root_filename);
+CREATE INDEX IF NOT EXISTS notes_timestamp ON notes (timestamp);
+CREATE TABLE IF NOT EXISTS skipped (
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (source, path)
+);
+"""
+
+_INSERT = "INSERT OR REPLACE INTO notes (%s) VALUES (%s)" % (", ".join(_COLUMNS), ", ".join("?" * len(_COLUMNS)))
+
+
+def normalize_fsid(fsid):
+    """An FSID in PPM form (16 uppercase hex digits), whichever format it came from.
+
+    KWZ FSIDs are converted with schema.convertKWZFSIDToPPM; anything else is
+    returned uppercased.
+    """
+    return convertKWZFSIDToPPM(fsid) if fsid else fsid
+
+
+def ppm_root_fragment(filename):
+    """The root filename fragment a PPM stores for a note descended from filename.
+
+    PPMs only keep the MAC part and the first 5 characters (as hex) of
+    their root's filename, e.g. "F3A1B2_0123456789ABC_000" -> "F3A1B2_3031323334".
+    Returns None if filename isn't a PPM filename.
+    """
+    if not verifyPPMFilename(filename):
+        return None
+    return "%s_%s" % (filename[:6], filename[7:12].encode("ascii").hex().upper())
+
+
+def _row(source, path, size, mtime, record):
+    return (
+        source, path, size, mtime, record["format"],
+        record["current_author_name"], record["parent_author_name"], record["root_author_name"],
+        record["current_author_id"], record["parent_author_id"], record["root_author_id"],
+        normalize_fsid(record["current_author_id"]), normalize_fsid(record["parent_author_id"]),
+        normalize_fsid(record["root_author_id"]),
+        record["current_filename"], record["parent_filename"], record["root_filename"],
+        record["timestamp"], record["creation_timestamp"], record["frame_count"],
+        record["framerate"], record["lock"],
+        json.dumps(record["track_sizes"]), json.dumps(record["track_digests"]),
+    )
+
+
+def _parse(data):
+    """note_metadata of an in-memory note, or None if it doesn't parse."""
+    try:
+        parser = formats.load_note(data)
+    except archive.PARSE_ERRORS:
+        return None
+    try:
+        return formats.note_metadata(parser)
+    finally:
+        parser.unload()
+
+
+class Catalog:
+    """An SQLite note catalogue at path (created if missing)."""
+
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._db = sqlite3.connect(path)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # -- Scanning -------------------------------------------------------------
+
+    def scan(self, source):
+        """Add or refresh every note in a directory tree or tar/zip archive.
+
+        Files whose size and mtime match the catalogue are not read again;
+        new and changed notes are parsed and written in batches of
+        batch_size, and rows for files no longer present are deleted. Files
+        that aren't notes, or don't parse, are skipped; they are remembered
+        (so they aren't read again until they change) and a note that
+        changes into one loses its row.
+
+        Returns a dict of counts: added, updated, unchanged, removed, skipped.
+        """
+        source = os.path.abspath(source)
+        known = {row["path"]: (row["size"], row["mtime"]) for row in
+                 self._db.execute("SELECT path, size, mtime FROM notes WHERE source = ?", (source,))}
+        known_skipped = {row["path"]: (row["size"], row["mtime"]) for row in
+                         self._db.execute("SELECT path, size, mtime FROM skipped WHERE source = ?", (source,))}
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "skipped": 0}
+        seen = set()
+        rejected = []
+        recovered = []
+
+        def changed(path, size, mtime):
+            seen.add(path)
+            if known.get(path) == (size, mtime):
+                stats["unchanged"] += 1
+                return False
+            if known_skipped.get(path) == (size, mtime):
+                stats["skipped"] += 1
+                return False
+            return True
+
+        def reject(path, size, mtime):
+            stats["skipped"] += 1
+            rejected.append((source, path, size, mtime))
+
+        if os.path.isdir(source):
+            members = self._directory_members(source, changed, reject)
+        else:
+            members = archive.iter_members(source, select=changed)
+
+        batch = []
+        for member in members:
+            record = _parse(member.data)
+            if record is None:
+                reject(member.name, member.size, member.mtime)
+                continue
+            if member.name in known_skipped:
+                recovered.append((source, member.name))
+            stats["updated" if member.name in known else "added"] += 1
+            batch.append(_row(source, member.name, member.size, member.mtime, record))
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        self._write(batch)
+
+        gone = [(source, path) for path in known if path not in seen]
+        gone_skipped = [(source, path) for path in known_skipped if path not in seen]
+        with self._db:
+            self._db.executemany("DELETE FROM notes WHERE source = ? AND path = ?", gone)
+            self._db.executemany("DELETE FROM notes WHERE source = ? AND path = ?",
+                                 [(source, path) for _source, path, _size, _mtime in rejected])
+            self._db.executemany("DELETE FROM skipped WHERE source = ? AND path = ?", gone_skipped + recovered)
+            self._db.executemany("INSERT OR REPLACE INTO skipped (source, path, size, mtime) VALUES (?, ?, ?, ?)",
+                                 rejected)
+        stats["removed"] = len(gone)
+        return stats
+
+    def _directory_members(self, directory, select, reject):
+        """Yield an archive.Member, named by relative path, for each note file
+        under directory; reject(path, size, mtime) is called for other files."""
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue
+                if st.st_size > archive.MAX_MEMBER_SIZE:
+                    continue
+                path = os.path.relpath(full, directory)
+                if not select(path, st.st_size, st.st_mtime):
+                    continue
+                with open(full, "rb") as f:
+                    head = f.read(4)
+                    fmt = formats.detect_format(head)
+                    if fmt is None:
+                        reject(path, st.st_size, st.st_mtime)
+                        continue
+                    yield archive.Member(path, fmt, st.st_size, st.st_mtime, head + f.read())
+
+    def _write(self, rows):
+        if rows:
+            with self._db:
+                self._db.executemany(_INSERT, rows)
+
+    def remove_source(self, source):
+        """Delete every row scanned from source; returns the number removed."""
+        source = os.path.abspath(source)
+        with self._db:
+            self._db.execute("DELETE FROM skipped WHERE source = ?", (source,))
+            return self._db.execute("DELETE FROM notes WHERE source = ?", (source,)).rowcount
+
+    # -- Queries --------------------------------------------------------------
+
+    def _select(self, where, params):
+        rows = self._db.execute("SELECT * FROM notes WHERE %s ORDER BY timestamp, id" % where, params)
+        return [_record(row) for row in rows]
+
+    def by_author(self, fsid, role="current"):
+        """Notes whose current (or "parent" / "root") author has this FSID, in
+        either PPM or KWZ form."""
+        if role not in ("current", "parent", "root"):
+            raise ValueError("role must be 'current', 'parent' or 'root', got %r" % (role,))
+        return self._select("%s_author_fsid = ?" % role, (normalize_fsid(fsid),))
+
+    def by_filename(self, filename):
+        """Notes whose current filename is filename."""
+        return self._select("current_filename = ?", (filename,))
+
+    def descendants(self, root_filename):
+        """Notes whose root is root_filename (including the root itself).
+
+        For a PPM filename this also matches the truncated root fragment
+        that PPMs store (see ppm_root_fragment).
+        """
+        fragment = ppm_root_fragment(root_filename)
+        if fragment is None:
+            return self._select("root_filename = ? OR current_filename = ?", (root_filename, root_filename))
+        return self._select("root_filename IN (?, ?) OR current_filename = ?",
+                            (root_filename, fragment, root_filename))
+
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for row in self._db.execute("SELECT * FROM notes ORDER BY id"):
+            yield _record(row)
+
+
+def _record(row):
+    record = dict(row)
+    record["track_sizes"] = json.loads(record["track_sizes"])
+    record["track_digests"] = json.loads(record["track_digests"])
+    return record
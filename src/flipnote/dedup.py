@@ -0,0 +1,287 @@
+"""
+Content-addressed deduplication of notes and frames.
+
+Fingerprints are taken from the compressed data, so finding duplicates
+doesn't decode anything:
+
+    parser.animation_digest        the whole animation (PPM animation
+                                   section, KWZ KMI entries + KMC)
+    parser.frame_digests           each frame's encoded bytes
+    parser.get_keyframe_digests()  decoded layers of keyframes (optional;
+                                   decodes, but also matches re-encoded copies)
+
+DuplicateIndex groups many notes by these. NoteStore keeps whole notes in
+an SQLite file, split into chunks at frame boundaries and stored by digest,
+so re-uploads and edited copies share the frames they have in common:
+
+    from flipnote import archive, dedup
+
+    index = dedup.DuplicateIndex()
+    for name, fingerprint in archive.map_notes("notes.tar", func=dedup.fingerprint):
+        index.add_fingerprint(name, fingerprint)
+    index.duplicate_notes()     # [[name, name, ...], ...]
+    index.related(name)         # [(other name, shared frames), ...]
+
+    with dedup.NoteStore("notes.sqlite") as store:
+        key = store.add(open("note.kwz", "rb").read())
+        data = store.get(key)
+"""
+
+import sqlite3
+from collections import Counter, defaultdict
+from hashlib import blake2b
+
+from flipnote import archive
+from flipnote import formats
+from flipnote import kwz
+from flipnote import ppm
+
+_DIGEST_SIZE = 16
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    digest BLOB PRIMARY KEY,
+    data BLOB NOT NULL,
+    refs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notes (
+    key TEXT PRIMARY KEY,
+    format TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunks BLOB NOT NULL
+);
+"""
+
+
+def fingerprint(parser, keyframes=False):
+    """Fingerprints of a parsed note as a dict: format, note
+    (animation_digest), frames (frame_digests) and, with keyframes,
+    keyframes (get_keyframe_digests, which decodes).
+
+    A module-level function, so it can be passed to archive.map_notes
+    (use functools.partial for keyframes).
+    """
+    result = {
+        "format": "ppm" if isinstance(parser, ppm.Parser) else "kwz",
+        "note": parser.animation_digest,
+        "frames": parser.frame_digests,
+    }
+    if keyframes:
+        result["keyframes"] = parser.get_keyframe_digests()
+    return result
+
+
+class DuplicateIndex:
+    """Index of note and frame fingerprints for duplicate lookups.
+
+    Notes are added under a unique name (a path, archive member or
+    catalogue key) with add or add_fingerprint. With keyframes, add also
+    records decoded keyframe digests.
+    """
+
+    def __init__(self, keyframes=False):
+        self.keyframes = keyframes
+        self.notes = {}  # name -> fingerprint dict
+        self._by_note = defaultdict(list)
+        self._by_frame = defaultdict(list)
+        self._by_keyframe = defaultdict(list)
+
+    def __len__(self):
+        return len(self.notes)
+
+    def __contains__(self, name):
+        return name in self.notes
+
+    def add(self, name, parser):
+        """Fingerprint a parsed note and add it."""
+        self.add_fingerprint(name, fingerprint(parser, self.keyframes))
+
+    def add_fingerprint(self, name, record):
+        """Add a note from a fingerprint dict (see fingerprint); raises
+        ValueError if name is already in the index."""
+        if name in self.notes:
+            raise ValueError("Note already in index: %r" % (name,))
+        self.notes[name] = record
+        self._by_note[record["note"]].append(name)
+        for index, digest in enumerate(record["frames"]):
+            self._by_frame[digest].append((name, index))
+        for index, digest in record.get("keyframes", {}).items():
+            self._by_keyframe[digest].append((name, index))
+
+    def duplicate_notes(self):
+        """Groups of names whose animation is identical, largest first."""
+        groups = [names for names in self._by_note.values() if len(names) > 1]
+        groups.sort(key=len, reverse=True)
+        return groups
+
+    def shared_frames(self, min_notes=2, keyframes=False):
+        """Frames found in at least min_notes different notes, as
+        {digest: [(name, frame index), ...]}.
+
+        With keyframes, matches decoded keyframes instead of encoded frames.
+        """
+        table = self._by_keyframe if keyframes else self._by_frame
+        return {digest: places for digest, places in table.items()
+                if len({name for name, _index in places}) >= min_notes}
+
+    def frames_like(self, digest, keyframes=False):
+        """(name, frame index) of every frame with this frame (or keyframe) digest."""
+        table = self._by_keyframe if keyframes else self._by_frame
+        return list(table.get(digest, ()))
+
+    def related(self, name, keyframes=False):
+        """Other notes sharing frames with name, as [(other name, number of
+        name's frames they share)], most shared first."""
+        record = self.notes[name]
+        if keyframes:
+            table, digests = self._by_keyframe, record.get("keyframes", {}).values()
+        else:
+            table, digests = self._by_frame, record["frames"]
+        counts = Counter()
+        for digest in set(digests):
+            counts.update({owner for owner, _index in table[digest] if owner != name})
+        return counts.most_common()
+
+
+def _digest(data):
+    return blake2b(data, digest_size=_DIGEST_SIZE).digest()
+
+
+def _boundaries(parser, size):
+    """Offsets where a note is split into chunks: its frames, the sections
+    around them and the signature."""
+    cuts = {0, size}
+    for start, end in parser.frame_spans:
+        cuts.add(start)
+        cuts.add(end)
+    if isinstance(parser, ppm.Parser):
+        cuts.add(ppm.PPM_ANIMATION_HEADER_OFFSET + 8)  # After the header, metadata, thumbnail and animation header
+        cuts.add(ppm.PPM_ANIMATION_HEADER_OFFSET + parser.animation_data_size)
+        cuts.add(size - ppm.PPM_SIGNATURE_SIZE)
+    else:
+        for section in parser.sections.values():
+            cuts.add(section["offset"])
+        cuts.add(size - kwz.KWZ_SIGNATURE_SIZE)
+    return sorted(cut for cut in cuts if 0 <= cut <= size)
+
+
+def split_note(data):
+    """Split an in-memory note into chunks at frame and section boundaries.
+
+    Returns (format, chunks); joining the chunks gives data back. Raises
+    ValueError for data that isn't a PPM or KWZ note.
+    """
+    data = bytes(data)
+    try:
+        parser = formats.load_note(data)
+    except ValueError:
+        raise
+    except archive.PARSE_ERRORS as e:
+        raise ValueError("Truncated or corrupt note: %s" % e) from e
+    try:
+        fmt = "ppm" if isinstance(parser, ppm.Parser) else "kwz"
+        cuts = _boundaries(parser, len(data))
+    finally:
+        parser.unload()
+    return fmt, [data[start:end] for start, end in zip(cuts, cuts[1:]) if end > start]
+
+
+class NoteStore:
+    """An SQLite store of notes at path (created if missing) that keeps
+    each distinct chunk (frame, section or signature) once.
+
+    Notes are keyed by the hex blake2b digest of the whole file. Chunks are
+    reference counted and deleted with the last note using them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, data):
+        """Store a note's bytes; returns its key. Adding a stored note again
+        does nothing."""
+        data = bytes(data)
+        key = blake2b(data, digest_size=_DIGEST_SIZE).hexdigest()
+        if key in self:
+            return key
+        fmt, chunks = split_note(data)
+        digests = [_digest(chunk) for chunk in chunks]
+        with self._db:
+            self._db.executemany("INSERT OR IGNORE INTO chunks (digest, data, refs) VALUES (?, ?, 0)",
+                                 zip(digests, chunks))
+            self._db.executemany("UPDATE chunks SET refs = refs + 1 WHERE digest = ?",
+                                 ((digest,) for digest in digests))
+            self._db.execute("INSERT INTO notes (key, format, size, chunks) VALUES (?, ?, ?, ?)",
+                             (key, fmt, len(data), b"".join(digests)))
+        return key
+
+    def add_file(self, path):
+        """Store the note at path; returns its key."""
+        with open(path, "rb") as f:
+            return self.add(f.read())
+
+    def _chunk_digests(self, key):
+        row = self._db.execute("SELECT chunks FROM notes WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        chunks = row[0]
+        return [chunks[i:i + _DIGEST_SIZE] for i in range(0, len(chunks), _DIGEST_SIZE)]
+
+    def get(self, key, verify=True):
+        """The bytes of the note stored as key; raises KeyError if there is
+        none, and ValueError if verify is set and they don't match the key."""
+        chunks = {}
+        parts = []
+        for digest in self._chunk_digests(key):
+            if digest not in chunks:
+                chunks[digest] = self._db.execute("SELECT data FROM chunks WHERE digest = ?",
+                                                  (digest,)).fetchone()[0]
+            parts.append(chunks[digest])
+        data = b"".join(parts)
+        if verify and blake2b(data, digest_size=_DIGEST_SIZE).hexdigest() != key:
+            raise ValueError("Stored note %s is corrupt" % key)
+        return data
+
+    def remove(self, key):
+        """Delete a note and any chunks no other note uses; returns whether it was stored."""
+        try:
+            digests = self._chunk_digests(key)
+        except KeyError:
+            return False
+        with self._db:
+            self._db.executemany("UPDATE chunks SET refs = refs - 1 WHERE digest = ?",
+                                 ((digest,) for digest in digests))
+            self._db.execute("DELETE FROM chunks WHERE refs <= 0")
+            self._db.execute("DELETE FROM notes WHERE key = ?", (key,))
+        return True
+
+    def __contains__(self, key):
+        return self._db.execute("SELECT 1 FROM notes WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self._db.execute("SELECT key FROM notes ORDER BY rowid")]
+
+    def stats(self):
+        """Note and chunk counts, the total size of the stored notes and the
+        bytes actually held for them."""
+        notes, note_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM notes").fetchone()
+        chunks, chunk_bytes = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM chunks").fetchone()
+        return {"notes": notes, "note_bytes": note_bytes, "chunks": chunks, "chunk_bytes": chunk_bytes}
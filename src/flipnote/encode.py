@@ -0,0 +1,778 @@
+"""
+PPM and KWZ encoders.
+
+PPMEncoder and KWZEncoder build notes frame by frame from layer arrays and
+write them as files that the parsers in this package decode back to exactly
+the same layers, colours and metadata. Each frame is compressed as it is
+added, choosing the cheapest PPM line encoding (0-3) per row or KWZ tile
+type (0-7) per 8x8 tile, so only the previous frame's layers are kept.
+Encoding options control the properties load tests care about: keyframe
+interval, translation, the allowed line encodings / tile types and track
+lengths.
+
+    from flipnote.encode import KWZEncoder
+
+    encoder = KWZEncoder(frame_speed=8, keyframe_interval=10)
+    for layers in frames:  # (3, 240, 320) arrays of 0-2
+        encoder.add_frame(layers, colors=((1, 2), (3, 4), (5, 6)))
+    encoder.set_track(0, samples=pcm)  # int16 at 16364 Hz
+    encoder.save("synthetic.kwz")
+
+Audio given as PCM is ADPCM-encoded against the same decoder state the
+parsers use, so decoding yields the encoder's reconstruction (ADPCM is lossy;
+pass adpcm= to store exact bytes).
+"""
+
+import re
+import struct
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+from flipnote import kwz
+from flipnote import ppm
+
+PPM_FORMAT_VERSION = 0x24
+PPM_TRACK_COUNT = 4
+
+KWZ_TRACK_COUNT = 5
+KWZ_THUMBNAIL_PLACEHOLDER = b"\xff\xd8\xff\xd9"  # empty JPEG
+
+# Every row can be written raw (PPM line encoding 3) and every tile as
+# per-row lines (KWZ tile type 4), so those are always allowed
+PPM_FALLBACK_LINE_ENCODING = 3
+KWZ_FALLBACK_TILE_TYPE = 4
+
+PPM_FILENAME_RE = re.compile(r"^([0-9A-F]{6})_([0-9A-F]{13})_([0-9]{3})$")
+PPM_FRAGMENT_RE = re.compile(r"^([0-9A-F]{6})_([0-9A-F]{10})$")
+KWZ_FILENAME_RE = re.compile(r"^[a-z0-5]{28}$")
+KWZ_PPM_FILENAME_RE = re.compile(r"^([0-9A-F]{6})_([ -~]{13})_([0-9]{3})$")
+
+
+def _utf16_name(name):
+    raw = name.encode("utf-16-le")
+    if len(raw) > 22:
+        raise ValueError("Author name %r is longer than 11 UTF-16 code units" % (name,))
+    return raw.ljust(22, b"\x00")
+
+
+def _timestamp(value, epoch):
+    """Seconds since epoch for a datetime or Unix timestamp."""
+    if isinstance(value, datetime):
+        value = value.timestamp()
+    return int(value) - epoch
+
+
+def _allowed(types, fallback, name, valid):
+    if types is None:
+        return frozenset(valid)
+    types = frozenset(types)
+    if not types <= frozenset(valid):
+        raise ValueError("Invalid %s: %r" % (name, sorted(types - frozenset(valid))))
+    return types | {fallback}
+
+
+def _check_layers(layers, shape, limit, name):
+    layers = np.asarray(layers)
+    if layers.shape != shape:
+        raise ValueError("%s layers must have shape %r, got %r" % (name, shape, layers.shape))
+    layers = layers.astype(np.uint8)
+    if layers.max(initial=0) > limit:
+        raise ValueError("%s layer values must be 0-%d" % (name, limit))
+    return layers
+
+
+def _output(path, data):
+    if hasattr(path, "write"):
+        path.write(data)
+    else:
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+# -- ADPCM --------------------------------------------------------------------
+
+
+def _ima_code(diff, step):
+    """4-bit IMA ADPCM code for a prediction error."""
+    code = 0
+    if diff < 0:
+        code = 8
+        diff = -diff
+    if diff >= step:
+        code |= 4
+        diff -= step
+    if diff >= step >> 1:
+        code |= 2
+        diff -= step >> 1
+    if diff >= step >> 2:
+        code |= 1
+    return code
+
+
+def _ima_delta(code, step):
+    """Predictor change for a 4-bit code, as the decoders compute it."""
+    diff = step >> 3
+    if code & 1:
+        diff += step >> 2
+    if code & 2:
+        diff += step >> 1
+    if code & 4:
+        diff += step
+    return -diff if code & 8 else diff
+
+
+def encode_ppm_adpcm(samples):
+    """Encode int16 PCM at 8192 Hz as a PPM audio track.
+
+    The track starts with the 4-byte header ppm._decode_adpcm reads (initial
+    predictor and step index) followed by two 4-bit samples per byte, low
+    nibble first. An odd sample count is padded with one extra sample.
+    """
+    samples = np.asarray(samples, dtype=np.int16)
+    if len(samples) == 0:
+        return b""
+    steps = ppm.ADPCM_STEP_TABLE.tolist()
+    index_table = ppm.ADPCM_INDEX_TABLE_4BIT.tolist()
+    predictor = int(samples[0])
+    step_index = 0
+    out = bytearray(struct.pack("<hBB", predictor, step_index, 0))
+    codes = []
+    for target in samples.tolist():
+        step = steps[step_index]
+        code = _ima_code(target - predictor, step)
+        predictor = min(32767, max(-32768, predictor + _ima_delta(code, step)))
+        step_index = min(88, max(0, step_index + index_table[code]))
+        codes.append(code)
+    if len(codes) % 2:
+        codes.append(codes[-1] & 8)
+    out += bytes(codes[i] | (codes[i + 1] << 4) for i in range(0, len(codes), 2))
+    return bytes(out)
+
+
+def encode_kwz_adpcm(samples):
+    """Encode int16 PCM at 16364 Hz as a KWZ variable-width ADPCM track.
+
+    Each code is 2 or 4 bits wide depending on the decoder state, exactly as
+    kwz._decode_audio_track reads them. The final byte is padded with codes
+    that hold the last level, so a track may decode to a few extra samples.
+    """
+    samples = np.asarray(samples, dtype=np.int16)
+    predictor = 0
+    step_index = 0
+    out = bytearray()
+    byte = 0
+    bit_pos = 0
+    targets = (samples.astype(np.int32) // kwz.KWZ_SCALING_FACTOR).tolist()
+    i = 0
+    while i < len(targets) or bit_pos:
+        target = targets[i] if i < len(targets) else predictor
+        step = kwz.ADPCM_STEP_TABLE[step_index]
+        if step_index < kwz.KWZ_VARIABLE_THRESHOLD or bit_pos > 4:
+            # 2-bit mode: magnitude step >> 3 or step >> 3 + step, bit 1 is the sign
+            diff = target - predictor
+            small = step >> 3
+            code = 1 if abs(abs(diff) - small - step) < abs(abs(diff) - small) else 0
+            if diff < 0:
+                code |= 2
+            delta = small + (step if code & 1 else 0)
+            predictor += -delta if code & 2 else delta
+            step_index += kwz.ADPCM_INDEX_TABLE_2BIT[code]
+            width = 2
+        else:
+            code = _ima_code(target - predictor, step)
+            predictor += _ima_delta(code, step)
+            step_index += kwz.ADPCM_INDEX_TABLE_4BIT[code]
+            width = 4
+        step_index = min(kwz.KWZ_STEP_INDEX_MAX, max(kwz.KWZ_STEP_INDEX_MIN, step_index))
+        predictor = min(kwz.KWZ_PREDICTOR_MAX, max(kwz.KWZ_PREDICTOR_MIN, predictor))
+
+        byte |= code << bit_pos
+        bit_pos += width
+        if bit_pos == 8:
+            out.append(byte)
+            byte = 0
+            bit_pos = 0
+        i += 1
+    return bytes(out)
+
+
+# -- PPM ----------------------------------------------------------------------
+
+
+PPM_DEFAULT_META = {
+    "lock": 0,
+    "thumb_index": 0,
+    "root_author_name": "",
+    "parent_author_name": "",
+    "current_author_name": "",
+    "root_author_id": "0000000000000000",
+    "parent_author_id": "0000000000000000",
+    "current_author_id": "0000000000000000",
+    "parent_filename": "000000_0000000000000_000",
+    "current_filename": "000000_0000000000000_000",
+    "root_filename_fragment": "000000_0000000000",
+    "timestamp": ppm.DSI_EPOCH,
+}
+
+
+def _ppm_fsid(fsid):
+    raw = bytes.fromhex(fsid)
+    if len(raw) != 8:
+        raise ValueError("PPM FSIDs are 16 hex digits, got %r" % (fsid,))
+    return raw[::-1]
+
+
+def _ppm_filename(name):
+    m = PPM_FILENAME_RE.match(name)
+    if m is None:
+        raise ValueError("Invalid PPM filename %r (expected MMMMMM_IIIIIIIIIIIII_EEE)" % (name,))
+    mac, ident, edits = m.groups()
+    return bytes.fromhex(mac) + ident.encode("ascii") + struct.pack("<H", int(edits))
+
+
+def _ppm_fragment(fragment):
+    m = PPM_FRAGMENT_RE.match(fragment)
+    if m is None:
+        raise ValueError("Invalid PPM root filename fragment %r" % (fragment,))
+    return bytes.fromhex(m.group(1) + m.group(2))
+
+
+def _ppm_thumbnail_bytes(indices):
+    """Inverse of ppm._thumbnail_indices for one (48, 64) index image."""
+    indices = np.asarray(indices, dtype=np.uint8)
+    if indices.shape != (ppm.PPM_THUMBNAIL_HEIGHT, ppm.PPM_THUMBNAIL_WIDTH) or indices.max(initial=0) > 15:
+        raise ValueError("A PPM thumbnail is a (48, 64) array of indices 0-15")
+    # (line, pixel) of the flipped image -> (tile_y, tile_x, line, pixel)
+    tiles = indices[::-1].reshape(ppm.PPM_THUMBNAIL_HEIGHT // 8, 8, ppm.PPM_THUMBNAIL_WIDTH // 8, 8)
+    pixels = tiles.transpose(0, 2, 1, 3).reshape(ppm.PPM_THUMBNAIL_SIZE, 2)
+    return (pixels[:, 0] | (pixels[:, 1] << 4)).tobytes()
+
+
+def _ppm_translated(layers, dx, dy):
+    """layers shifted by (dx, dy) with zeros shifted in, as the decoder XORs them."""
+    out = np.zeros_like(layers)
+    height, width = layers.shape[1:]
+    if abs(dx) < width and abs(dy) < height:
+        out[:, max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = \
+            layers[:, max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+    return out
+
+
+def _ppm_encode_layer(layer, allowed):
+    """(48 packed line encodings, line data) for one (192, 256) 0/1 layer."""
+    chunks = np.packbits(layer.reshape(ppm.PPM_FRAME_HEIGHT, 32, 8), axis=2, bitorder="little")[:, :, 0]
+    set_chunks = chunks != 0
+    unset_chunks = chunks != 0xFF
+    costs = np.stack([
+        np.where(set_chunks.any(axis=1), 1 << 30, 0),
+        4 + set_chunks.sum(axis=1),
+        4 + unset_chunks.sum(axis=1),
+        np.full(ppm.PPM_FRAME_HEIGHT, 32),
+    ])
+    for encoding in range(4):
+        if encoding not in allowed:
+            costs[encoding] = 1 << 30
+    encodings = costs.argmin(axis=0)
+
+    data = bytearray()
+    for y, encoding in enumerate(encodings.tolist()):
+        if encoding == 1 or encoding == 2:
+            used = set_chunks[y] if encoding == 1 else unset_chunks[y]
+            data += struct.pack(">I", int(np.packbits(used).view(">u4")[0]))
+            data += chunks[y][used].tobytes()
+        elif encoding == 3:
+            data += chunks[y].tobytes()
+    packed = (encodings.reshape(48, 4).astype(np.uint8) << ppm.LINE_ENCODING_SHIFTS).sum(axis=1, dtype=np.uint8)
+    return packed.tobytes(), bytes(data)
+
+
+class PPMEncoder:
+    """Build a .ppm note from (2, 192, 256) layer arrays of 0/1 pixels.
+
+    Args:
+        frame_speed: playback speed 1-8 (see ppm.FRAMERATES)
+        bgm_speed: speed the BGM was recorded at (default: frame_speed)
+        loop: loop playback
+        layer_visibility: (layer 1, layer 2) visible flags
+        keyframe_interval: make every n-th frame a keyframe (0: only the first)
+        line_encodings: line encodings (0-3) the encoder may use; 3 (raw)
+            is always allowed
+        meta: initial metadata, see set_meta
+    """
+
+    def __init__(self, frame_speed=6, bgm_speed=None, loop=True, layer_visibility=(True, True),
+                 keyframe_interval=0, line_encodings=None, **meta):
+        if not 1 <= frame_speed <= 8:
+            raise ValueError("PPM frame speed must be 1-8, got %r" % (frame_speed,))
+        self.frame_speed = frame_speed
+        self.bgm_speed = frame_speed if bgm_speed is None else bgm_speed
+        self.loop = loop
+        self.layer_visibility = tuple(layer_visibility)
+        self.keyframe_interval = keyframe_interval
+        self.line_encodings = _allowed(line_encodings, PPM_FALLBACK_LINE_ENCODING, "line encodings", range(4))
+        self.meta = dict(PPM_DEFAULT_META)
+        self.set_meta(**meta)
+        self.thumbnail = bytes(ppm.PPM_THUMBNAIL_SIZE)
+        self.tracks = [b""] * PPM_TRACK_COUNT
+
+        self._frames = []
+        self._sfx = bytearray()
+        self._previous = None
+
+    @property
+    def frame_count(self):
+        return len(self._frames)
+
+    def set_meta(self, **fields):
+        """Set metadata fields, named as the Parser attributes they decode to.
+
+        Names are strings, author IDs 16-digit FSIDs, filenames
+        "MMMMMM_IIIIIIIIIIIII_EEE", timestamp a datetime or Unix time.
+        """
+        for key, value in fields.items():
+            if key not in PPM_DEFAULT_META:
+                raise ValueError("Unknown PPM metadata field %r" % (key,))
+            self.meta[key] = value
+
+    def set_thumbnail(self, indices):
+        """Set the thumbnail from a (48, 64) array of THUMBNAIL_PALETTE indices."""
+        self.thumbnail = _ppm_thumbnail_bytes(indices)
+
+    def set_track(self, track, samples=None, adpcm=None):
+        """Set track 0-3 (BGM, SE1-SE3) from int16 PCM at 8192 Hz or raw ADPCM bytes."""
+        if not 0 <= track < PPM_TRACK_COUNT:
+            raise ValueError("Track must be 0-3, got %d" % track)
+        if (samples is None) == (adpcm is None):
+            raise ValueError("Pass exactly one of samples or adpcm")
+        self.tracks[track] = encode_ppm_adpcm(samples) if adpcm is None else bytes(adpcm)
+
+    def add_frame(self, layers, paper=1, colors=(1, 1), keyframe=None, translate=(0, 0), sfx=0):
+        """Compress and append a frame.
+
+        Args:
+            layers: (2, 192, 256) array of 0/1 pixels (layer 1, layer 2)
+            paper: paper colour, 0 (black) or 1 (white)
+            colors: pen colour of each layer: 1 (inverse of paper), 2 (red), 3 (blue)
+            keyframe: force (True) or suppress (False) a keyframe; None
+                follows keyframe_interval. The first frame is always one.
+            translate: (x, y) offset of the previous frame for a diff frame
+            sfx: per-frame sound effect flags byte
+        """
+        layers = _check_layers(layers, (2, ppm.PPM_FRAME_HEIGHT, ppm.PPM_FRAME_WIDTH), 1, "PPM")
+        index = len(self._frames)
+        if keyframe is None:
+            keyframe = self.keyframe_interval > 0 and index % self.keyframe_interval == 0
+        keyframe = keyframe or self._previous is None
+
+        header = (paper & 1) | ((colors[0] & 3) << 1) | ((colors[1] & 3) << 3)
+        blob = bytearray()
+        if keyframe:
+            header |= 0x80
+            residual = layers
+        else:
+            dx, dy = translate
+            if not (-128 <= dx <= 127 and -128 <= dy <= 127):
+                raise ValueError("Translation must fit in a signed byte, got %r" % (translate,))
+            if dx or dy:
+                header |= 0x20
+                blob += struct.pack("<bb", dx, dy)
+            residual = layers ^ _ppm_translated(self._previous, dx, dy)
+
+        encodings_1, data_1 = _ppm_encode_layer(residual[0], self.line_encodings)
+        encodings_2, data_2 = _ppm_encode_layer(residual[1], self.line_encodings)
+        self._frames.append(bytes((header,)) + bytes(blob) + encodings_1 + encodings_2 + data_1 + data_2)
+        self._sfx.append(sfx & 0xFF)
+        self._previous = layers
+
+    def add_encoded_frame(self, data, sfx=0):
+        """Append an already compressed frame (header byte, translation,
+        line encoding tables and line data) as-is.
+
+        The encoder doesn't decode it, so the next add_frame is a keyframe.
+        """
+        self._frames.append(bytes(data))
+        self._sfx.append(sfx & 0xFF)
+        self._previous = None
+
+    def tobytes(self):
+        """The complete .ppm file."""
+        count = len(self._frames)
+        if count == 0:
+            raise ValueError("A note needs at least one frame")
+        meta = self.meta
+
+        table = bytearray()
+        frame_data = bytearray()
+        for blob in self._frames:
+            table += struct.pack("<I", len(frame_data))
+            frame_data += blob
+        frame_data += bytes(-len(frame_data) % 4)
+        flags = (self.layer_visibility[0] << 11) | (self.layer_visibility[1] << 10) | (bool(self.loop) << 1)
+        animation = struct.pack("<HIH", len(table), 0, flags) + bytes(table) + bytes(-len(table) % 4) + frame_data
+
+        sound_size = sum(len(track) for track in self.tracks)
+        out = bytearray(b"PARA" + struct.pack("<IIHH", len(animation), sound_size, count - 1, PPM_FORMAT_VERSION))
+        out += struct.pack("<HH", meta["lock"], meta["thumb_index"])
+        for key in ("root_author_name", "parent_author_name", "current_author_name"):
+            out += _utf16_name(meta[key])
+        out += _ppm_fsid(meta["parent_author_id"]) + _ppm_fsid(meta["current_author_id"])
+        out += _ppm_filename(meta["parent_filename"]) + _ppm_filename(meta["current_filename"])
+        out += _ppm_fsid(meta["root_author_id"]) + _ppm_fragment(meta["root_filename_fragment"])
+        out += struct.pack("<IH", _timestamp(meta["timestamp"], ppm.DSI_EPOCH), 0)
+        out += self.thumbnail
+        out += animation
+        out += self._sfx
+        out += bytes(-len(out) % 4)
+
+        sizes = [len(track) for track in self.tracks]
+        out += struct.pack("<4IBB", *sizes, 8 - self.frame_speed, 8 - self.bgm_speed) + bytes(14)
+        out += b"".join(self.tracks)
+        out += bytes(ppm.PPM_SIGNATURE_SIZE)
+        return bytes(out)
+
+    def save(self, path):
+        """Write the note to a filename or binary file object."""
+        _output(path, self.tobytes())
+
+
+# -- KWZ ----------------------------------------------------------------------
+
+
+KWZ_DEFAULT_META = {
+    "lock": 0,
+    "thumb_index": 0,
+    "app_version": 0,
+    "creation_timestamp": kwz.DSI_EPOCH,
+    "modified_timestamp": kwz.DSI_EPOCH,
+    "root_username": "",
+    "parent_username": "",
+    "current_username": "",
+    "root_fsid": "00000000000000000000",
+    "parent_fsid": "00000000000000000000",
+    "current_fsid": "00000000000000000000",
+    "root_filename": "a" * 28,
+    "parent_filename": "a" * 28,
+    "current_filename": "a" * 28,
+}
+
+# Weights giving a line's LINE_TABLE index: p1*2187 + p0*729 + p3*243 + ...
+_KWZ_LINE_WEIGHTS = np.array([729, 2187, 81, 243, 9, 27, 1, 3], dtype=np.int32)
+
+# LINE_TABLE index of each LINE_TABLE_SHIFTED entry
+_KWZ_SHIFTED_INDEX = (kwz.LINE_TABLE_SHIFTED.astype(np.int32) @ _KWZ_LINE_WEIGHTS).tolist()
+_KWZ_COMMON = {index: i for i, index in enumerate(kwz.KWZ_COMMON_LINE_INDEX)}
+# (line a, line b) -> common index for tile type 2
+_KWZ_COMMON_PAIRS = {
+    (index, _KWZ_SHIFTED_INDEX[kwz.KWZ_LINE_INDEX_SHIFTED[i]]): i
+    for i, index in enumerate(kwz.KWZ_COMMON_LINE_INDEX)
+}
+_KWZ_TILE_7_PATTERNS = [tuple(pattern) for pattern in kwz.TILE_TYPE_7_PATTERNS]
+
+# Tile views of a (240, 320) layer in decode order
+_KWZ_TILE_ROWS = np.array([y for x, y in kwz.TILE_POSITIONS], dtype=np.intp)
+_KWZ_TILE_COLS = np.array([x for x, y in kwz.TILE_POSITIONS], dtype=np.intp)
+_KWZ_TILE_Y = _KWZ_TILE_ROWS[:, None, None] + np.arange(8)[None, :, None]
+_KWZ_TILE_X = _KWZ_TILE_COLS[:, None, None] + np.arange(8)[None, None, :]
+
+
+def _kwz_fsid(fsid):
+    raw = bytes.fromhex(fsid)
+    if len(raw) != kwz.KWZ_FSID_LENGTH:
+        raise ValueError("KWZ FSIDs are 20 hex digits, got %r" % (fsid,))
+    return raw
+
+
+def _kwz_filename(name):
+    if isinstance(name, (bytes, bytearray)):
+        if len(name) != kwz.KWZ_FILENAME_LENGTH:
+            raise ValueError("Raw KWZ filenames are 28 bytes")
+        return bytes(name)
+    if KWZ_FILENAME_RE.match(name):
+        return name.encode("ascii")
+    m = KWZ_PPM_FILENAME_RE.match(name)
+    if m is not None:
+        mac, ident, edits = m.groups()
+        raw = bytes.fromhex(mac) + ident.encode("ascii") + struct.pack("<H", int(edits))
+        return raw.ljust(kwz.KWZ_FILENAME_LENGTH, b"\x00")
+    raise ValueError("Invalid KWZ filename %r" % (name,))
+
+
+def _kwz_tile_tokens(lines):
+    """Encodings of one tile from its 8 line indices (LINE_TABLE rows).
+
+    Returns a dict mapping each tile type (0-4, 7) that can represent the
+    tile to (bits, tokens), tokens being the (value, width) fields that
+    follow the 3-bit tile type.
+    """
+    options = {}
+    common = [_KWZ_COMMON.get(line) for line in lines]
+    a, b = lines[0], lines[1]
+
+    if all(line == a for line in lines):
+        if common[0] is not None:
+            options[0] = (5, [(common[0], 5)])
+        options[1] = (13, [(a, 13)])
+
+    if lines[0::2] == (a,) * 4 and lines[1::2] == (b,) * 4:
+        pair = _KWZ_COMMON_PAIRS.get((a, b))
+        if pair is not None:
+            options[2] = (5, [(pair, 5)])
+        if _KWZ_SHIFTED_INDEX[a] == b:
+            options[3] = (13, [(a, 13)])
+
+    flags = 0
+    rows = []
+    for row, line in enumerate(lines):
+        if common[row] is not None:
+            flags |= 1 << row
+            rows.append((common[row], 5))
+        else:
+            rows.append((line, 13))
+    options[4] = (8 + sum(width for _, width in rows), [(flags, 8)] + rows)
+
+    distinct = set(lines)
+    if len(distinct) <= 2:
+        for pattern, rows in enumerate(_KWZ_TILE_7_PATTERNS):
+            line_a = [line for line, bit in zip(lines, rows) if not bit]
+            line_b = [line for line, bit in zip(lines, rows) if bit]
+            if len(set(line_a)) != 1 or len(set(line_b)) != 1:
+                continue
+            line_a, line_b = line_a[0], line_b[0]
+            if line_a in _KWZ_COMMON and line_b in _KWZ_COMMON:
+                # The decoder advances common patterns by one
+                candidate = (13, [((pattern - 1) % 4, 2), (1, 1), (_KWZ_COMMON[line_a], 5),
+                                  (_KWZ_COMMON[line_b], 5)])
+            else:
+                candidate = (29, [(pattern, 2), (0, 1), (line_a, 13), (line_b, 13)])
+            if 7 not in options or candidate[0] < options[7][0]:
+                options[7] = candidate
+    return options
+
+
+class _BitWriter:
+    """LSB-first bit writer producing the 16-bit words kwz._BitReader consumes."""
+
+    def __init__(self):
+        self._value = 0
+        self._count = 0
+        self._out = bytearray()
+
+    def write(self, value, num_bits):
+        self._value |= value << self._count
+        self._count += num_bits
+        while self._count >= 16:
+            self._out += struct.pack("<H", self._value & 0xFFFF)
+            self._value >>= 16
+            self._count -= 16
+
+    def getvalue(self):
+        if self._count:
+            return bytes(self._out) + struct.pack("<H", self._value & 0xFFFF)
+        return bytes(self._out)
+
+
+def _kwz_encode_layer(layer, previous, is_diff, allowed):
+    """Bitstream for one (240, 320) layer of 0-2 pixels."""
+    tiles = layer[_KWZ_TILE_Y, _KWZ_TILE_X]
+    unchanged = (tiles == previous[_KWZ_TILE_Y, _KWZ_TILE_X]).all(axis=(1, 2))
+    none = np.zeros(len(tiles), dtype=bool)
+    # Type 5 copies the previous frame's tile; type 6 keeps what the layer
+    # starts as (the previous frame for a diff layer, blank for a key layer)
+    same = unchanged if 5 in allowed else none
+    kept = (unchanged if is_diff else ~tiles.any(axis=(1, 2))) if 6 in allowed else none
+    if kept.all():
+        # An empty layer leaves every tile as it starts
+        return b""
+    lines = (tiles.astype(np.int32) @ _KWZ_LINE_WEIGHTS).tolist()
+    same = same.tolist()
+    kept = kept.tolist()
+
+    writer = _BitWriter()
+    write = writer.write
+    count = len(lines)
+    t = 0
+    while t < count:
+        if same[t]:
+            run = 1
+            while run < 32 and t + run < count and same[t + run]:
+                run += 1
+            # Short runs of tiles the no-op already keeps are cheaper as type 6
+            if run >= 3 or not all(kept[t:t + run]):
+                write(5, 3)
+                write(run - 1, 5)
+                t += run
+                continue
+        if kept[t]:
+            write(6, 3)
+            t += 1
+            continue
+
+        options = _kwz_tile_tokens(tuple(lines[t]))
+        tile_type = min((bits, tile_type) for tile_type, (bits, _) in options.items()
+                        if tile_type in allowed)[1]
+        write(tile_type, 3)
+        for value, width in options[tile_type][1]:
+            write(value, width)
+        t += 1
+    return writer.getvalue()
+
+
+def _kwz_section(magic, body, crc=True):
+    if crc:
+        body = struct.pack("<I", zlib.crc32(body) & 0xFFFFFFFF) + body
+    return magic + bytes((kwz.SECTION_MAGIC[magic],)) + struct.pack("<I", len(body)) + body
+
+
+class KWZEncoder:
+    """Build a .kwz note from (3, 240, 320) layer arrays of 0-2 pixels.
+
+    Args:
+        frame_speed: playback speed index 0-10 (see kwz.FRAMERATES)
+        bgm_speed: speed the BGM was recorded at (default: frame_speed)
+        loop: loop playback
+        layer_visibility: (A, B, C) visible flags
+        keyframe_interval: make every n-th frame a keyframe (0: only the first)
+        tile_types: tile types (0-7) the encoder may use; 4 (per-row lines)
+            is always allowed. Leaving out 5 and 6 writes every tile out.
+        meta: initial metadata, see set_meta
+    """
+
+    def __init__(self, frame_speed=8, bgm_speed=None, loop=True, layer_visibility=(True, True, True),
+                 keyframe_interval=0, tile_types=None, **meta):
+        if not 0 <= frame_speed < len(kwz.FRAMERATES):
+            raise ValueError("KWZ frame speed must be 0-%d, got %r" % (len(kwz.FRAMERATES) - 1, frame_speed))
+        self.frame_speed = frame_speed
+        self.bgm_speed = frame_speed if bgm_speed is None else bgm_speed
+        self.loop = loop
+        self.layer_visibility = tuple(layer_visibility)
+        self.keyframe_interval = keyframe_interval
+        self.tile_types = _allowed(tile_types, KWZ_FALLBACK_TILE_TYPE, "tile types", range(8))
+        self.meta = dict(KWZ_DEFAULT_META)
+        self.set_meta(**meta)
+        self.thumbnail = KWZ_THUMBNAIL_PLACEHOLDER
+        self.tracks = [b""] * KWZ_TRACK_COUNT
+
+        self._kmc = bytearray()
+        self._kmi = bytearray()
+        self._previous = np.zeros((3, kwz.KWZ_FRAME_HEIGHT, kwz.KWZ_FRAME_WIDTH), dtype=np.uint8)
+        self._frame_count = 0
+
+    @property
+    def frame_count(self):
+        return self._frame_count
+
+    def set_meta(self, **fields):
+        """Set metadata fields, named as the keys of Parser.meta they decode to.
+
+        Usernames are strings, FSIDs 20 hex digits, filenames 28-character
+        KWZ names (or PPM-style "MMMMMM_IIIIIIIIIIIII_EEE" names),
+        timestamps datetimes or Unix times.
+        """
+        for key, value in fields.items():
+            if key not in KWZ_DEFAULT_META:
+                raise ValueError("Unknown KWZ metadata field %r" % (key,))
+            self.meta[key] = value
+
+    def set_thumbnail(self, jpeg):
+        """Set the KTN thumbnail (JPEG bytes, stored as-is)."""
+        self.thumbnail = bytes(jpeg)
+
+    def set_track(self, track, samples=None, adpcm=None):
+        """Set track 0-4 (BGM, SE1-SE4) from int16 PCM at 16364 Hz or raw ADPCM bytes."""
+        if not 0 <= track < KWZ_TRACK_COUNT:
+            raise ValueError("Track must be 0-4, got %d" % track)
+        if (samples is None) == (adpcm is None):
+            raise ValueError("Pass exactly one of samples or adpcm")
+        self.tracks[track] = encode_kwz_adpcm(samples) if adpcm is None else bytes(adpcm)
+
+    def add_frame(self, layers, paper=0, colors=((1, 2), (1, 2), (1, 2)), keyframe=None, sfx=0,
+                  depths=(0, 0, 0), author_fsid=None, camera_flags=0):
+        """Compress and append a frame.
+
+        Args:
+            layers: (3, 240, 320) array of 0-2 pixels (layers A, B, C);
+                1 and 2 select the layer's two colours
+            paper: paper colour, a PALETTE index 0-6
+            colors: (colour 1, colour 2) PALETTE indices per layer; 7 or
+                more leaves that colour undrawn
+            keyframe: force (True) or suppress (False) a keyframe; None
+                follows keyframe_interval. The first frame is always one.
+            sfx, depths, author_fsid, camera_flags: stored in the frame's
+                KMI entry (author_fsid defaults to current_fsid)
+        """
+        layers = _check_layers(layers, (3, kwz.KWZ_FRAME_HEIGHT, kwz.KWZ_FRAME_WIDTH), 2, "KWZ")
+        index = self._frame_count
+        if keyframe is None:
+            keyframe = self.keyframe_interval > 0 and index % self.keyframe_interval == 0
+        keyframe = keyframe or index == 0
+        previous, allowed = self._previous, self.tile_types
+        if previous is None:
+            # After an encoded frame the decoder's layers are unknown: start
+            # from blank key layers and don't copy tiles (type 5)
+            keyframe = True
+            previous = np.zeros_like(layers)
+            allowed = allowed - {5}
+
+        flags = paper & 0x0F
+        for k, (color_1, color_2) in enumerate(colors):
+            flags |= (color_1 & 0x0F) << (8 + 8 * k)
+            flags |= (color_2 & 0x0F) << (12 + 8 * k)
+        if keyframe:
+            flags |= 0x70
+
+        data = [_kwz_encode_layer(layers[k], previous[k], not keyframe, allowed) for k in range(3)]
+        self._append(flags, data, sfx, depths, author_fsid, camera_flags)
+        self._previous = layers
+
+    def add_encoded_frame(self, flags, layers, sfx=0, depths=(0, 0, 0), author_fsid=None, camera_flags=0):
+        """Append an already compressed frame as-is: its KMI flags word and
+        the bitstreams of layers A, B and C. Other arguments are as in
+        add_frame.
+
+        The encoder doesn't decode it, so the next add_frame is a keyframe.
+        """
+        self._append(flags, [bytes(data) for data in layers], sfx, depths, author_fsid, camera_flags)
+        self._previous = None
+
+    def _append(self, flags, layers, sfx, depths, author_fsid, camera_flags):
+        for k, data in enumerate(layers):
+            if len(data) > 0xFFFF:
+                raise ValueError("Layer %d of frame %d compresses to %d bytes (max 65535)"
+                                 % (k, self._frame_count, len(data)))
+        self._kmc += b"".join(layers)
+        fsid = _kwz_fsid(self.meta["current_fsid"] if author_fsid is None else author_fsid)
+        self._kmi += struct.pack("<IHHH", flags, *(len(data) for data in layers)) + fsid
+        self._kmi += bytes(depths) + bytes((sfx & 0xFF,)) + struct.pack("<HH", 0, camera_flags)
+        self._frame_count += 1
+
+    def tobytes(self):
+        """The complete .kwz file."""
+        if self._frame_count == 0:
+            raise ValueError("A note needs at least one frame")
+        meta = self.meta
+
+        layer_flags = sum(1 << k for k, visible in enumerate(self.layer_visibility) if not visible)
+        flags = (meta["lock"] & 1) | (bool(self.loop) << 1)
+        kfh = struct.pack("<III", _timestamp(meta["creation_timestamp"], kwz.DSI_EPOCH),
+                          _timestamp(meta["modified_timestamp"], kwz.DSI_EPOCH), meta["app_version"])
+        kfh += b"".join(_kwz_fsid(meta[key]) for key in ("root_fsid", "parent_fsid", "current_fsid"))
+        kfh += b"".join(_utf16_name(meta[key]) for key in ("root_username", "parent_username", "current_username"))
+        kfh += b"".join(_kwz_filename(meta[key]) for key in ("root_filename", "parent_filename", "current_filename"))
+        kfh += struct.pack("<HHHBB", self._frame_count, meta["thumb_index"], flags, self.frame_speed, layer_flags)
+
+        out = _kwz_section(b"KFH", kfh)
+        out += _kwz_section(b"KTN", self.thumbnail)
+        out += _kwz_section(b"KMC", bytes(self._kmc))
+        out += _kwz_section(b"KMI", bytes(self._kmi), crc=False)
+        if any(self.tracks):
+            audio = b"".join(self.tracks)
+            ksn = struct.pack("<I5I", self.bgm_speed, *(len(track) for track in self.tracks))
+            ksn += struct.pack("<I", zlib.crc32(audio) & 0xFFFFFFFF) + audio
+            out += b"KSN" + bytes((kwz.SECTION_MAGIC[b"KSN"],)) + struct.pack("<I", len(ksn)) + ksn
+        return out + bytes(kwz.KWZ_SIGNATURE_SIZE)
+
+    def save(self, path):
+        """Write the note to a filename or binary file object."""
+        _output(path, self.tobytes())
@@ -0,0 +1,114 @@
+"""
+Format detection shared by helpers that accept either PPM or KWZ notes.
+"""
+
+import io
+
+from flipnote import ppm
+from flipnote import kwz
+
+PPM_MAGIC = b"PARA"
+
+# Any KWZ file starts with one of its section headers (folder icons have no KFH)
+KWZ_SECTION_MAGICS = (b"KFH", b"KTN", b"KMC", b"KMI", b"KSN")
+
+
+def detect_format(head):
+    """Return "ppm", "kwz" or None from the first bytes of a file."""
+    head = bytes(head[:4])
+    if head == PPM_MAGIC:
+        return "ppm"
+    if head[:3] in KWZ_SECTION_MAGICS:
+        return "kwz"
+    return None
+
+
+def parser_class(fmt):
+    """Return the Parser class for a format name ("ppm" or "kwz")."""
+    if fmt == "ppm":
+        return ppm.Parser
+    if fmt == "kwz":
+        return kwz.Parser
+    raise ValueError("Unknown flipnote format: %r" % (fmt,))
+
+
+def open_note(path, backend="auto", verify=0.0):
+    """Open a .ppm or .kwz file, choosing the parser from its magic bytes.
+
+    backend and verify are passed to the parser's open.
+    """
+    with open(path, "rb") as f:
+        fmt = detect_format(f.read(4))
+    if fmt is None:
+        raise ValueError("Not a PPM or KWZ file: %r" % (path,))
+    return parser_class(fmt).open(path, backend=backend, verify=verify)
+
+
+def load_note(data):
+    """Parse a PPM or KWZ note held in memory (bytes or a binary stream)."""
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data.seek(0)
+        data = data.read()
+    fmt = detect_format(data)
+    if fmt is None:
+        raise ValueError("Not a PPM or KWZ buffer")
+    parser = parser_class(fmt)()
+    parser.load(io.BytesIO(data))
+    return parser
+
+
+def note_metadata(parser):
+    """Format-independent metadata of a parsed note as a plain dict.
+
+    Holds the format, author names and IDs, filenames, timestamps (Unix
+    seconds; creation_timestamp is None for PPM, which only stores one),
+    frame count, framerate, lock flag, track sizes and track MD5 digests.
+    IDs and filenames are as the parser reports them.
+    """
+    if isinstance(parser, ppm.Parser):
+        fmt = "ppm"
+        timestamp = int(parser.timestamp.timestamp())
+        creation_timestamp = None
+        root_filename = parser.root_filename_fragment
+    else:
+        fmt = "kwz"
+        timestamp = parser.modified_timestamp
+        creation_timestamp = parser.creation_timestamp
+        root_filename = parser.root_filename
+    return {
+        "format": fmt,
+        "current_author_name": parser.current_author_name,
+        "parent_author_name": parser.parent_author_name,
+        "root_author_name": parser.root_author_name,
+        "current_author_id": parser.current_author_id,
+        "parent_author_id": parser.parent_author_id,
+        "root_author_id": parser.root_author_id,
+        "current_filename": parser.current_filename,
+        "parent_filename": parser.parent_filename,
+        "root_filename": root_filename,
+        "timestamp": timestamp,
+        "creation_timestamp": creation_timestamp,
+        "frame_count": parser.frame_count,
+        "framerate": parser.framerate,
+        "lock": parser.lock,
+        "track_sizes": parser.track_sizes,
+        "track_digests": parser.track_digests,
+    }
+
+
+def validate(data, check_crc=False):
+    """Structural problems with a PPM or KWZ file (bytes or a path), as a list of strings.
+
+    Dispatches to flipnote.ppm.validate or flipnote.kwz.validate; check_crc
+    additionally verifies KWZ section CRC32s. An empty list means the file
+    can be handed to a parser.
+    """
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        with open(data, "rb") as f:
+            data = f.read()
+    fmt = detect_format(data)
+    if fmt == "ppm":
+        return ppm.validate(data)
+    if fmt == "kwz":
+        return kwz.validate(data, check_crc)
+    return ["not a PPM or KWZ file"]
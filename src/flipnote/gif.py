@@ -0,0 +1,228 @@
+"""
+Animated GIF export straight from palette-indexed frames.
+
+Flipnote frames use at most 3 (PPM) or 7 (KWZ) colours, so they can be
+written without quantization: each frame carries a local colour table
+holding only the colours it uses, and only the rectangle that changed since
+the previous frame is stored. Frames are decoded, compressed and written
+one at a time; identical consecutive frames are merged by extending the
+previous frame's delay.
+
+    from flipnote.gif import write_gif
+
+    write_gif(parser, "animation.gif", scale=2)
+
+Parsers also expose this as ``parser.export_gif(path)``.
+"""
+
+import struct
+
+import numpy as np
+
+from flipnote._palette import check_scale, upscale_indices
+
+GIF_MAX_CODES = 4096
+GIF_MAX_DELAY = 0xFFFF
+
+# Graphic control extension flags: disposal method 1 (leave the frame in
+# place), so each sub-rectangle is drawn over the previous frame
+GIF_DISPOSE_NONE = 1 << 2
+
+
+def _lzw_encode(data, min_code_size):
+    """Compress a bytes object of colour indices with GIF's variable-width LZW.
+
+    Strings are keyed by (prefix code << 8 | index) in a flat dict, which is
+    cheap for the very long runs that small palettes produce.
+    """
+    clear = 1 << min_code_size
+    end = clear + 1
+    out = bytearray()
+    append = out.append
+
+    code_size = min_code_size + 1
+    next_code = end + 1
+    table = {}
+
+    buffer = clear
+    nbits = code_size
+
+    prefix = data[0]
+    for k in data[1:]:
+        key = (prefix << 8) | k
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+
+        buffer |= prefix << nbits
+        nbits += code_size
+        while nbits >= 8:
+            append(buffer & 0xFF)
+            buffer >>= 8
+            nbits -= 8
+
+        if next_code < GIF_MAX_CODES:
+            table[key] = next_code
+            next_code += 1
+            if next_code > (1 << code_size) and code_size < 12:
+                code_size += 1
+        else:
+            # Table full: start over
+            buffer |= clear << nbits
+            nbits += code_size
+            table.clear()
+            code_size = min_code_size + 1
+            next_code = end + 1
+        prefix = k
+
+    for code in (prefix, end):
+        buffer |= code << nbits
+        nbits += code_size
+    while nbits > 0:
+        append(buffer & 0xFF)
+        buffer >>= 8
+        nbits -= 8
+    return bytes(out)
+
+
+def _sub_blocks(data):
+    """Split image data into length-prefixed sub-blocks of at most 255 bytes."""
+    out = bytearray()
+    for i in range(0, len(data), 255):
+        chunk = data[i:i + 255]
+        out.append(len(chunk))
+        out += chunk
+    out.append(0)
+    return bytes(out)
+
+
+def _changed_box(current, previous):
+    """(x, y, w, h) bounding box of the pixels that differ, or None."""
+    diff = current != previous
+    rows = np.flatnonzero(diff.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(diff.any(axis=0))
+    y, x = int(rows[0]), int(cols[0])
+    return x, y, int(cols[-1]) - x + 1, int(rows[-1]) - y + 1
+
+
+class GifWriter:
+    """Incrementally write an animated GIF from full-size indexed frames.
+
+    Frames are (height, width) uint8 arrays of indices into one fixed
+    palette (an (N, 3) uint8 array, N <= 256). Only the previous frame and
+    one pending, not yet written sub-rectangle are kept in memory.
+    """
+
+    def __init__(self, fp, width, height, palette, loop=True):
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.palette = np.asarray(palette, dtype=np.uint8)
+        self._previous = None
+        self._pending = None
+
+        # Header and logical screen descriptor without a global colour table
+        fp.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0))
+        if loop:
+            # NETSCAPE2.0 application extension: loop forever
+            fp.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + b"\x00")
+
+    def add_frame(self, indices, delay):
+        """Queue a frame shown for delay centiseconds."""
+        if indices.shape != (self.height, self.width):
+            raise ValueError("Frame shape %r does not match %dx%d" % (indices.shape, self.width, self.height))
+
+        if self._previous is None:
+            box = (0, 0, self.width, self.height)
+        else:
+            box = _changed_box(indices, self._previous)
+
+        pending = self._pending
+        if box is None:
+            if pending[5] + delay <= GIF_MAX_DELAY:
+                self._pending = pending[:5] + (pending[5] + delay,)
+                return
+            # Delay field would overflow: repeat a single unchanged pixel
+            box = (0, 0, 1, 1)
+
+        if pending is not None:
+            self._write_frame(*pending)
+        x, y, w, h = box
+        self._pending = (x, y, w, h, np.array(indices[y:y + h, x:x + w]), delay)
+        self._previous = np.array(indices)
+
+    def _write_frame(self, x, y, w, h, rect, delay):
+        # Local colour table of just the colours used, padded to a power of two
+        used = np.unique(rect)
+        bits = max(1, int(len(used) - 1).bit_length())
+        table = np.zeros((1 << bits, 3), dtype=np.uint8)
+        table[:len(used)] = self.palette[used]
+        remap = np.zeros(256, dtype=np.uint8)
+        remap[used] = np.arange(len(used), dtype=np.uint8)
+
+        min_code_size = max(2, bits)
+        data = _lzw_encode(remap[rect].tobytes(), min_code_size)
+
+        self.fp.write(b"".join((
+            b"\x21\xF9\x04" + struct.pack("<BHBB", GIF_DISPOSE_NONE, delay, 0, 0),
+            b"\x2C" + struct.pack("<HHHHB", x, y, w, h, 0x80 | (bits - 1)),
+            table.tobytes(),
+            bytes((min_code_size,)),
+            _sub_blocks(data),
+        )))
+
+    def close(self):
+        """Write the last pending frame and the trailer."""
+        if self._pending is not None:
+            self._write_frame(*self._pending)
+            self._pending = None
+        self.fp.write(b"\x3B")
+
+
+def frame_delays(count, framerate):
+    """Per-frame GIF delays in centiseconds for a framerate.
+
+    Delays are rounded along the running timeline so the total length stays
+    exact even when 100 / framerate is not a whole number.
+    """
+    if framerate <= 0:
+        return [10] * count
+    ticks = [int(round(i * 100.0 / framerate)) for i in range(count + 1)]
+    return [max(1, ticks[i + 1] - ticks[i]) for i in range(count)]
+
+
+def write_gif(parser, path, scale=1, loop=None, skip_hidden=None):
+    """Export every frame of a parsed note as an animated GIF.
+
+    Args:
+        parser: a PPM or KWZ parser
+        path: output filename or writable binary file object
+        scale: integer nearest-neighbour upscaling factor
+        loop: loop forever (default: the note's own loop flag)
+        skip_hidden: as in decode_frame
+    """
+    scale = check_scale(scale)
+    if loop is None:
+        loop = bool(parser.loop)
+
+    if hasattr(path, "write"):
+        _write_gif(parser, path, scale, loop, skip_hidden)
+    else:
+        with open(path, "wb") as f:
+            _write_gif(parser, f, scale, loop, skip_hidden)
+
+
+def _write_gif(parser, fp, scale, loop, skip_hidden):
+    count = parser.frame_count
+    writer = None
+    for index, delay in enumerate(frame_delays(count, parser.framerate)):
+        frame = upscale_indices(parser.decode_frame_indexed(index, skip_hidden), scale)
+        if writer is None:
+            height, width = frame.shape
+            writer = GifWriter(fp, width, height, parser.indexed_palette, loop)
+        writer.add_frame(frame, delay)
+    if writer is not None:
+        writer.close()
@@ -8,12 +8,19 @@ Matches the C implementation in libugomemo exactly:
 - Variable-width 2/4-bit ADPCM audio at 16364 Hz
 """
 
+import contextlib
 import struct
+import zlib
 import numpy as np
-from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5, blake2b
 
 from flipnote.schema import convertKWZFSIDToPPM
 from flipnote import _native
+from flipnote import metrics
+from flipnote.gif import write_gif
+from flipnote.stream import write_wav, write_y4m
+from flipnote._palette import check_region, check_scale, indices_to_rgb, palette_array, rgb_to_indices
 
 # ---------------------------------------------------------------------------
 # Constants
@@ -43,6 +50,7 @@ PALETTE = [
     (0x06, 0xAE, 0xFF),  # 5: blue
     (0x00, 0x00, 0x00),  # 6: transparent (placeholder)
 ]
+PALETTE_ARRAY = palette_array(PALETTE)
 
 # Commonly occurring line offsets
 KWZ_COMMON_LINE_INDEX = [
@@ -92,6 +100,14 @@ TILE_TYPE_7_PATTERNS = [
     [0, 1, 1, 0, 1, 1, 0, 1],
 ]
 
+# Section layout sizes (bytes after the 8-byte section header)
+KWZ_KFH_SIZE = 4 + 200          # CRC32 + header fields
+KWZ_KMI_ENTRY_SIZE = 28
+KWZ_KSN_HEADER_SIZE = 4 + 20 + 4  # speed + 5 track sizes + CRC32 of the audio
+
+# Sections at least this large are hashed on the thread pool by verify_sections
+KWZ_CRC_PARALLEL_SIZE = 1 << 16
+
 # Section magic bytes (4th byte is the section type indicator)
 SECTION_MAGIC = {
     b"KFH": 0x14,
@@ -186,6 +202,10 @@ def _compute_tile_positions():
 
 TILE_POSITIONS = _compute_tile_positions()
 
+# Row-major index into the 30x40 tile grid for each tile in decode order
+TILE_GRID_INDEX = np.array([(y // KWZ_TILE_SIZE) * KWZ_TILES_X + x // KWZ_TILE_SIZE
+                            for x, y in TILE_POSITIONS], dtype=np.int32)
+
 
 # ---------------------------------------------------------------------------
 # Bitpacked reader
@@ -252,11 +272,56 @@ def _decode_filename(raw):
     return "0x" + raw[:KWZ_FILENAME_LENGTH].hex().upper()
 
 
+def _fsid_ppm(raw):
+    return convertKWZFSIDToPPM(raw.hex())
+
+
+def _fsid_int(raw):
+    """10-byte KWZ FSID as the 64-bit integer of its PPM form (the middle 8 bytes, LE)."""
+    return None if raw is None else int.from_bytes(raw[1:9], "little")
+
+
+def _frame_data_size(entry):
+    return entry["layer_a_size"] + entry["layer_b_size"] + entry["layer_c_size"]
+
+
+# KFH fields kept as raw bytes in Parser._raw and formatted into meta[key]
+# when first read: key -> (raw field, decoder)
+LAZY_META_FIELDS = {
+    "root_fsid": ("root_fsid", bytes.hex),
+    "root_fsid_ppm": ("root_fsid", _fsid_ppm),
+    "root_filename": ("root_filename", _decode_filename),
+    "parent_fsid": ("parent_fsid", bytes.hex),
+    "parent_fsid_ppm": ("parent_fsid", _fsid_ppm),
+    "parent_filename": ("parent_filename", _decode_filename),
+    "current_fsid": ("current_fsid", bytes.hex),
+    "current_fsid_ppm": ("current_fsid", _fsid_ppm),
+    "current_filename": ("current_filename", _decode_filename),
+}
+
+
 # ---------------------------------------------------------------------------
 # Layer decompression
 # ---------------------------------------------------------------------------
 
-def _decompress_layer(layer, prev_layer, data, size, is_diff):
+def _skip_tile(read, tile_type):
+    """Consume the bits of one tile of type 0-4, 6 or 7 without decoding it."""
+    if tile_type == 0 or tile_type == 2:
+        read(5)
+    elif tile_type == 1 or tile_type == 3:
+        read(13)
+    elif tile_type == 4:
+        flags = read(8)
+        for row in range(8):
+            read(5 if flags & (1 << row) else 13)
+    elif tile_type == 7:
+        read(2)
+        bits = 5 if read(1) else 13
+        read(bits)
+        read(bits)
+
+
+def _decompress_layer(layer, prev_layer, data, size, is_diff, written=None, mask=None):
     """Decompress a single layer from bitpacked tile data.
 
     Matches kwz_decompress_layer_v2 in kwz_video.c exactly.
@@ -267,11 +332,19 @@ def _decompress_layer(layer, prev_layer, data, size, is_diff):
         data: raw compressed bytes (memoryview or bytes)
         size: compressed data size in bytes
         is_diff: if True, this layer is a diff against the previous frame
+        written: optional (1200,) bool array, set to the tiles (in decode
+            order) that may differ from prev_layer
+        mask: optional (1200,) bool array of tiles (in decode order) to
+            decode; the bits of other tiles are consumed but not drawn
     """
     if is_diff and prev_layer is not None:
         layer[:] = prev_layer
+        if written is not None:
+            written[:] = False
     else:
         layer[:] = 0
+        if written is not None:
+            written[:] = True
 
     if size == 0:
         return
@@ -283,7 +356,13 @@ def _decompress_layer(layer, prev_layer, data, size, is_diff):
         x, y = TILE_POSITIONS[t]
         tile_type = reader.read(3)
 
-        if tile_type == 0:
+        if written is not None and tile_type != 6:
+            written[t] = tile_type != 5
+
+        if mask is not None and tile_type != 5 and not mask[t]:
+            _skip_tile(reader.read, tile_type)
+
+        elif tile_type == 0:
             # Common index -> same line for all 8 rows
             line_idx = KWZ_COMMON_LINE_INDEX[reader.read(5)]
             line = LINE_TABLE[line_idx]
@@ -338,7 +417,9 @@ def _decompress_layer(layer, prev_layer, data, size, is_diff):
                 if t >= KWZ_TILE_COUNT:
                     break
                 sx, sy = TILE_POSITIONS[t]
-                if prev_layer is not None:
+                if written is not None:
+                    written[t] = False
+                if prev_layer is not None and (mask is None or mask[t]):
                     for row in range(8):
                         layer[sy + row, sx:sx + 8] = prev_layer[sy + row, sx:sx + 8]
                 if s < skip_count:
@@ -374,84 +455,93 @@ def _decompress_layer(layer, prev_layer, data, size, is_diff):
         t += 1
 
 
+def _scan_layer_tiles(data, size):
+    """Walk a layer's tile stream without writing pixels.
+
+    Returns a (1200,) uint8 array with the tile type that covers each tile in
+    decode order; tiles covered by a type 5 skip run are reported as 5. An
+    empty layer (size 0) is reported as all type 6 (no-op).
+    """
+    types = np.full(KWZ_TILE_COUNT, 6, dtype=np.uint8)
+    if size == 0:
+        return types
+
+    reader = _BitReader(data)
+    read = reader.read
+    t = 0
+
+    while t < KWZ_TILE_COUNT:
+        tile_type = read(3)
+        types[t] = tile_type
+
+        if tile_type == 5:
+            skip_count = read(5)
+            end = min(t + skip_count + 1, KWZ_TILE_COUNT)
+            types[t:end] = 5
+            t = end - 1
+        else:
+            _skip_tile(read, tile_type)
+
+        t += 1
+
+    return types
+
+
+def _region_tile_mask(x, y, w, h):
+    """(1200,) bool array, in decode order, of the tiles intersecting a region."""
+    grid = np.zeros((KWZ_TILES_Y, KWZ_TILES_X), dtype=bool)
+    grid[y // KWZ_TILE_SIZE:(y + h - 1) // KWZ_TILE_SIZE + 1,
+         x // KWZ_TILE_SIZE:(x + w - 1) // KWZ_TILE_SIZE + 1] = True
+    return grid.reshape(-1)[TILE_GRID_INDEX]
+
+
 # ---------------------------------------------------------------------------
 # Layer compositing
 # ---------------------------------------------------------------------------
 
-def _composite_frame(output, layer_a, layer_b, layer_c, flags):
-    """Composite 3 layers into an RGB frame.
+def _composite_frame_indexed(output, layer_a, layer_b, layer_c, flags):
+    """Composite 3 layers into a frame of PALETTE indices.
 
     Matches kwz_composite_frame in kwz_video.c exactly.
 
     Args:
-        output: numpy array (240, 320, 3) uint8, modified in-place
+        output: numpy array (240, 320) uint8, modified in-place
         layer_a, layer_b, layer_c: numpy arrays (240, 320) uint8 with values 0-2
         flags: u32 frame flags from KMI entry
     """
     paper_idx = flags & 0x0F
-    la_c1 = (flags >> 8) & 0x0F
-    la_c2 = (flags >> 12) & 0x0F
-    lb_c1 = (flags >> 16) & 0x0F
-    lb_c2 = (flags >> 20) & 0x0F
-    lc_c1 = (flags >> 24) & 0x0F
-    lc_c2 = (flags >> 28) & 0x0F
-
     if paper_idx > 6:
         paper_idx = 0
-    paper = PALETTE[paper_idx]
-
-    # Fill with paper color
-    output[:, :, 0] = paper[0]
-    output[:, :, 1] = paper[1]
-    output[:, :, 2] = paper[2]
-
-    # Layer C (bottom)
-    if lc_c1 < 7:
-        mask = layer_c == 1
-        color = PALETTE[lc_c1]
-        output[mask, 0] = color[0]
-        output[mask, 1] = color[1]
-        output[mask, 2] = color[2]
-    if lc_c2 < 7:
-        mask = layer_c == 2
-        color = PALETTE[lc_c2]
-        output[mask, 0] = color[0]
-        output[mask, 1] = color[1]
-        output[mask, 2] = color[2]
-
-    # Layer B (middle)
-    if lb_c1 < 7:
-        mask = layer_b == 1
-        color = PALETTE[lb_c1]
-        output[mask, 0] = color[0]
-        output[mask, 1] = color[1]
-        output[mask, 2] = color[2]
-    if lb_c2 < 7:
-        mask = layer_b == 2
-        color = PALETTE[lb_c2]
-        output[mask, 0] = color[0]
-        output[mask, 1] = color[1]
-        output[mask, 2] = color[2]
-
-    # Layer A (top)
-    if la_c1 < 7:
-        mask = layer_a == 1
-        color = PALETTE[la_c1]
-        output[mask, 0] = color[0]
-        output[mask, 1] = color[1]
-        output[mask, 2] = color[2]
-    if la_c2 < 7:
-        mask = layer_a == 2
-        color = PALETTE[la_c2]
-        output[mask, 0] = color[0]
-        output[mask, 1] = color[1]
-        output[mask, 2] = color[2]
+    output[:] = paper_idx
+
+    # Layer C (bottom), then B, then A (top); colour slots >= 7 are not drawn
+    for layer, shift in ((layer_c, 24), (layer_b, 16), (layer_a, 8)):
+        c1 = (flags >> shift) & 0x0F
+        c2 = (flags >> (shift + 4)) & 0x0F
+        if c1 < 7:
+            output[layer == 1] = c1
+        if c2 < 7:
+            output[layer == 2] = c2
+
+
+def _composite_frame(output, layer_a, layer_b, layer_c, flags):
+    """Composite 3 layers into an RGB frame.
+
+    Args:
+        output: numpy array (240, 320, 3) uint8, modified in-place
+        layer_a, layer_b, layer_c: numpy arrays (240, 320) uint8 with values 0-2
+        flags: u32 frame flags from KMI entry
+    """
+    pixels = np.empty(output.shape[:2], dtype=np.uint8)
+    _composite_frame_indexed(pixels, layer_a, layer_b, layer_c, flags)
+    np.take(PALETTE_ARRAY, pixels, axis=0, out=output)
 
 
 # ---------------------------------------------------------------------------
 # Audio decoding
 # ---------------------------------------------------------------------------
 
+@metrics.timed("kwz.decode_audio.python")
 def _decode_audio_track(data, step_index=0):
     """Decode variable-width 2/4-bit ADPCM audio.
 
@@ -527,15 +617,141 @@ def _decode_audio_track(data, step_index=0):
     return output[:output_pos]
 
 
+# ---------------------------------------------------------------------------
+# Validation
+# ---------------------------------------------------------------------------
+
+def _section_crc(data, name, offset, length):
+    """(stored, computed) CRC32 of a section, or None for sections without one.
+
+    data may be a memoryview; the checksummed range is passed to zlib.crc32
+    without copying.
+    """
+    if name == "KSN":
+        start = offset + 8 + KWZ_KSN_HEADER_SIZE
+        stored = struct.unpack_from("<I", data, start - 4)[0]
+    elif name == "KMI":
+        return None
+    else:
+        start = offset + 12
+        stored = struct.unpack_from("<I", data, offset + 8)[0]
+    return stored, zlib.crc32(data[start:offset + 8 + length]) & 0xFFFFFFFF
+
+
+def validate(data, check_crc=False):
+    """Bounds-check a KWZ file held in memory without decoding anything.
+
+    Walks the section table and checks each section against the file
+    length, the KMI layer sizes against the KMC section and the KSN track
+    sizes against the KSN section. With check_crc, the CRC32 of every
+    section that carries one is verified as well. Returns a list of problem
+    descriptions; an empty list means the file is structurally sound.
+    """
+    data = memoryview(data)
+    size = len(data) - KWZ_SIGNATURE_SIZE
+    if size < 8:
+        return ["file too short (%d bytes)" % len(data)]
+
+    problems = []
+    sections = {}
+    offset = 0
+    while offset < size:
+        if offset + 8 > size:
+            problems.append("truncated section header at 0x%X" % offset)
+            break
+        magic = bytes(data[offset:offset + 3])
+        length = struct.unpack_from("<I", data, offset + 4)[0]
+        if magic not in SECTION_MAGIC:
+            problems.append("unknown section %r at 0x%X" % (magic, offset))
+            break
+        name = magic.decode("ascii")
+        if offset + 8 + length > size:
+            problems.append("%s section at 0x%X runs %d bytes past the end of the file"
+                            % (name, offset, offset + 8 + length - size))
+            break
+        if name in sections:
+            problems.append("duplicate %s section at 0x%X" % (name, offset))
+        else:
+            sections[name] = (offset, length)
+        offset += 8 + length
+
+    frame_count = 1
+    if "KFH" in sections:
+        offset, length = sections["KFH"]
+        if length < KWZ_KFH_SIZE:
+            problems.append("KFH section is %d bytes, expected %d" % (length, KWZ_KFH_SIZE))
+        else:
+            for i, name in enumerate(("root", "parent", "current")):
+                start = offset + 12 + 42 + 22 * i
+                try:
+                    bytes(data[start:start + 22]).decode("utf-16-le")
+                except UnicodeDecodeError:
+                    problems.append("%s author name is not valid UTF-16" % name)
+            frame_count, thumb_index, _flags, speed = struct.unpack_from("<HHHB", data, offset + 12 + 192)
+            if frame_count == 0:
+                problems.append("frame count is 0")
+            if thumb_index >= max(frame_count, 1):
+                problems.append("thumbnail frame %d is out of range for %d frames" % (thumb_index, frame_count))
+            if speed >= len(FRAMERATES):
+                problems.append("invalid frame speed %d" % speed)
+
+    if ("KMI" in sections) != ("KMC" in sections):
+        problems.append("KMI and KMC sections must both be present")
+    elif "KMI" in sections:
+        kmi_offset, kmi_length = sections["KMI"]
+        kmc_length = sections["KMC"][1]
+        if kmi_length < frame_count * KWZ_KMI_ENTRY_SIZE:
+            problems.append("KMI section holds %d entries but there are %d frames"
+                            % (kmi_length // KWZ_KMI_ENTRY_SIZE, frame_count))
+        elif kmc_length < 4:
+            problems.append("KMC section is too short for its CRC32")
+        else:
+            entries = np.frombuffer(data, dtype=np.uint8, count=frame_count * KWZ_KMI_ENTRY_SIZE,
+                                    offset=kmi_offset + 8).reshape(frame_count, KWZ_KMI_ENTRY_SIZE)
+            layer_sizes = entries[:, 4:10].copy().view("<u2")
+            total = int(layer_sizes.sum())
+            if total > kmc_length - 4:
+                problems.append("KMI layer sizes total %d bytes but the KMC section holds %d"
+                                % (total, kmc_length - 4))
+
+    if "KSN" in sections:
+        offset, length = sections["KSN"]
+        if length < KWZ_KSN_HEADER_SIZE:
+            problems.append("KSN section is %d bytes, too short for its header" % length)
+        else:
+            tracks = struct.unpack_from("<5I", data, offset + 12)
+            if sum(tracks) > length - KWZ_KSN_HEADER_SIZE:
+                problems.append("audio tracks total %d bytes but the KSN section holds %d"
+                                % (sum(tracks), length - KWZ_KSN_HEADER_SIZE))
+
+    if check_crc:
+        for name, (offset, length) in sections.items():
+            if length < (KWZ_KSN_HEADER_SIZE if name == "KSN" else 4):
+                continue
+            crc = _section_crc(data, name, offset, length)
+            if crc is not None and crc[0] != crc[1]:
+                problems.append("%s CRC32 mismatch (stored %08X, computed %08X)" % (name, crc[0], crc[1]))
+
+    return problems
+
+
 # ---------------------------------------------------------------------------
 # Parser class
 # ---------------------------------------------------------------------------
 
 class Parser:
-    """KWZ file parser matching the libugomemo C implementation."""
+    """KWZ file parser matching the libugomemo C implementation.
+
+    With verify_crc, each section's CRC32 is checked the first time the
+    section is used (KFH on load, KMC on the first frame decode, KTN and KSN
+    on thumbnail and audio access) and a mismatch raises ValueError.
+    """
 
-    def __init__(self, buffer=None):
+    audio_sample_rate = KWZ_AUDIO_SAMPLE_RATE
+
+    def __init__(self, buffer=None, verify_crc=False):
         self.buffer = None
+        self.verify_crc = verify_crc
         self.size = 0
         self.sections = {}
         self.is_folder_icon = False
@@ -551,6 +767,7 @@ class Parser:
         self._track_lengths = [0, 0, 0, 0, 0]
 
         self._kmc_data = None     # Raw KMC section data (after CRC32)
+        self._crc_report = {}     # Section name -> verify_sections entry
 
         # Layer buffers for frame decoding (persistent across frames for diffing)
         self._layer_a = np.zeros((KWZ_FRAME_HEIGHT, KWZ_FRAME_WIDTH), dtype=np.uint8)
@@ -560,46 +777,81 @@ class Parser:
         self._prev_layer_b = np.zeros((KWZ_FRAME_HEIGHT, KWZ_FRAME_WIDTH), dtype=np.uint8)
         self._prev_layer_c = np.zeros((KWZ_FRAME_HEIGHT, KWZ_FRAME_WIDTH), dtype=np.uint8)
         self._prev_decoded_frame = -1
+        self._stale_layers = frozenset()
+        self._valid_tiles = None
+        self._unused = None
+        self._delta_previous = None
 
-        self.meta = None
+        self._meta = None
+        self._raw = None            # Raw KFH FSID / filename bytes by field
+        self._meta_complete = False
 
-        # Native C acceleration handle
+        # Native C acceleration handle, why there is none (for metrics), and
+        # the differential checker for verify
         self._native_ctx = None
+        self._native_reason = None
+        self._verifier = None
         self._file_path = None
 
+        # Optional decoded-frame cache (flipnote.cache.FrameCache)
+        self.frame_cache = None
+        self._animation_digest = None
+
         if buffer is not None:
             self.load(buffer)
 
     @classmethod
-    def open(cls, path):
+    @metrics.timed("kwz.open")
+    def open(cls, path, cache=None, verify_crc=False, backend="auto", verify=0.0):
         """Open a KWZ file from disk.
 
         Uses C acceleration via libugomemo if available for frame/audio decode.
+        cache is an optional flipnote.cache.FrameCache for decoded frames;
+        verify_crc enables lazy per-section CRC32 checks (see Parser);
+        backend and verify are as in load.
         """
-        instance = cls()
+        instance = cls(verify_crc=verify_crc)
         instance._file_path = str(path)
+        instance.frame_cache = cache
 
-        # Try native C backend
-        instance._native_ctx = _native.native_kwz_open(instance._file_path)
-
-        # Always parse in Python for metadata access
+        # Always parse in Python for metadata access. The file is read into
+        # memory so thumbnail/audio access keeps working after it is closed.
         with open(path, "rb") as f:
-            instance.load(f)
+            instance.load(f.read(), backend, verify)
 
         return instance
 
-    def load(self, buffer):
-        """Load and parse a KWZ file from a file-like object or bytes."""
+    @metrics.timed("kwz.load")
+    def load(self, buffer, backend="auto", verify=0.0):
+        """Load and parse a KWZ file from a file-like object or bytes.
+
+        backend picks the frame and audio decoder: "auto" uses libugomemo
+        when it is available and the file was opened from a path, "native"
+        raises ValueError when it can't, and "python" never uses it.
+
+        verify, a fraction between 0 and 1, decodes that share of frames
+        with both backends the first time they are requested and compares
+        them; see verify_report.
+        """
         if isinstance(buffer, (bytes, bytearray, memoryview)):
             import io
             buffer = io.BytesIO(buffer)
 
         self.buffer = buffer
+        self.sections = {}
+        self._crc_report = {}
+        self._animation_digest = None
+        self._unused = None
+        self._prev_decoded_frame = -1
+        self._stale_layers = frozenset()
+        self._valid_tiles = None
+        self._delta_previous = None
 
         # Get file size (excluding 256-byte signature)
         self.buffer.seek(0, 2)
         self.size = self.buffer.tell() - KWZ_SIGNATURE_SIZE
         self.buffer.seek(0, 0)
+        metrics.count("kwz.bytes_read", self.size + KWZ_SIGNATURE_SIZE)
 
         # Parse section table
         offset = 0
@@ -635,6 +887,12 @@ class Parser:
             self.buffer.seek(kmc_section["offset"] + 12)  # 8 header + 4 CRC32
             self._kmc_data = self.buffer.read(kmc_section["length"] - 4)
 
+        # Open native context for C acceleration, as the backend allows
+        if self._native_ctx is not None:
+            _native.native_kwz_close(self._native_ctx)
+        self._native_ctx, self._native_reason, self._verifier = _native.open_context(
+            "kwz", self._file_path, backend, verify)
+
     def unload(self):
         """Release resources."""
         if self._native_ctx is not None:
@@ -660,7 +918,12 @@ class Parser:
         self._frame_offsets = []
         self._track_lengths = [0, 0, 0, 0, 0]
         self._kmc_data = None
+        self._crc_report = {}
         self._prev_decoded_frame = -1
+        self._stale_layers = frozenset()
+        self._valid_tiles = None
+        self._unused = None
+        self._delta_previous = None
 
     # -----------------------------------------------------------------------
     # Properties
@@ -682,6 +945,29 @@ class Parser:
     # Public properties
     # -----------------------------------------------------------------------
 
+    @property
+    def meta(self):
+        """KFH/KSN metadata dict, or None before a file is loaded.
+
+        FSIDs and filenames are only formatted into it the first time the
+        dict is read; the single-field properties format just their field.
+        """
+        if self._meta is not None and not self._meta_complete:
+            for key in LAZY_META_FIELDS:
+                self._format(key)
+            self._meta_complete = True
+        return self._meta
+
+    def _format(self, key):
+        """meta[key] for a LAZY_META_FIELDS key, decoding it on first access."""
+        if self._meta is None:
+            return None
+        value = self._meta[key]
+        if value is None:
+            field, decode = LAZY_META_FIELDS[key]
+            value = self._meta[key] = decode(self._raw[field])
+        return value
+
     @property
     def thumb_index(self):
         return self._thumb_index
@@ -693,76 +979,189 @@ class Parser:
 
     @property
     def lock(self):
-        return self.meta.get('lock', 0) if self.meta else 0
+        return self._meta.get('lock', 0) if self._meta else 0
 
     @property
     def loop(self):
-        return self.meta.get('loop', 0) if self.meta else 0
+        return self._meta.get('loop', 0) if self._meta else 0
 
     @property
     def creation_timestamp(self):
-        return self.meta.get('creation_timestamp') if self.meta else None
+        return self._meta.get('creation_timestamp') if self._meta else None
 
     @property
     def modified_timestamp(self):
-        return self.meta.get('modified_timestamp') if self.meta else None
+        return self._meta.get('modified_timestamp') if self._meta else None
 
     @property
     def app_version(self):
-        return self.meta.get('app_version') if self.meta else None
+        return self._meta.get('app_version') if self._meta else None
 
     @property
     def current_author_name(self):
-        return self.meta.get('current_username') if self.meta else None
+        return self._meta.get('current_username') if self._meta else None
 
     @property
     def parent_author_name(self):
-        return self.meta.get('parent_username') if self.meta else None
+        return self._meta.get('parent_username') if self._meta else None
 
     @property
     def root_author_name(self):
-        return self.meta.get('root_username') if self.meta else None
+        return self._meta.get('root_username') if self._meta else None
 
     @property
     def current_author_id(self):
-        return self.meta.get('current_fsid') if self.meta else None
+        return self._format("current_fsid")
 
     @property
     def parent_author_id(self):
-        return self.meta.get('parent_fsid') if self.meta else None
+        return self._format("parent_fsid")
 
     @property
     def root_author_id(self):
-        return self.meta.get('root_fsid') if self.meta else None
+        return self._format("root_fsid")
 
     @property
     def current_filename(self):
-        return self.meta.get('current_filename') if self.meta else None
+        return self._format("current_filename")
 
     @property
     def parent_filename(self):
-        return self.meta.get('parent_filename') if self.meta else None
+        return self._format("parent_filename")
 
     @property
     def root_filename(self):
-        return self.meta.get('root_filename') if self.meta else None
+        return self._format("root_filename")
+
+    @property
+    def current_author_id_raw(self):
+        """The 10 FSID bytes as stored in the file."""
+        return self._raw["current_fsid"] if self._raw else None
+
+    @property
+    def parent_author_id_raw(self):
+        return self._raw["parent_fsid"] if self._raw else None
+
+    @property
+    def root_author_id_raw(self):
+        return self._raw["root_fsid"] if self._raw else None
+
+    @property
+    def current_author_id_int(self):
+        """Current author FSID as a 64-bit integer, equal to a PPM parser's for the same user."""
+        return _fsid_int(self.current_author_id_raw)
+
+    @property
+    def parent_author_id_int(self):
+        return _fsid_int(self.parent_author_id_raw)
+
+    @property
+    def root_author_id_int(self):
+        return _fsid_int(self.root_author_id_raw)
+
+    @property
+    def current_filename_raw(self):
+        """The 28 filename bytes as stored in the file."""
+        return self._raw["current_filename"] if self._raw else None
+
+    @property
+    def parent_filename_raw(self):
+        return self._raw["parent_filename"] if self._raw else None
+
+    @property
+    def root_filename_raw(self):
+        return self._raw["root_filename"] if self._raw else None
 
     @property
     def track_sizes(self):
         """Track sizes list (matches PPM naming)."""
         return list(self._track_lengths)
 
+    @property
+    def track_digests(self):
+        """MD5 hex digests of the raw track data (None for empty tracks), matching PPM naming."""
+        return [self._get_track_digest(track) for track in range(len(self._track_lengths))]
+
     @property
     def layer_visibility(self):
         """Layer visibility as [layer_a, layer_b, layer_c]."""
         return list(self._layer_visibility)
 
+    @property
+    def indexed_palette(self):
+        """RGB lookup table for decode_frame_indexed output (PALETTE)."""
+        return PALETTE_ARRAY
+
+    @property
+    def animation_digest(self):
+        """Hex digest of the frame data (KMI entries + KMC), used as the frame cache identity."""
+        if self._animation_digest is None:
+            h = blake2b(digest_size=16)
+            for entry in self._frame_meta:
+                h.update(struct.pack("<IHHH", entry["flags"], entry["layer_a_size"],
+                                     entry["layer_b_size"], entry["layer_c_size"]))
+            if self._kmc_data is not None:
+                h.update(self._kmc_data)
+            self._animation_digest = h.hexdigest()
+        return self._animation_digest
+
+    @property
+    def frame_spans(self):
+        """(start, end) file offsets of each frame's compressed layer data in the KMC section."""
+        if "KMC" not in self.sections:
+            return []
+        base = self.sections["KMC"]["offset"] + 12  # 8 header + 4 CRC32
+        return [(base + offset, base + offset + _frame_data_size(entry))
+                for offset, entry in zip(self._frame_offsets, self._frame_meta)]
+
+    @property
+    def frame_digests(self):
+        """Hex digests of each frame: its KMI flags and layer sizes, then its
+        compressed layer data (see get_frame_data).
+
+        Equal digests mean identically encoded frames. Diff layers are only
+        the same picture if the frames before them are too.
+        """
+        digests = []
+        for index, entry in enumerate(self._frame_meta):
+            h = blake2b(digest_size=16)
+            h.update(struct.pack("<IHHH", entry["flags"], entry["layer_a_size"],
+                                 entry["layer_b_size"], entry["layer_c_size"]))
+            h.update(self.get_frame_data(index))
+            digests.append(h.hexdigest())
+        return digests
+
+    def get_frame_data(self, index):
+        """Compressed layer A, B and C data of frame index as stored in the KMC section."""
+        offset = self._frame_offsets[index]
+        return self._kmc_data[offset:offset + _frame_data_size(self._frame_meta[index])]
+
+    def get_keyframe_digests(self):
+        """Hex digests of the decoded layers of frame 0 and every frame whose
+        three layers are all keyframes, as {index: digest}.
+
+        Unlike frame_digests this decodes the frames, but it also matches
+        keyframes that draw the same layers with different encodings or
+        colours.
+        """
+        digests = {}
+        for index, entry in enumerate(self._frame_meta):
+            if index == 0 or entry["flags"] & 0x70 == 0x70:
+                self._decode_layers(index)
+                h = blake2b(digest_size=16)
+                for layer in (self._layer_a, self._layer_b, self._layer_c):
+                    h.update(layer.tobytes())
+                digests[index] = h.hexdigest()
+        return digests
+
     # -----------------------------------------------------------------------
     # Section parsers
     # -----------------------------------------------------------------------
 
+    @metrics.timed("kwz.decode_meta")
     def _decode_meta(self):
         """Parse the KFH section. Matches kwz_process_kfh in kwz.c."""
+        self._verify_section("KFH")
         section = self.sections["KFH"]
         self.buffer.seek(section["offset"] + 12)  # 8 header + 4 CRC32
 
@@ -792,11 +1191,17 @@ class Parser:
             ((layer_flags >> 2) & 0x1) == 0,  # Layer C
         ]
 
-        root_fsid_hex = root_author_id.hex()
-        parent_fsid_hex = parent_author_id.hex()
-        current_fsid_hex = current_author_id.hex()
-
-        self.meta = {
+        self._raw = {
+            "root_fsid": root_author_id,
+            "root_filename": root_filename,
+            "parent_fsid": parent_author_id,
+            "parent_filename": parent_filename,
+            "current_fsid": current_author_id,
+            "current_filename": current_filename,
+        }
+        # The LAZY_META_FIELDS keys hold None until formatted (see meta)
+        self._meta_complete = False
+        self._meta = {
             "lock": flags & 0x1,
             "loop": (flags >> 1) & 0x1,
             "flags": flags,
@@ -808,19 +1213,20 @@ class Parser:
             "creation_timestamp": creation_timestamp + DSI_EPOCH,
             "modified_timestamp": modified_timestamp + DSI_EPOCH,
             "root_username": root_author_name.decode("utf-16-le").rstrip("\x00"),
-            "root_fsid": root_fsid_hex,
-            "root_fsid_ppm": convertKWZFSIDToPPM(root_fsid_hex),
-            "root_filename": _decode_filename(root_filename),
+            "root_fsid": None,
+            "root_fsid_ppm": None,
+            "root_filename": None,
             "parent_username": parent_author_name.decode("utf-16-le").rstrip("\x00"),
-            "parent_fsid": parent_fsid_hex,
-            "parent_fsid_ppm": convertKWZFSIDToPPM(parent_fsid_hex),
-            "parent_filename": _decode_filename(parent_filename),
+            "parent_fsid": None,
+            "parent_fsid_ppm": None,
+            "parent_filename": None,
             "current_username": current_author_name.decode("utf-16-le").rstrip("\x00"),
-            "current_fsid": current_fsid_hex,
-            "current_fsid_ppm": convertKWZFSIDToPPM(current_fsid_hex),
-            "current_filename": _decode_filename(current_filename),
+            "current_fsid": None,
+            "current_fsid_ppm": None,
+            "current_filename": None,
         }
 
+    @metrics.timed("kwz.decode_ksn")
     def _decode_ksn(self):
         """Parse the KSN (sound) section. Matches kwz_process_ksn in kwz.c."""
         section = self.sections["KSN"]
@@ -832,8 +1238,8 @@ class Parser:
 
         self._track_lengths = [bgm_size, se1_size, se2_size, se3_size, se4_size]
 
-        if self.meta is not None:
-            self.meta.update({
+        if self._meta is not None:
+            self._meta.update({
                 "bgm_used": bgm_size > 0,
                 "se1_used": se1_size > 0,
                 "se2_used": se2_size > 0,
@@ -846,6 +1252,7 @@ class Parser:
                 "se4_digest": self._get_track_digest(4),
             })
 
+    @metrics.timed("kwz.decode_kmi")
     def _decode_kmi(self):
         """Parse KMI frame metadata entries. Matches kwz_decode_kmi in kwz.c."""
         self.buffer.seek(self.sections["KMI"]["offset"] + 8)
@@ -889,84 +1296,496 @@ class Parser:
     # Frame decoding
     # -----------------------------------------------------------------------
 
-    def decode_frame(self, index):
+    def decode_frame(self, index, skip_hidden=None, region=None, scale=1):
         """Decode a frame to an RGB numpy array (240, 320, 3) uint8.
 
         Uses C acceleration if available, otherwise pure Python.
         Matches kwz_decode_frame / kwz_decode_frame_alloc in kwz_video.c.
+
+        With skip_hidden, layers that are hidden for the whole note
+        (layer_visibility) are neither decoded nor drawn, and layers that are
+        never given a drawable colour aren't decoded. The native decoder
+        always renders every layer, so by default (None) they are only
+        skipped when decoding in pure Python; skip_hidden=True decodes notes
+        with hidden layers in pure Python even when libugomemo is available.
+
+        region=(x, y, w, h) returns just that crop, shape (h, w, 3). The pure
+        Python decoder then only draws and composites the 8x8 tiles that
+        intersect it; the frame cache is bypassed.
+
+        scale enlarges the frame by an integer factor (nearest neighbour).
+        The palette indices are enlarged before the colour lookup, so there
+        is no full-size RGB intermediate.
         """
         if index < 0 or index >= self._frame_count:
             raise IndexError("Frame index %d out of range [0, %d)" % (index, self._frame_count))
+        self._verify_section("KMC")
+        skip_hidden = self._skip_hidden(skip_hidden)
 
-        # Try native C decode
-        if self._native_ctx is not None:
-            result = _native.native_kwz_decode_frame(self._native_ctx, index)
-            if result is not None:
-                return result
+        scale = check_scale(scale)
+        if region is not None or scale != 1:
+            return indices_to_rgb(self.decode_frame_indexed(index, skip_hidden, region), PALETTE_ARRAY, scale)
+
+        # Without a cache the native RGB output can be returned as-is
+        if self.frame_cache is None:
+            if self._native_usable(index, skip_hidden):
+                result = self._native_decode_frame(index)
+                if result is not None:
+                    return result
+            return self._decode_frame_python(index, skip_hidden)
+
+        return PALETTE_ARRAY[self.decode_frame_indexed(index, skip_hidden)]
+
+    def decode_frames(self, start=0, stop=None, skip_hidden=None, scale=1):
+        """Decode frames start..stop-1 into one (N, 240 * scale, 320 * scale, 3) uint8 array.
+
+        Frames are decoded in order (so diffs are applied incrementally) and
+        written straight into the preallocated output; skip_hidden and scale
+        behave as in decode_frame.
+        """
+        count = self._frame_count
+        stop = count if stop is None else stop
+        if start < 0 or stop > count or start > stop:
+            raise IndexError("Frame range [%d, %d) out of range [0, %d)" % (start, stop, count))
+        scale = check_scale(scale)
+
+        frames = np.empty((stop - start, KWZ_FRAME_HEIGHT * scale, KWZ_FRAME_WIDTH * scale, 3), dtype=np.uint8)
+        for i, index in enumerate(range(start, stop)):
+            indices_to_rgb(self.decode_frame_indexed(index, skip_hidden), PALETTE_ARRAY, scale, out=frames[i])
+        return frames
+
+    def export_gif(self, path, scale=1, loop=None, skip_hidden=None):
+        """Write the animation to path (or a binary file object) as a GIF.
+
+        Frames are written straight from palette indices, one at a time; see
+        flipnote.gif.write_gif.
+        """
+        write_gif(self, path, scale=scale, loop=loop, skip_hidden=skip_hidden)
+
+    def export_y4m(self, path, scale=1, chroma="420jpeg", skip_hidden=None):
+        """Stream the animation to path (or a file object / pipe) as YUV4MPEG2.
+
+        See flipnote.stream.write_y4m.
+        """
+        write_y4m(self, path, scale=scale, chroma=chroma, skip_hidden=skip_hidden)
+
+    def export_wav(self, path, track=0):
+        """Write an audio track to path (or a file object / pipe) as a WAV.
+
+        See flipnote.stream.write_wav.
+        """
+        write_wav(self, path, track)
+
+    def decode_frame_indexed(self, index, skip_hidden=None, region=None):
+        """Decode a frame to a (240, 320) uint8 array of PALETTE indices.
+
+        Uses the frame cache and C acceleration when available. skip_hidden
+        and region behave as in decode_frame.
+        """
+        if index < 0 or index >= self._frame_count:
+            raise IndexError("Frame index %d out of range [0, %d)" % (index, self._frame_count))
+        self._verify_section("KMC")
+        skip_hidden = self._skip_hidden(skip_hidden)
+
+        if region is not None:
+            return self._decode_frame_indexed(index, skip_hidden, region)
+
+        cache = self.frame_cache
+        if cache is not None:
+            key = (self.animation_digest, index, "indexed" if skip_hidden else "indexed-all")
+            pixels = cache.get(key)
+            if pixels is None:
+                pixels = self._decode_frame_indexed(index, skip_hidden)
+                cache.put(key, pixels)
+            return pixels
+        return self._decode_frame_indexed(index, skip_hidden)
+
+    def _decode_frame_indexed(self, index, skip_hidden=True, region=None):
+        if region is None:
+            x, y, w, h = 0, 0, KWZ_FRAME_WIDTH, KWZ_FRAME_HEIGHT
+        else:
+            x, y, w, h = check_region(region, KWZ_FRAME_WIDTH, KWZ_FRAME_HEIGHT)
 
-        return self._decode_frame_python(index)
+        if self._native_usable(index, skip_hidden):
+            result = self._native_decode_frame(index)
+            if result is not None:
+                return rgb_to_indices(result[y:y + h, x:x + w], PALETTE)
+
+        skip, flags = self._layer_skip(index, skip_hidden)
+        self._decode_layers(index, skip, mask=None if region is None else _region_tile_mask(x, y, w, h))
+        rows, cols = slice(y, y + h), slice(x, x + w)
+        pixels = np.empty((h, w), dtype=np.uint8)
+        _composite_frame_indexed(pixels, self._layer_a[rows, cols], self._layer_b[rows, cols],
+                                 self._layer_c[rows, cols], flags)
+        return pixels
+
+    def _skip_hidden(self, skip_hidden):
+        """Resolve a skip_hidden argument: None (the default) skips hidden
+        layers only when frames are decoded in pure Python."""
+        return not self.uses_native if skip_hidden is None else skip_hidden
+
+    def _native_usable(self, index, skip_hidden):
+        """Whether frame index can come from the native decoder. It always
+        renders every layer, so not when skip_hidden would leave a hidden one
+        out; verify still compares the backends on such a frame."""
+        if self._native_ctx is None:
+            if self._native_reason is not None:
+                metrics.fallback("kwz.decode_frame", self._native_reason)
+            return False
+        if skip_hidden and self._unused_layers()[0]:
+            metrics.fallback("kwz.decode_frame", "hidden layers")
+            verifier = self._verifier
+            if verifier is not None and verifier.wants(index):
+                self._native_decode_frame(index)
+            return False
+        return True
+
+    def _native_decode_frame(self, index):
+        """Decode a frame to RGB with libugomemo (None on failure), checking
+        it against the Python decoder if verify samples it."""
+        verifier = self._verifier
+        if verifier is not None and verifier.wants(index):
+            return verifier.check(
+                index,
+                lambda: _native.native_kwz_decode_frame(self._native_ctx, index),
+                lambda: self._decode_frame_python(index, skip_hidden=False),
+            )
+        return _native.native_kwz_decode_frame(self._native_ctx, index)
 
-    def _decode_frame_python(self, index):
+    def _decode_frame_python(self, index, skip_hidden=True):
         """Pure Python frame decode. Decodes all frames from 0..index for correct diffing."""
         output = np.zeros((KWZ_FRAME_HEIGHT, KWZ_FRAME_WIDTH, 3), dtype=np.uint8)
+        skip, flags = self._layer_skip(index, skip_hidden)
+        self._decode_layers(index, skip)
+        _composite_frame(output, self._layer_a, self._layer_b, self._layer_c, flags)
+        return output
+
+    def _unused_layers(self):
+        """Return (hidden, uncoloured) sets of layer numbers (0=A, 1=B, 2=C).
+
+        hidden: switched off in layer_visibility for the whole note.
+        uncoloured: both colour slots are >= 7 (not drawn) in every frame.
+        """
+        if self._unused is None:
+            hidden = {k for k in range(3) if not self._layer_visibility[k]}
+            uncoloured = set()
+            for k in range(3):
+                shift = 8 + 8 * k
+                if all(((e["flags"] >> shift) & 0x0F) >= 7 and ((e["flags"] >> (shift + 4)) & 0x0F) >= 7
+                       for e in self._frame_meta):
+                    uncoloured.add(k)
+            self._unused = (frozenset(hidden), frozenset(uncoloured))
+        return self._unused
+
+    def _layer_skip(self, index, skip_hidden):
+        """Return (layers to leave undecoded, frame flags to composite with)."""
+        flags = self._frame_meta[index]["flags"]
+        if not skip_hidden:
+            return frozenset(), flags
+        hidden, uncoloured = self._unused_layers()
+        # Setting both colour slots to 0xF stops a hidden layer being drawn
+        for k in hidden:
+            flags |= 0xFF << (8 + 8 * k)
+        return hidden | uncoloured, flags
+
+    @metrics.timed("kwz.decode_frame.python")
+    def _decode_layers(self, index, skip=frozenset(), dirty=None, mask=None):
+        """Bring the layer buffers up to frame index, replaying diffs as needed.
+
+        Layers in skip (0=A, 1=B, 2=C) are not decompressed; their buffers are
+        marked stale and rebuilt from frame 0 when next needed.
+
+        With mask, a (1200,) bool array in decode order, only those tiles are
+        drawn. Tiles only ever depend on the same tile of the previous frame,
+        so the buffers stay valid inside the mask and a later decode that
+        needs anything outside it replays from frame 0.
+
+        If dirty is a (1200,) bool array and frame index is decoded directly
+        on top of frame index - 1, it is set to the tiles (in decode order)
+        that may have changed and True is returned. Otherwise returns False.
+        """
+        valid = self._valid_tiles
+        covered = valid is None or (mask is not None and not (mask & ~valid).any())
+        reusable = covered and not (self._stale_layers - skip)
+        if self._prev_decoded_frame == index and reusable:
+            return False
 
         # Determine starting frame for sequential decode
-        if self._prev_decoded_frame >= 0 and self._prev_decoded_frame < index:
+        if self._prev_decoded_frame >= 0 and self._prev_decoded_frame < index and reusable:
             start = self._prev_decoded_frame + 1
+            stale = self._stale_layers | skip
         else:
             start = 0
+            stale = skip
             self._prev_layer_a[:] = 0
             self._prev_layer_b[:] = 0
             self._prev_layer_c[:] = 0
 
+        layers = (
+            (self._layer_a, self._prev_layer_a, "layer_a_size", 0x10),
+            (self._layer_b, self._prev_layer_b, "layer_b_size", 0x20),
+            (self._layer_c, self._prev_layer_c, "layer_c_size", 0x40),
+        )
+
+        if metrics.ENABLED:
+            metrics.count("kwz.frames_decoded", index - start + 1)
+            metrics.count("kwz.frames_replayed", index - start)
+
+        tracked = dirty is not None and mask is None and start == index and index > 0
+        if tracked:
+            dirty[:] = False
+            written = np.empty(KWZ_TILE_COUNT, dtype=bool)
+
         for i in range(start, index + 1):
             entry = self._frame_meta[i]
             flags = entry["flags"]
             offset = self._frame_offsets[i]
 
-            diff_a = not (flags & 0x10)
-            diff_b = not (flags & 0x20)
-            diff_c = not (flags & 0x40)
-
-            la_size = entry["layer_a_size"]
-            lb_size = entry["layer_b_size"]
-            lc_size = entry["layer_c_size"]
-
             # Decompress each layer
-            _decompress_layer(
-                self._layer_a, self._prev_layer_a,
-                self._kmc_data[offset:offset + la_size], la_size, diff_a
-            )
-            offset += la_size
-
-            _decompress_layer(
-                self._layer_b, self._prev_layer_b,
-                self._kmc_data[offset:offset + lb_size], lb_size, diff_b
-            )
-            offset += lb_size
-
-            _decompress_layer(
-                self._layer_c, self._prev_layer_c,
-                self._kmc_data[offset:offset + lc_size], lc_size, diff_c
-            )
+            for k, (layer, prev_layer, size_key, key_flag) in enumerate(layers):
+                size = entry[size_key]
+                if k not in skip:
+                    _decompress_layer(
+                        layer, prev_layer,
+                        self._kmc_data[offset:offset + size], size, not (flags & key_flag),
+                        written if tracked else None, mask
+                    )
+                    if tracked:
+                        dirty |= written
+                offset += size
 
             # Save layers as previous for next frame
             if i < index:
-                np.copyto(self._prev_layer_a, self._layer_a)
-                np.copyto(self._prev_layer_b, self._layer_b)
-                np.copyto(self._prev_layer_c, self._layer_c)
-
-        # Composite final frame
-        _composite_frame(output, self._layer_a, self._layer_b, self._layer_c,
-                         self._frame_meta[index]["flags"])
+                for k, (layer, prev_layer, _size_key, _key_flag) in enumerate(layers):
+                    if k not in skip:
+                        np.copyto(prev_layer, layer)
 
         # Update prev layers for next call
-        np.copyto(self._prev_layer_a, self._layer_a)
-        np.copyto(self._prev_layer_b, self._layer_b)
-        np.copyto(self._prev_layer_c, self._layer_c)
+        for k, (layer, prev_layer, _size_key, _key_flag) in enumerate(layers):
+            if k not in skip:
+                np.copyto(prev_layer, layer)
         self._prev_decoded_frame = index
+        self._stale_layers = stale
+        self._valid_tiles = mask
+        return tracked
+
+    def decode_frame_delta(self, index, skip_hidden=None):
+        """Decode a frame and return only the 8x8 tiles that changed since the
+        frame returned by the previous decode_frame_delta call.
+
+        When frames are requested in order, the tiles the decoder wrote are
+        the only candidates, so the delta costs little beyond the decode
+        itself. Any other order falls back to comparing whole frames. The
+        first call (and the first after reset_delta) sends the full frame.
+
+        Returns a dict with:
+            index: the frame index
+            full: True if rects holds the whole frame as a single rect
+            rects: list of (x, y, pixels), pixels being an RGB uint8 array
+                   (8, 8, 3) for a tile or (240, 320, 3) for a full frame
+        """
+        if index < 0 or index >= self._frame_count:
+            raise IndexError("Frame index %d out of range [0, %d)" % (index, self._frame_count))
+        self._verify_section("KMC")
+        skip_hidden = self._skip_hidden(skip_hidden)
+
+        dirty = None
+        if self._native_ctx is None:
+            if self._native_reason is not None:
+                metrics.fallback("kwz.decode_frame", self._native_reason)
+            skip, flags = self._layer_skip(index, skip_hidden)
+            dirty = np.empty(KWZ_TILE_COUNT, dtype=bool)
+            if not self._decode_layers(index, skip, dirty):
+                dirty = None
+            pixels = np.empty((KWZ_FRAME_HEIGHT, KWZ_FRAME_WIDTH), dtype=np.uint8)
+            _composite_frame_indexed(pixels, self._layer_a, self._layer_b, self._layer_c, flags)
+        else:
+            flags = self._frame_meta[index]["flags"]
+            pixels = self._decode_frame_indexed(index, skip_hidden)
+
+        previous = self._delta_previous
+        self._delta_previous = (index, flags, pixels)
+        if previous is None:
+            return {"index": index, "full": True, "rects": [(0, 0, PALETTE_ARRAY[pixels])]}
+
+        prev_index, prev_flags, prev_pixels = previous
+        if dirty is not None and prev_index == index - 1 and prev_flags == flags:
+            candidates = np.zeros(KWZ_TILE_COUNT, dtype=bool)
+            candidates[TILE_GRID_INDEX[dirty]] = True
+            candidates = np.flatnonzero(candidates)
+        else:
+            candidates = np.arange(KWZ_TILE_COUNT)
 
-        return output
+        # View both frames as a (1200, 8, 8) stack of tiles in row-major order
+        tiles = pixels.reshape(KWZ_TILES_Y, 8, KWZ_TILES_X, 8).swapaxes(1, 2).reshape(-1, 8, 8)
+        prev_tiles = prev_pixels.reshape(KWZ_TILES_Y, 8, KWZ_TILES_X, 8).swapaxes(1, 2).reshape(-1, 8, 8)
+        changed = candidates[(tiles[candidates] != prev_tiles[candidates]).any(axis=(1, 2))]
+
+        rgb = PALETTE_ARRAY[tiles[changed]]
+        rects = [(int(t % KWZ_TILES_X) * 8, int(t // KWZ_TILES_X) * 8, rgb[i])
+                 for i, t in enumerate(changed)]
+        return {"index": index, "full": False, "rects": rects}
+
+    def reset_delta(self):
+        """Forget the previous frame so the next decode_frame_delta sends a full frame."""
+        self._delta_previous = None
+
+    # -----------------------------------------------------------------------
+    # Bitstream analysis
+    # -----------------------------------------------------------------------
+
+    def get_frame_activity(self, index, skip_hidden=True):
+        """Per-frame change statistics read from the tile stream, without decoding pixels.
+
+        A tile counts as changed unless every layer left it as it was: type 5
+        (copy from previous frame) always keeps it, type 6 (no-op) keeps it on
+        a diff layer. With skip_hidden, layers that never reach the output are
+        ignored.
+
+        Returns a dict with:
+            tile_counts: (3, 8) int array of tile type counts per layer (A, B, C)
+            dirty_tiles: (30, 40) bool array of tiles that may have changed
+            score: fraction of tiles that may have changed (0.0 - 1.0)
+            palette_changed: True if the frame's colours differ from the previous frame
+        """
+        if index < 0 or index >= self._frame_count:
+            raise IndexError("Frame index %d out of range [0, %d)" % (index, self._frame_count))
+        self._verify_section("KMC")
+
+        entry = self._frame_meta[index]
+        flags = entry["flags"]
+        offset = self._frame_offsets[index]
+        ignored = frozenset()
+        if skip_hidden:
+            hidden, uncoloured = self._unused_layers()
+            ignored = hidden | uncoloured
+
+        tile_counts = np.zeros((3, 8), dtype=np.int64)
+        dirty = np.zeros(KWZ_TILE_COUNT, dtype=bool)
+
+        for k, (size_key, key_flag) in enumerate((("layer_a_size", 0x10),
+                                                  ("layer_b_size", 0x20),
+                                                  ("layer_c_size", 0x40))):
+            size = entry[size_key]
+            types = _scan_layer_tiles(self._kmc_data[offset:offset + size], size)
+            offset += size
+            tile_counts[k] = np.bincount(types, minlength=8)
+            if k in ignored:
+                continue
+            if flags & key_flag:
+                dirty[TILE_GRID_INDEX[types != 5]] = True
+            else:
+                dirty[TILE_GRID_INDEX[types < 5]] = True
+                dirty[TILE_GRID_INDEX[types == 7]] = True
+
+        prev_flags = self._frame_meta[index - 1]["flags"] if index > 0 else flags
+        return {
+            "tile_counts": tile_counts,
+            "dirty_tiles": dirty.reshape(KWZ_TILES_Y, KWZ_TILES_X),
+            "score": float(dirty.mean()),
+            "palette_changed": (flags & 0xFFFFFF0F) != (prev_flags & 0xFFFFFF0F),
+        }
+
+    def get_activity_scores(self, skip_hidden=True):
+        """Activity score (fraction of tiles that may have changed) for every frame."""
+        return np.array([self.get_frame_activity(i, skip_hidden)["score"]
+                         for i in range(self._frame_count)], dtype=np.float64)
+
+    # -----------------------------------------------------------------------
+    # Validation
+    # -----------------------------------------------------------------------
+
+    @property
+    def uses_native(self):
+        """True when frames and audio are decoded by libugomemo."""
+        return self._native_ctx is not None
+
+    def verify_report(self):
+        """Differential check results when opened with verify (see
+        flipnote._native.FrameVerifier.report), or None."""
+        if self._verifier is None:
+            return None
+        return self._verifier.report()
+
+    def validate(self, check_crc=False):
+        """Structural problems with the loaded file (see flipnote.kwz.validate)."""
+        self.buffer.seek(0)
+        return validate(self.buffer.read(), check_crc)
+
+    @contextlib.contextmanager
+    def _file_view(self):
+        """Memoryview of the whole file, without a copy when the buffer is a BytesIO."""
+        getbuffer = getattr(self.buffer, "getbuffer", None)
+        if getbuffer is None:
+            self.buffer.seek(0)
+            yield memoryview(self.buffer.read())
+        else:
+            with getbuffer() as view:
+                yield view
+
+    def _crc_entry(self, data, name):
+        section = self.sections[name]
+        offset, length = section["offset"], section["length"]
+        entry = {"offset": offset, "length": length, "stored": None, "computed": None, "ok": None}
+        if name == "KMI":
+            return entry  # KMI carries no CRC32
+        if (length < (KWZ_KSN_HEADER_SIZE if name == "KSN" else 4)
+                or offset + 8 + length > len(data) - KWZ_SIGNATURE_SIZE):
+            entry["ok"] = False
+        else:
+            entry["stored"], entry["computed"] = _section_crc(data, name, offset, length)
+            entry["ok"] = entry["stored"] == entry["computed"]
+        return entry
+
+    def _verify_section(self, name):
+        """With verify_crc, check a section's CRC32 the first time it is used."""
+        if not self.verify_crc or name not in self.sections:
+            return
+        entry = self._crc_report.get(name)
+        if entry is None:
+            with self._file_view() as data:
+                entry = self._crc_report[name] = self._crc_entry(data, name)
+        if entry["ok"] is False:
+            if entry["stored"] is None:
+                raise ValueError("KWZ %s section is truncated" % name)
+            raise ValueError("KWZ %s section CRC32 mismatch (stored %08X, computed %08X)"
+                             % (name, entry["stored"], entry["computed"]))
+
+    def verify_sections(self, sections=None, workers=1):
+        """Check section CRC32s in bulk and return a per-section report.
+
+        sections defaults to every section in the file. Results are shared
+        with the lazy verify_crc checks, so no section is hashed twice. With
+        workers > 1, sections of at least KWZ_CRC_PARALLEL_SIZE bytes are
+        hashed on a thread pool (zlib.crc32 releases the GIL on large buffers).
+        Mismatches are reported, not raised.
+
+        Returns a dict mapping each section name to a dict with:
+            offset, length: position and size of the section
+            stored, computed: CRC32 values (None for KMI, which has none,
+                              or for a truncated section)
+            ok: True, False, or None when there is nothing to check
+        """
+        names = list(self.sections) if sections is None else list(sections)
+        for name in names:
+            if name not in self.sections:
+                raise ValueError("No %s section in this file" % (name,))
+
+        pending = [name for name in names if name not in self._crc_report]
+        if pending:
+            with self._file_view() as data:
+                large = [name for name in pending if self.sections[name]["length"] >= KWZ_CRC_PARALLEL_SIZE]
+                if workers <= 1 or len(large) < 2:
+                    large = []
+                for name in pending:
+                    if name not in large:
+                        self._crc_report[name] = self._crc_entry(data, name)
+                if large:
+                    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flipnote-crc") as pool:
+                        entries = list(pool.map(lambda name: self._crc_entry(data, name), large))
+                    self._crc_report.update(zip(large, entries))
+
+        return {name: dict(self._crc_report[name]) for name in names}
 
     # -----------------------------------------------------------------------
     # Thumbnail
@@ -974,6 +1793,7 @@ class Parser:
 
     def get_thumbnail(self):
         """Return raw thumbnail bytes from the KTN section."""
+        self._verify_section("KTN")
         section = self.sections["KTN"]
         self.buffer.seek(section["offset"] + 12)  # 8 header + 4 CRC32
         return self.buffer.read(section["length"] - 4)
@@ -1000,6 +1820,10 @@ class Parser:
         """Return the raw compressed audio bytes for a track."""
         if not self.has_audio_track(track):
             return b""
+        self._verify_section("KSN")
+        return self._read_audio_track(track)
+
+    def _read_audio_track(self, track):
         size = self._track_lengths[track]
         self.buffer.seek(self._get_audio_track_offset(track))
         return self.buffer.read(size)
@@ -1007,7 +1831,7 @@ class Parser:
     def _get_track_digest(self, track):
         """Compute MD5 hex digest of raw audio track data."""
         if self.has_audio_track(track):
-            return md5(self.get_audio_track_raw(track)).hexdigest()
+            return md5(self._read_audio_track(track)).hexdigest()
         return None
 
     def decode_audio_track(self, track, step_index=0):
@@ -1025,12 +1849,15 @@ class Parser:
         """
         if not self.has_audio_track(track):
             return np.array([], dtype=np.int16)
+        self._verify_section("KSN")
 
         # Try native C decode
         if self._native_ctx is not None:
             result = _native.native_kwz_decode_track(self._native_ctx, track, step_index)
             if result is not None:
                 return result
+        elif self._native_reason is not None:
+            metrics.fallback("kwz.decode_audio", self._native_reason)
 
         raw = self.get_audio_track_raw(track)
         return _decode_audio_track(raw, step_index)
@@ -0,0 +1,256 @@
+"""
+Lineage graph of notes, linking each note to the one it was edited from.
+
+Built from bulk metadata (formats.note_metadata records, archive.iter_metadata,
+or the rows of a flipnote.catalog.Catalog), keyed by filename: a note's
+parent is its parent_filename, so notes only seen as a parent still get a
+node. The graph is held in integer arrays indexed by node id:
+
+    parents   parent node, -1 for roots
+    authors   current author, an index into fsids (-1 if unknown)
+    preorder  nodes in depth-first order; a subtree is a contiguous slice,
+              so subtree and ancestor tests are O(1) range checks
+    tops      root node of each node's tree
+
+FSIDs are normalised to PPM form with schema.convertKWZFSIDToPPM, so PPM
+and KWZ notes by the same author match.
+
+    from flipnote.lineage import Lineage
+
+    lineage = Lineage.build(catalog)
+    lineage.parent("F3A1B2_0123456789ABC_001")
+    lineage.subtree(lineage.root("F3A1B2_0123456789ABC_001"))
+"""
+
+import numpy as np
+
+from flipnote.schema import convertKWZFSIDToPPM
+
+
+class Lineage:
+    """Parent/child graph of note filenames in integer arrays.
+
+    Use Lineage.build or Lineage.load rather than the constructor.
+    """
+
+    def __init__(self, names, parents, authors, fsids, _index=None):
+        self.names = list(names)
+        self.fsids = list(fsids)
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.authors = np.asarray(authors, dtype=np.int32)
+        self._index = _index if _index is not None else {name: i for i, name in enumerate(self.names)}
+        self._fsid_index = {fsid: i for i, fsid in enumerate(self.fsids)}
+        if not self._build_tree():
+            self._break_cycles()
+            self._build_tree()
+
+    @classmethod
+    def build(cls, records):
+        """Build a lineage from an iterable of metadata dicts.
+
+        Each record needs current_filename and may have parent_filename,
+        current_author_id and parent_author_id (as in formats.note_metadata).
+        A parent_filename equal to current_filename (an unedited original)
+        means no parent. Later records override earlier ones for the same
+        filename.
+        """
+        index = {}
+        names = []
+        parents = []
+        authors = []
+        fsid_index = {}
+        fsids = []
+
+        def node(name):
+            i = index.get(name)
+            if i is None:
+                i = index[name] = len(names)
+                names.append(name)
+                parents.append(-1)
+                authors.append(-1)
+            return i
+
+        raw_authors = {}  # Each distinct raw ID is normalised once
+
+        def author(raw):
+            i = raw_authors.get(raw)
+            if i is None:
+                fsid = convertKWZFSIDToPPM(raw)
+                i = fsid_index.get(fsid)
+                if i is None:
+                    i = fsid_index[fsid] = len(fsids)
+                    fsids.append(fsid)
+                raw_authors[raw] = i
+            return i
+
+        for record in records:
+            current = record.get("current_filename")
+            if not current:
+                continue
+            i = node(current)
+            if record.get("current_author_id"):
+                authors[i] = author(record["current_author_id"])
+            parent = record.get("parent_filename")
+            if parent and parent != current:
+                p = parents[i] = node(parent)
+                # A parent that isn't in the scan still gets its author from the child
+                if authors[p] < 0 and record.get("parent_author_id"):
+                    authors[p] = author(record["parent_author_id"])
+
+        return cls(names, parents, authors, fsids, index)
+
+    # -- Construction ---------------------------------------------------------
+
+    def _break_cycles(self):
+        """Cut one link of every parent cycle (corrupt or forged metadata)."""
+        parents = self.parents.tolist()
+        state = [0] * len(parents)  # 0 unseen, 1 on the current walk, 2 done
+        cut = False
+        for start in range(len(parents)):
+            walk = []
+            v = start
+            while v >= 0 and state[v] == 0:
+                state[v] = 1
+                walk.append(v)
+                v = parents[v]
+            if v >= 0 and state[v] == 1:
+                parents[v] = -1
+                cut = True
+            for u in walk:
+                state[u] = 2
+        if cut:
+            self.parents = np.array(parents, dtype=np.int32)
+
+    def _build_tree(self):
+        """Children in CSR form, then the depth-first order, subtree sizes and roots.
+
+        Works a tree level at a time with array operations. Returns False if
+        some nodes are unreachable from a root (they sit on a parent cycle).
+        """
+        count = len(self.names)
+        parents = self.parents
+        has_parent = parents >= 0
+
+        # Children of node i are child_nodes[child_offsets[i]:child_offsets[i + 1]]
+        order = np.argsort(parents, kind="stable")
+        self.child_nodes = order[np.count_nonzero(~has_parent):].astype(np.int32)
+        self.child_offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parents[has_parent], minlength=count), out=self.child_offsets[1:])
+
+        # Breadth-first levels; each level lists the children of the previous
+        # one grouped by parent, in sibling order
+        levels = [np.flatnonzero(~has_parent).astype(np.int32)]
+        group_sizes = [None]
+        reached = levels[0].size
+        while True:
+            frontier = levels[-1]
+            starts = self.child_offsets[frontier]
+            counts = self.child_offsets[frontier + 1] - starts
+            total = int(counts.sum())
+            if not total:
+                break
+            first = np.cumsum(counts) - counts
+            levels.append(self.child_nodes[np.repeat(starts - first, counts) + np.arange(total)])
+            group_sizes.append(counts[counts > 0])
+            reached += total
+        if reached < count:
+            return False
+
+        sizes = np.ones(count, dtype=np.int64)
+        for level in reversed(levels[1:]):
+            sizes += np.bincount(parents[level], weights=sizes[level], minlength=count).astype(np.int64)
+
+        # A node's depth-first position is its parent's + 1 + the sizes of its
+        # earlier siblings' subtrees
+        positions = np.empty(count, dtype=np.int64)
+        tops = np.empty(count, dtype=np.int32)
+        roots = levels[0]
+        positions[roots] = np.cumsum(sizes[roots]) - sizes[roots]
+        tops[roots] = roots
+        for level, groups in zip(levels[1:], group_sizes[1:]):
+            level_sizes = sizes[level]
+            before = np.cumsum(level_sizes) - level_sizes
+            group_start = np.repeat(before[np.cumsum(groups) - groups], groups)
+            positions[level] = positions[parents[level]] + 1 + before - group_start
+            tops[level] = tops[parents[level]]
+
+        self.preorder = np.empty(count, dtype=np.int32)
+        self.preorder[positions] = np.arange(count, dtype=np.int32)
+        self.positions = positions.astype(np.int32)
+        self.sizes = sizes.astype(np.int32)
+        self.tops = tops
+        return True
+
+    # -- Persistence ----------------------------------------------------------
+
+    def save(self, path):
+        """Write the graph to path as a compressed .npz."""
+        np.savez_compressed(path, names=np.array(self.names, dtype=str), parents=self.parents,
+                            authors=self.authors, fsids=np.array(self.fsids, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        """Read a graph written by save."""
+        with np.load(path) as data:
+            return cls(data["names"].tolist(), data["parents"], data["authors"], data["fsids"].tolist())
+
+    # -- Queries --------------------------------------------------------------
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def node(self, name):
+        """Node id of a filename; raises KeyError if it isn't in the graph."""
+        return self._index[name]
+
+    def parent(self, name):
+        """Filename of the note name was edited from, or None."""
+        p = self.parents[self.node(name)]
+        return None if p < 0 else self.names[p]
+
+    def children(self, name):
+        """Filenames of the notes edited directly from name."""
+        i = self.node(name)
+        return [self.names[c] for c in self.child_nodes[self.child_offsets[i]:self.child_offsets[i + 1]]]
+
+    def ancestors(self, name):
+        """Filenames from name's parent up to its root, nearest first."""
+        out = []
+        p = self.parents[self.node(name)]
+        while p >= 0:
+            out.append(self.names[p])
+            p = self.parents[p]
+        return out
+
+    def root(self, name):
+        """Filename of the original note name descends from (name itself for a root)."""
+        return self.names[self.tops[self.node(name)]]
+
+    def subtree_nodes(self, name):
+        """Node ids of name and all its descendants, in depth-first order."""
+        i = self.node(name)
+        start = self.positions[i]
+        return self.preorder[start:start + self.sizes[i]]
+
+    def subtree(self, name):
+        """Filenames of name and all its descendants, in depth-first order."""
+        return [self.names[i] for i in self.subtree_nodes(name)]
+
+    def descendant_count(self, name):
+        return int(self.sizes[self.node(name)]) - 1
+
+    def is_ancestor(self, ancestor, name):
+        """True if name descends (directly or not) from ancestor."""
+        a, v = self.node(ancestor), self.node(name)
+        start = self.positions[a]
+        return a != v and start <= self.positions[v] < start + self.sizes[a]
+
+    def by_author(self, fsid):
+        """Filenames of the notes whose author has this FSID (PPM or KWZ form)."""
+        i = self._fsid_index.get(convertKWZFSIDToPPM(fsid))
+        if i is None:
+            return []
+        return [self.names[v] for v in np.flatnonzero(self.authors == i)]
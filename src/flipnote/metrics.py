@@ -0,0 +1,115 @@
+"""
+Opt-in instrumentation for parsing and decoding.
+
+Counts and times file opens, each parse stage, frame and audio decodes per
+backend (native libugomemo or pure Python), frames replayed to resolve diff
+chains, bytes read, and every time a decode falls back from the native
+library to Python, with the reason:
+
+    from flipnote import metrics
+
+    metrics.enable()
+    note = KWZ.open("animation.kwz")
+    note.decode_frame(10)
+    print(metrics.snapshot()["fallbacks"])  # {"kwz.decode_frame": {"native library not available": 1}}
+
+Recording is off by default. While disabled, instrumented functions only
+pay for one global flag check. Statistics are process-wide and thread-safe.
+"""
+
+import functools
+import threading
+import time
+
+ENABLED = False
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}    # name -> [count, total seconds, max seconds]
+_fallbacks = {}  # operation -> {reason: count}
+
+
+def enable():
+    """Start recording."""
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    """Stop recording (collected statistics are kept)."""
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """Clear all collected statistics."""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+        _fallbacks.clear()
+
+
+def count(name, n=1):
+    """Add n to a counter."""
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def add_time(name, seconds):
+    """Record one timed call of name."""
+    if ENABLED:
+        with _lock:
+            entry = _timings.get(name)
+            if entry is None:
+                _timings[name] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                if seconds > entry[2]:
+                    entry[2] = seconds
+
+
+def fallback(operation, reason):
+    """Record that operation ran in pure Python instead of the native library."""
+    if ENABLED:
+        with _lock:
+            reasons = _fallbacks.setdefault(operation, {})
+            reasons[reason] = reasons.get(reason, 0) + 1
+
+
+def timed(name):
+    """Decorator recording the call count and cumulative time of a function."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    """All statistics as a plain dict.
+
+    Returns a dict with:
+        enabled: whether recording is on
+        counters: {name: count}
+        timings: {name: {"count", "total", "mean", "max"}} in seconds
+        fallbacks: {operation: {reason: count}}
+    """
+    with _lock:
+        return {
+            "enabled": ENABLED,
+            "counters": dict(_counters),
+            "timings": {
+                name: {"count": n, "total": total, "mean": total / n, "max": peak}
+                for name, (n, total, peak) in _timings.items()
+            },
+            "fallbacks": {operation: dict(reasons) for operation, reasons in _fallbacks.items()},
+        }
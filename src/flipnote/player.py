@@ -0,0 +1,253 @@
+"""
+Real-time playback helper.
+
+Player decodes frames ahead of the consumer on a background thread into a
+bounded queue and hands them out paced by the note's framerate:
+
+    from flipnote.player import Player
+
+    with Player(parser) as player:
+        for index, frame in player:
+            show(frame)
+
+When decoding falls behind, frames are either dropped to catch up with the
+clock (behind="drop") or the last frame is shown again until the next one is
+ready (behind="duplicate"). metrics() reports decode latency, presentation
+lateness, queue depth and dropped/duplicated frame counts.
+
+The parser must not be used by anything else while a Player owns it.
+"""
+
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class Player:
+    """Prefetching, framerate-paced frame source for one parser."""
+
+    def __init__(self, parser, queue_size=8, loop=False, behind="drop", decode=None,
+                 framerate=None, clock=time.monotonic, sleep=time.sleep):
+        if behind not in ("drop", "duplicate"):
+            raise ValueError("behind must be 'drop' or 'duplicate', got %r" % (behind,))
+        self.parser = parser
+        self.loop = loop
+        self.behind = behind
+        self.framerate = parser.framerate if framerate is None else framerate
+        self._decode = decode or parser.decode_frame
+        self._clock = clock
+        self._sleep = sleep
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+
+        self._start_time = None
+        self._slot = 0
+        self._last = None
+        self._finished = False
+
+        self.frames_decoded = 0
+        self.frames_presented = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self._skipped = 0
+        self._decode_total = 0.0
+        self._decode_max = 0.0
+        self._late_total = 0.0
+        self._late_max = 0.0
+        self._depth_total = 0
+        self._depth_max = 0
+
+    # -- Lifecycle -------------------------------------------------------------
+
+    def start(self):
+        """Start the background decoder."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="flipnote-player", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the decoder thread and discard any queued frames.
+
+        The player is finished afterwards: next_frame raises StopIteration.
+        """
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._finished = True
+        # Wake a consumer blocked waiting for the next frame
+        try:
+            self._queue.put_nowait(_END)
+        except queue.Full:
+            pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _period(self):
+        return 1.0 / self.framerate if self.framerate > 0 else 0.0
+
+    def _run(self):
+        period = self._period()
+        count = self.parser.frame_count
+        seq = 0
+        try:
+            while not self._stop.is_set():
+                for index in range(count):
+                    # In drop mode, don't spend time on frames whose slot has
+                    # already passed; a later decode replays any diffs they carry
+                    start = self._start_time
+                    if self.behind == "drop" and start is not None and period and index < count - 1 \
+                            and self._clock() > start + (seq + 1) * period:
+                        self._skipped += 1
+                        seq += 1
+                        continue
+                    began = self._clock()
+                    frame = self._decode(index)
+                    elapsed = self._clock() - began
+                    self.frames_decoded += 1
+                    self._decode_total += elapsed
+                    self._decode_max = max(self._decode_max, elapsed)
+                    if not self._put((seq, index, frame)):
+                        return
+                    seq += 1
+                if not self.loop:
+                    break
+        except Exception as e:
+            self._error = e
+        self._put(_END)
+
+    # -- Consumer side ---------------------------------------------------------
+
+    def _take(self, block):
+        """Next queued (seq, index, frame), or None once the decoder has finished."""
+        item = self._queue.get(block=block)
+        if item is _END:
+            self._finished = True
+            return None
+        return item
+
+    def _end(self):
+        if self._error is not None:
+            raise self._error
+        raise StopIteration
+
+    def next_frame(self):
+        """Wait until the next frame is due and return (index, frame).
+
+        Raises StopIteration at the end of a non-looping note or once the
+        player has been stopped.
+        """
+        if self._finished:
+            self._end()
+        self.start()
+
+        depth = self._queue.qsize()
+        self._depth_total += depth
+        self._depth_max = max(self._depth_max, depth)
+
+        if self._start_time is None:
+            item = self._take(block=True)
+            if item is None:
+                self._end()
+            self._start_time = self._clock()
+            return self._present(item, 0.0)
+
+        period = self._period()
+
+        if self.behind == "duplicate":
+            # Fixed cadence: each call is one slot, repeating the last frame
+            # whenever the next one isn't ready in time
+            due = self._start_time + self._slot * period
+            now = self._clock()
+            if now < due:
+                self._sleep(due - now)
+            try:
+                item = self._take(block=False)
+            except queue.Empty:
+                self.duplicated += 1
+                self._slot += 1
+                self.frames_presented += 1
+                return self._last[1:]
+            if item is None:
+                self._end()
+            return self._present(item, max(0.0, self._clock() - due))
+
+        # Drop mode: frame seq is due at start + seq * period; skip frames that
+        # are a whole period late when a newer one is already waiting
+        item = self._take(block=True)
+        while item is not None and period and \
+                self._clock() - (self._start_time + item[0] * period) >= period:
+            try:
+                newer = self._take(block=False)
+            except queue.Empty:
+                break
+            if newer is None:
+                break
+            self.dropped += 1
+            item = newer
+        if item is None:
+            self._end()
+
+        due = self._start_time + item[0] * period
+        now = self._clock()
+        if now < due:
+            self._sleep(due - now)
+        return self._present(item, max(0.0, self._clock() - due))
+
+    def _present(self, item, lateness):
+        self._late_total += lateness
+        self._late_max = max(self._late_max, lateness)
+        self._slot += 1
+        self.frames_presented += 1
+        self._last = item
+        return item[1:]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next_frame()
+
+    # -- Metrics ---------------------------------------------------------------
+
+    def metrics(self):
+        """Playback statistics as a dict (times in seconds)."""
+        decoded = self.frames_decoded
+        presented = self.frames_presented
+        return {
+            "framerate": self.framerate,
+            "frames_decoded": decoded,
+            "frames_presented": presented,
+            "dropped": self.dropped + self._skipped,
+            "duplicated": self.duplicated,
+            "queue_depth": self._queue.qsize(),
+            "queue_depth_avg": self._depth_total / presented if presented else 0.0,
+            "queue_depth_max": self._depth_max,
+            "decode_latency_avg": self._decode_total / decoded if decoded else 0.0,
+            "decode_latency_max": self._decode_max,
+            "lateness_avg": self._late_total / presented if presented else 0.0,
+            "lateness_max": self._late_max,
+        }
@@ -1,14 +1,20 @@
 import struct
 import numpy as np
+from hashlib import blake2b, md5
 from datetime import datetime, timezone
 
+from flipnote import metrics
+from flipnote.gif import write_gif
+from flipnote.stream import write_wav, write_y4m
+from flipnote._palette import check_region, check_scale, indices_to_rgb, palette_array, rgb_to_indices
+
 try:
     from flipnote._native import (
         NATIVE_AVAILABLE,
-        native_ppm_open,
         native_ppm_close,
         native_ppm_decode_frame,
         native_ppm_decode_track,
+        open_context,
     )
 except ImportError:
     NATIVE_AVAILABLE = False
@@ -19,6 +25,12 @@ PPM_FRAME_WIDTH = 256
 PPM_FRAME_HEIGHT = 192
 PPM_THUMBNAIL_WIDTH = 64
 PPM_THUMBNAIL_HEIGHT = 48
+PPM_THUMBNAIL_OFFSET = 0xA0
+PPM_THUMBNAIL_SIZE = PPM_THUMBNAIL_WIDTH * PPM_THUMBNAIL_HEIGHT // 2
+PPM_ANIMATION_HEADER_OFFSET = 0x6A0
+PPM_SIGNATURE_SIZE = 144  # 128-byte RSA signature + 16 bytes padding
+PPM_SIGNATURE_PADDING = 16
+PPM_AUDIO_SAMPLE_RATE = 8192
 
 DSI_EPOCH = 946706400  # Seconds since January 1 2000 00:00 UTC
 
@@ -45,6 +57,7 @@ THUMBNAIL_PALETTE = [
     (0x00, 0xFF, 0x00),
     (0x00, 0xFF, 0x00),
 ]
+THUMBNAIL_PALETTE_ARRAY = palette_array(THUMBNAIL_PALETTE)
 
 # Paper color by index (0 = black, 1 = white)
 PAPER_COLORS = [
@@ -66,6 +79,11 @@ WHITE = (0xFF, 0xFF, 0xFF)
 RED = (0xFF, 0x2A, 0x2A)
 BLUE = (0x0A, 0x39, 0xFF)
 
+# Every colour a decoded frame can use; decode_frame_indexed returns indices
+# into this table (paper colours first, matching PAPER_COLORS)
+FRAME_PALETTE = [BLACK, WHITE, RED, BLUE]
+FRAME_PALETTE_ARRAY = palette_array(FRAME_PALETTE)
+
 # -- ADPCM tables -------------------------------------------------------------
 
 ADPCM_STEP_TABLE = np.array([
@@ -91,6 +109,9 @@ ADPCM_INDEX_TABLE_4BIT = np.array([
     -1, -1, -1, -1,  2,  4,  6,  8,
 ], dtype=np.int8)
 
+# Bit offsets of the four 2-bit line encodings packed in each byte
+LINE_ENCODING_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+
 # -- Helpers ------------------------------------------------------------------
 
 
@@ -100,7 +121,12 @@ def _round_up_mult_4(n):
 
 def _decode_fsid(data):
     """8 bytes LE u64, rendered as reversed-byte uppercase hex (16 chars)."""
-    return "".join("%02X" % b for b in reversed(data))
+    return data[::-1].hex().upper()
+
+
+def _fsid_int(data):
+    """8-byte FSID as the integer its hex form spells, or None."""
+    return None if data is None else int.from_bytes(data, "little")
 
 
 def _decode_filename(data):
@@ -123,34 +149,48 @@ def _decode_filename(data):
 
 def _decode_filename_fragment(data):
     """8-byte root filename fragment: MAC(3)_first-5-bytes-as-hex."""
-    parts = []
-    for i, b in enumerate(data):
-        if i == 3:
-            parts.append("_")
-        parts.append("%02X" % b)
-    return "".join(parts)
+    return "%s_%s" % (data[:3].hex().upper(), data[3:].hex().upper())
+
+
+def _thumbnail_indices(raw):
+    """Decode (N, 1536) uint8 thumbnail bytes to (N, 48, 64) THUMBNAIL_PALETTE indices.
+
+    Each byte holds two 4-bit pixels (low nibble first). Bytes run through
+    8x8 tiles left to right, top to bottom, with the image stored upside down.
+    """
+    count = raw.shape[0]
+    pixels = np.empty((count, PPM_THUMBNAIL_SIZE, 2), dtype=np.uint8)
+    np.bitwise_and(raw, 0x0F, out=pixels[:, :, 0])
+    np.right_shift(raw, 4, out=pixels[:, :, 1])
+    # (tile_y, tile_x, line, pixel) -> (tile_y, line, tile_x, pixel)
+    tiles = pixels.reshape(count, PPM_THUMBNAIL_HEIGHT // 8, PPM_THUMBNAIL_WIDTH // 8, 8, 8)
+    image = tiles.transpose(0, 1, 3, 2, 4).reshape(count, PPM_THUMBNAIL_HEIGHT, PPM_THUMBNAIL_WIDTH)
+    return image[:, ::-1]
 
 
 def _unpack_line_encodings(data_48):
     """Unpack 48 bytes into 192 2-bit line encoding values."""
-    enc = np.empty(192, dtype=np.uint8)
-    for i in range(48):
-        byte = data_48[i]
-        for b in range(0, 8, 2):
-            idx = i * 4 + b // 2
-            if idx < 192:
-                enc[idx] = (byte >> b) & 3
-    return enc
-
-
-def _decompress_layer(data, offset, line_encodings):
-    """Decompress a single PPM layer from frame data. Returns (layer, new_offset)."""
+    packed = np.frombuffer(bytes(data_48[:48]), dtype=np.uint8)
+    return ((packed[:, None] >> LINE_ENCODING_SHIFTS) & 3).reshape(192)
+
+
+def _decompress_layer(data, offset, line_encodings, rows=None):
+    """Decompress a single PPM layer from frame data. Returns (layer, new_offset).
+
+    If rows is a (192,) bool array, only those rows are decoded; the others
+    are skipped over and left empty.
+    """
     layer = np.zeros((PPM_FRAME_HEIGHT, PPM_FRAME_WIDTH), dtype=np.uint8)
     pos = offset
 
     for y in range(PPM_FRAME_HEIGHT):
         encoding = line_encodings[y]
-        if encoding == 0:
+        if rows is not None and not rows[y]:
+            if encoding == 1 or encoding == 2:
+                pos += 4 + bin(struct.unpack_from(">I", data, pos)[0]).count("1")
+            elif encoding == 3:
+                pos += PPM_FRAME_WIDTH // 8
+        elif encoding == 0:
             # Empty line -- already zero
             pass
         elif encoding == 1 or encoding == 2:
@@ -182,6 +222,31 @@ def _decompress_layer(data, offset, line_encodings):
     return layer, pos
 
 
+def _skip_layer(data, offset, line_encodings):
+    """Return the offset just past a compressed layer without decoding it."""
+    pos = offset
+    for encoding in line_encodings:
+        if encoding == 1 or encoding == 2:
+            chunk_flags = struct.unpack_from(">I", data, pos)[0]
+            pos += 4 + bin(chunk_flags).count("1")
+        elif encoding == 3:
+            pos += PPM_FRAME_WIDTH // 8
+    return pos
+
+
+def _frame_end(data, offset):
+    """Return the offset just past the encoded frame starting at offset."""
+    header = data[offset]
+    pos = offset + 1
+    if not (header >> 7) & 1 and (header >> 5) & 3:
+        pos += 2  # Translation
+    line_enc_1 = _unpack_line_encodings(data[pos:pos + 48])
+    line_enc_2 = _unpack_line_encodings(data[pos + 48:pos + 96])
+    pos = _skip_layer(data, pos + 96, line_enc_1)
+    return _skip_layer(data, pos, line_enc_2)
+
+
+@metrics.timed("ppm.decode_audio.python")
 def _decode_adpcm(data, offset, length):
     """Decode IMA ADPCM audio with reversed nibbles. Returns numpy int16 array."""
     if length < 4:
@@ -243,18 +308,33 @@ def _decode_adpcm(data, offset, length):
 class Parser:
     """PPM (Flipnote Studio DSi) file parser."""
 
+    audio_sample_rate = PPM_AUDIO_SAMPLE_RATE
+
     @classmethod
-    def open(cls, path):
-        """Open a .ppm file from a filesystem path."""
+    @metrics.timed("ppm.open")
+    def open(cls, path, cache=None, backend="auto", verify=0.0):
+        """Open a .ppm file from a filesystem path.
+
+        cache is an optional flipnote.cache.FrameCache for decoded frames;
+        backend and verify are as in load.
+        """
         instance = cls()
         instance._path = path
-        instance.load(builtins_open(path, "rb"))
+        instance.frame_cache = cache
+        instance.load(builtins_open(path, "rb"), backend, verify)
         return instance
 
     def __init__(self):
         self.stream = None
         self._path = None
         self._native_ctx = None
+        self._native_reason = None  # Why _native_ctx is None, for metrics
+        self._verifier = None
+        self._animation_digest = None
+        self._frame_spans = None
+
+        # Optional decoded-frame cache (flipnote.cache.FrameCache)
+        self.frame_cache = None
 
         # Metadata fields
         self.lock = None
@@ -262,12 +342,15 @@ class Parser:
         self.current_author_name = None
         self.parent_author_name = None
         self.root_author_name = None
-        self.current_author_id = None
-        self.parent_author_id = None
-        self.root_author_id = None
-        self.current_filename = None
-        self.parent_filename = None
-        self.root_filename_fragment = None
+        # FSIDs and filenames are kept as the raw bytes from the file and
+        # only formatted as strings when read (see _format)
+        self.current_author_id_raw = None
+        self.parent_author_id_raw = None
+        self.root_author_id_raw = None
+        self.current_filename_raw = None
+        self.parent_filename_raw = None
+        self.root_filename_fragment_raw = None
+        self._formatted = {}
         self.timestamp = None
 
         # Header fields
@@ -300,9 +383,23 @@ class Parser:
         self.layers = None
         self.prev_layers = None
         self.prev_frame_index = -1
-
-    def load(self, stream):
-        """Load and parse a PPM file from an open binary stream."""
+        self._stale_layers = frozenset()
+        self._valid_rows = None
+        self._changed_rows = None
+        self._delta_previous = None
+
+    @metrics.timed("ppm.load")
+    def load(self, stream, backend="auto", verify=0.0):
+        """Load and parse a PPM file from an open binary stream.
+
+        backend picks the frame and audio decoder: "auto" uses libugomemo
+        when it is available and the file was opened from a path, "native"
+        raises ValueError when it can't, and "python" never uses it.
+
+        verify, a fraction between 0 and 1, decodes that share of frames
+        with both backends the first time they are requested and compares
+        them; see verify_report.
+        """
         self.stream = stream
         self._read_all_data()
         self._read_header()
@@ -315,15 +412,23 @@ class Parser:
         self.layers = np.zeros((2, PPM_FRAME_HEIGHT, PPM_FRAME_WIDTH), dtype=np.uint8)
         self.prev_layers = np.zeros((2, PPM_FRAME_HEIGHT, PPM_FRAME_WIDTH), dtype=np.uint8)
         self.prev_frame_index = -1
-
-        # Try to open native context for C acceleration
-        if NATIVE_AVAILABLE and self._path is not None:
-            self._native_ctx = native_ppm_open(self._path)
+        self._stale_layers = frozenset()
+        self._valid_rows = None
+        self._changed_rows = None
+        self._delta_previous = None
+        self._animation_digest = None
+        self._frame_spans = None
+
+        # Open native context for C acceleration, as the backend allows
+        if self._native_ctx is not None:
+            native_ppm_close(self._native_ctx)
+        self._native_ctx, self._native_reason, self._verifier = open_context("ppm", self._path, backend, verify)
 
     def _read_all_data(self):
         """Read the entire file into a bytes buffer for random access."""
         self.stream.seek(0)
         self._data = self.stream.read()
+        metrics.count("ppm.bytes_read", len(self._data))
 
     def unload(self):
         """Close the stream and release native resources."""
@@ -336,6 +441,7 @@ class Parser:
 
     # -- Internal parsing -----------------------------------------------------
 
+    @metrics.timed("ppm.read_header")
     def _read_header(self):
         """Parse the 16-byte file header."""
         d = self._data
@@ -348,6 +454,7 @@ class Parser:
         self.frame_count = fc + 1
         self.format_version = struct.unpack_from("<H", d, 14)[0]
 
+    @metrics.timed("ppm.read_meta")
     def _read_meta(self):
         """Parse the 0x90-byte metadata section at offset 0x10."""
         d = self._data
@@ -366,24 +473,26 @@ class Parser:
         self.current_author_name = d[off:off + 22].decode("utf-16-le").rstrip("\x00")
         off += 22
 
-        # FSIDs: 8 bytes each, reversed hex
-        self.parent_author_id = _decode_fsid(d[off:off + 8])
+        self._formatted = {}
+
+        # FSIDs: 8 bytes each, LE u64
+        self.parent_author_id_raw = d[off:off + 8]
         off += 8
-        self.current_author_id = _decode_fsid(d[off:off + 8])
+        self.current_author_id_raw = d[off:off + 8]
         off += 8
 
         # Filenames: 18 bytes each
-        self.parent_filename = _decode_filename(d[off:off + 18])
+        self.parent_filename_raw = d[off:off + 18]
         off += 18
-        self.current_filename = _decode_filename(d[off:off + 18])
+        self.current_filename_raw = d[off:off + 18]
         off += 18
 
         # Root FSID
-        self.root_author_id = _decode_fsid(d[off:off + 8])
+        self.root_author_id_raw = d[off:off + 8]
         off += 8
 
         # Root filename fragment (8 bytes)
-        self.root_filename_fragment = _decode_filename_fragment(d[off:off + 8])
+        self.root_filename_fragment_raw = d[off:off + 8]
         off += 8
 
         # Timestamp: u32 LE seconds since Jan 1 2000
@@ -394,6 +503,7 @@ class Parser:
         # u16 padding
         off += 2
 
+    @metrics.timed("ppm.read_animation_header")
     def _read_animation_header(self):
         """Parse the animation header, offset table, and compute frame data start."""
         d = self._data
@@ -421,6 +531,7 @@ class Parser:
         # Animation data starts after the 8-byte header + offset table rounded up to mult of 4
         self._anim_data_start = 0x06A0 + 8 + _round_up_mult_4(table_size)
 
+    @metrics.timed("ppm.read_sound_header")
     def _read_sound_header(self):
         """Parse the sound header (0x20 bytes) and compute track offsets."""
         d = self._data
@@ -454,16 +565,64 @@ class Parser:
 
         self._sfx_flags = d[sfx_flags_offset:sfx_flags_offset + self.frame_count]
 
+    @metrics.timed("ppm.read_signature")
     def _read_signature(self):
         """Read the 128-byte signature and 16-byte padding at the end of the file."""
         d = self._data
-        # Signature is at the very end: last 144 bytes (128 sig + 16 padding)
-        if len(d) >= 144:
-            self.signature = d[-144:-16]
-            self.signature_padding = d[-16:]
+        # Signature is at the very end of the file, followed by its padding
+        if len(d) >= PPM_SIGNATURE_SIZE:
+            self.signature = d[-PPM_SIGNATURE_SIZE:-PPM_SIGNATURE_PADDING]
+            self.signature_padding = d[-PPM_SIGNATURE_PADDING:]
 
     # -- Public properties ----------------------------------------------------
 
+    def _format(self, name, decode):
+        """String form of the raw field name + "_raw", decoded on first access."""
+        value = self._formatted.get(name)
+        if value is None:
+            raw = getattr(self, name + "_raw")
+            if raw is None:
+                return None
+            value = self._formatted[name] = decode(raw)
+        return value
+
+    @property
+    def current_author_id(self):
+        return self._format("current_author_id", _decode_fsid)
+
+    @property
+    def parent_author_id(self):
+        return self._format("parent_author_id", _decode_fsid)
+
+    @property
+    def root_author_id(self):
+        return self._format("root_author_id", _decode_fsid)
+
+    @property
+    def current_filename(self):
+        return self._format("current_filename", _decode_filename)
+
+    @property
+    def parent_filename(self):
+        return self._format("parent_filename", _decode_filename)
+
+    @property
+    def root_filename_fragment(self):
+        return self._format("root_filename_fragment", _decode_filename_fragment)
+
+    @property
+    def current_author_id_int(self):
+        """Current author FSID as a 64-bit integer ("%016X" % value is current_author_id)."""
+        return _fsid_int(self.current_author_id_raw)
+
+    @property
+    def parent_author_id_int(self):
+        return _fsid_int(self.parent_author_id_raw)
+
+    @property
+    def root_author_id_int(self):
+        return _fsid_int(self.root_author_id_raw)
+
     @property
     def track_sizes(self):
         """Track sizes as [bgm, se1, se2, se3]."""
@@ -474,6 +633,12 @@ class Parser:
         """Track byte offsets as [bgm, se1, se2, se3]."""
         return list(self._track_offsets)
 
+    @property
+    def track_digests(self):
+        """MD5 hex digests of the raw track data as [bgm, se1, se2, se3] (None for empty tracks)."""
+        return [md5(self._data[offset:offset + size]).hexdigest() if size else None
+                for offset, size in zip(self._track_offsets, self._track_sizes)]
+
     @property
     def sfx_flags(self):
         """Per-frame SFX flags byte array."""
@@ -489,32 +654,105 @@ class Parser:
         """Alias for thumb_index."""
         return self.thumb_index
 
+    @property
+    def indexed_palette(self):
+        """RGB lookup table for decode_frame_indexed output (FRAME_PALETTE)."""
+        return FRAME_PALETTE_ARRAY
+
+    @property
+    def animation_digest(self):
+        """Hex digest of the animation section, used as the note's frame cache identity."""
+        if self._animation_digest is None:
+            section = self._data[0x06A0:0x06A0 + self.animation_data_size]
+            self._animation_digest = blake2b(section, digest_size=16).hexdigest()
+        return self._animation_digest
+
+    @property
+    def frame_spans(self):
+        """(start, end) file offsets of each frame's compressed data.
+
+        The offset table only gives where frames start, so a frame runs up to
+        the next frame in file order. The last one is measured from its line
+        encodings, leaving out the padding before the end of the animation
+        section.
+        """
+        if self._frame_spans is None:
+            end = 0x06A0 + self.animation_data_size
+            starts = [min(self._anim_data_start + offset, end) for offset in self.offset_table[:self.frame_count]]
+            bounds = sorted(set(starts))
+            if bounds and bounds[-1] < end:
+                try:
+                    last_end = min(_frame_end(self._data, bounds[-1]), end)
+                except (IndexError, struct.error):
+                    last_end = end
+                bounds.append(last_end)
+            else:
+                bounds.append(end)
+            following = dict(zip(bounds, bounds[1:]))
+            self._frame_spans = [(start, following[start]) for start in starts]
+        return self._frame_spans
+
+    @property
+    def frame_digests(self):
+        """Hex digests of each frame's compressed bytes (see get_frame_data).
+
+        Equal digests mean identically encoded frames. Diff frames are only
+        the same picture if the frames before them are too.
+        """
+        view = memoryview(self._data)
+        return [blake2b(view[start:end], digest_size=16).hexdigest() for start, end in self.frame_spans]
+
+    def get_frame_data(self, index):
+        """Compressed bytes of frame index as stored in the file."""
+        start, end = self.frame_spans[index]
+        return self._data[start:end]
+
+    def get_keyframe_digests(self):
+        """Hex digests of the decoded layers of frame 0 and every keyframe, as {index: digest}.
+
+        Unlike frame_digests this decodes the frames, but it also matches
+        keyframes that draw the same layers with different encodings or pen
+        colours.
+        """
+        digests = {}
+        for index in range(self.frame_count):
+            if index == 0 or self._is_keyframe(index):
+                layers = self._decode_frame_raw(index)
+                digests[index] = blake2b(layers.tobytes(), digest_size=16).hexdigest()
+        return digests
+
+    # -- Validation -----------------------------------------------------------
+
+    @property
+    def uses_native(self):
+        """True when frames and audio are decoded by libugomemo."""
+        return self._native_ctx is not None
+
+    def verify_report(self):
+        """Differential check results when opened with verify (see
+        flipnote._native.FrameVerifier.report), or None."""
+        if self._verifier is None:
+            return None
+        return self._verifier.report()
+
+    def validate(self):
+        """Structural problems with the loaded file (see flipnote.ppm.validate)."""
+        return validate(self._data)
+
     # -- Thumbnail ------------------------------------------------------------
 
     def decode_thumbnail(self):
-        """Decode the 64x48 thumbnail to an RGB numpy array (48, 64, 3) uint8.
+        """Decode the 64x48 thumbnail to an RGB numpy array (48, 64, 3) uint8."""
+        return THUMBNAIL_PALETTE_ARRAY[self.get_thumbnail_pixels()]
+
+    def get_thumbnail_pixels(self):
+        """Decode the 64x48 thumbnail to a (48, 64) uint8 array of THUMBNAIL_PALETTE indices.
 
         The thumbnail is stored as 8x8 tiles of 4-bit palette-indexed pixels,
         with the Y axis flipped (bottom-to-top).
         """
-        d = self._data
-        off = 0xA0
-        output = np.zeros((PPM_THUMBNAIL_HEIGHT, PPM_THUMBNAIL_WIDTH, 3), dtype=np.uint8)
-
-        for tile_y in range(0, PPM_THUMBNAIL_HEIGHT, 8):
-            for tile_x in range(0, PPM_THUMBNAIL_WIDTH, 8):
-                for line in range(8):
-                    for pixel in range(0, 8, 2):
-                        byte = d[off]
-                        off += 1
-                        x = tile_x + pixel
-                        y = 47 - (tile_y + line)
-                        lo = byte & 0xF
-                        hi = byte >> 4
-                        output[y, x] = THUMBNAIL_PALETTE[lo]
-                        output[y, x + 1] = THUMBNAIL_PALETTE[hi]
-
-        return output
+        raw = np.frombuffer(self._data, dtype=np.uint8, count=PPM_THUMBNAIL_SIZE, offset=PPM_THUMBNAIL_OFFSET)
+        return np.ascontiguousarray(_thumbnail_indices(raw.reshape(1, -1))[0])
 
     # -- Frame palette --------------------------------------------------------
 
@@ -531,20 +769,160 @@ class Parser:
         pen = [inverse_paper, inverse_paper, RED, BLUE]
         return [paper, pen[layer_1_color], pen[layer_2_color]]
 
-    # -- Frame decoding -------------------------------------------------------
+    # -- Bitstream analysis ---------------------------------------------------
+
+    def get_frame_activity(self, index, skip_hidden=True):
+        """Per-frame change statistics read from the line encodings, without decoding pixels.
+
+        On a diff frame a row changes only where a layer's line encoding is
+        non-zero (something is XORed in); keyframes and translated diff
+        frames may change every row. With skip_hidden, hidden layers are
+        ignored.
+
+        Returns a dict with:
+            line_counts: (2, 4) int array of line encoding counts per layer
+            dirty_rows: (192,) bool array of rows that may have changed
+            score: fraction of rows that may have changed (0.0 - 1.0)
+            keyframe: True for keyframes
+            translated: True for diff frames with a non-zero translation
+            palette_changed: True if the frame's colours differ from the previous frame
+        """
+        if index < 0 or index >= self.frame_count:
+            raise IndexError("Frame index %d out of range [0, %d)" % (index, self.frame_count))
 
-    def _decode_frame_raw(self, index):
-        """Decode a single frame's two layers, handling diffing. Updates internal state."""
         d = self._data
+        pos = self._anim_data_start + self.offset_table[index]
+        header = d[pos]
+        pos += 1
 
-        # If this is not a keyframe and we haven't decoded the previous frame,
-        # we need to decode all frames up to this one
-        frame_pos = self._anim_data_start + self.offset_table[index]
-        header = d[frame_pos]
-        frame_type = (header >> 7) & 1
+        keyframe = bool((header >> 7) & 1)
+        translated = False
+        if not keyframe and (header >> 5) & 3:
+            translated = d[pos] != 0 or d[pos + 1] != 0
+            pos += 2
+
+        encodings = (_unpack_line_encodings(d[pos:pos + 48]),
+                     _unpack_line_encodings(d[pos + 48:pos + 96]))
+        line_counts = np.array([np.bincount(enc, minlength=4) for enc in encodings])
+
+        hidden = self._hidden_layers() if skip_hidden else frozenset()
+        if keyframe or translated:
+            dirty = np.ones(PPM_FRAME_HEIGHT, dtype=bool)
+        else:
+            dirty = np.zeros(PPM_FRAME_HEIGHT, dtype=bool)
+            for k in (0, 1):
+                if k not in hidden:
+                    dirty |= encodings[k] != 0
+
+        prev_header = d[self._anim_data_start + self.offset_table[index - 1]] if index > 0 else header
+        return {
+            "line_counts": line_counts,
+            "dirty_rows": dirty,
+            "score": float(dirty.mean()),
+            "keyframe": keyframe,
+            "translated": translated,
+            "palette_changed": (header & 0x1F) != (prev_header & 0x1F),
+        }
+
+    def get_activity_scores(self, skip_hidden=True):
+        """Activity score (fraction of rows that may have changed) for every frame."""
+        return np.array([self.get_frame_activity(i, skip_hidden)["score"]
+                         for i in range(self.frame_count)], dtype=np.float64)
+
+    # -- Frame decoding -------------------------------------------------------
 
-        if frame_type == 0 and index != 0 and self.prev_frame_index != index - 1:
-            self._decode_frame_raw(index - 1)
+    def _is_keyframe(self, index):
+        return (self._data[self._anim_data_start + self.offset_table[index]] >> 7) & 1
+
+    def _hidden_layers(self):
+        """Layer numbers (0 = layer 1, 1 = layer 2) switched off for the whole note."""
+        hidden = set()
+        if not self.layer_1_visible:
+            hidden.add(0)
+        if not self.layer_2_visible:
+            hidden.add(1)
+        return frozenset(hidden)
+
+    def _frame_translation(self, index):
+        """(translate_x, translate_y) of a diff frame; (0, 0) for keyframes."""
+        pos = self._anim_data_start + self.offset_table[index]
+        header = self._data[pos]
+        if (header >> 7) & 1 or not (header >> 5) & 3:
+            return 0, 0
+        return struct.unpack_from("<bb", self._data, pos + 1)
+
+    def _needed_rows(self, start, index, rows):
+        """Rows each of frames start..index must decode for rows of frame index.
+
+        Row y of a diff frame XORs in row y - translate_y of the frame before
+        it, so the needed rows are walked back through the translations.
+        Returns (list of (192,) bool arrays for start..index, rows needed from
+        frame start - 1).
+        """
+        needed = [None] * (index - start + 1)
+        for i in range(index, start - 1, -1):
+            needed[i - start] = rows
+            before = np.zeros(PPM_FRAME_HEIGHT, dtype=bool)
+            if not self._is_keyframe(i):
+                src = np.flatnonzero(rows) - self._frame_translation(i)[1]
+                before[src[(src >= 0) & (src < PPM_FRAME_HEIGHT)]] = True
+            rows = before
+        return needed, rows
+
+    @metrics.timed("ppm.decode_frame.python")
+    def _decode_frame_raw(self, index, skip=frozenset(), rows=None):
+        """Decode a frame's two layers, handling diffing. Updates internal state.
+
+        Diff frames are replayed from the nearest keyframe, or from the
+        previously decoded frame when that is closer. Layers in skip (0 or 1)
+        are not decompressed; they are marked stale and rebuilt from a
+        keyframe when next needed.
+
+        With rows, a (192,) bool array, only the rows of each frame that those
+        rows of frame index depend on are decoded. The layers are then only
+        valid in rows, and a later decode needing anything else replays from
+        the keyframe.
+        """
+        needed_stale = bool(self._stale_layers - skip)
+
+        keyframe = index
+        while keyframe > 0 and not self._is_keyframe(keyframe):
+            keyframe -= 1
+
+        prev = self.prev_frame_index
+        resume = 0 <= prev < index and prev >= keyframe and not needed_stale
+        needed = None
+        if resume:
+            start = prev + 1
+            valid = self._valid_rows
+            if rows is None:
+                resume = valid is None
+            else:
+                needed, before = self._needed_rows(start, index, rows)
+                resume = valid is None or not (before & ~valid).any()
+
+        if resume:
+            stale = self._stale_layers | skip
+        else:
+            start = keyframe
+            stale = skip
+            self.layers.fill(0)
+            if rows is not None:
+                needed = self._needed_rows(start, index, rows)[0]
+
+        if metrics.ENABLED:
+            metrics.count("ppm.frames_decoded", index - start + 1)
+            metrics.count("ppm.frames_replayed", index - start)
+        for i in range(start, index + 1):
+            self._decode_frame_layers(i, skip, None if needed is None else needed[i - start])
+        self._stale_layers = stale
+        self._valid_rows = rows
+
+        return self.layers
+
+    def _decode_frame_layers(self, index, skip, rows=None):
+        """Decode one frame (only rows, if given) on top of the current layer state."""
+        d = self._data
 
         # Copy current layers to previous
         np.copyto(self.prev_layers, self.layers)
@@ -553,15 +931,12 @@ class Parser:
         # Reset current layers
         self.layers.fill(0)
 
-        pos = frame_pos
+        pos = self._anim_data_start + self.offset_table[index]
         header = d[pos]
         pos += 1
 
         frame_type = (header >> 7) & 1
         translate_flag = (header >> 5) & 3
-        layer_2_color = (header >> 3) & 3
-        layer_1_color = (header >> 1) & 3
-        paper_color = header & 1
 
         translate_x = 0
         translate_y = 0
@@ -577,26 +952,84 @@ class Parser:
         pos += 48
 
         # Decompress layers
-        layer_1, pos = _decompress_layer(d, pos, line_enc_1)
-        layer_2, pos = _decompress_layer(d, pos, line_enc_2)
-
-        self.layers[0] = layer_1
-        self.layers[1] = layer_2
+        if 0 in skip:
+            pos = _skip_layer(d, pos, line_enc_1)
+        else:
+            self.layers[0], pos = _decompress_layer(d, pos, line_enc_1, rows)
+        if 1 not in skip:
+            self.layers[1], pos = _decompress_layer(d, pos, line_enc_2, rows)
 
         # Frame diffing: XOR with translated previous frame
+        decoded = [k for k in (0, 1) if k not in skip]
+        if frame_type == 0 and translate_x == 0 and translate_y == 0:
+            # Only rows with a non-zero residual can differ from the previous frame
+            self._changed_rows = self.layers[decoded].any(axis=(0, 2))
+        else:
+            self._changed_rows = None
+
         if frame_type == 0:
             for y in range(PPM_FRAME_HEIGHT):
                 prev_y = y - translate_y
-                if prev_y < 0 or prev_y >= PPM_FRAME_HEIGHT:
+                if prev_y < 0 or prev_y >= PPM_FRAME_HEIGHT or (rows is not None and not rows[y]):
                     continue
                 for x in range(PPM_FRAME_WIDTH):
                     prev_x = x - translate_x
                     if prev_x < 0 or prev_x >= PPM_FRAME_WIDTH:
                         continue
-                    self.layers[0, y, x] ^= self.prev_layers[0, prev_y, prev_x]
-                    self.layers[1, y, x] ^= self.prev_layers[1, prev_y, prev_x]
-
-        return self.layers
+                    for k in decoded:
+                        self.layers[k, y, x] ^= self.prev_layers[k, prev_y, prev_x]
+
+    def decode_frame_delta(self, index, skip_hidden=None):
+        """Decode a frame and return only the rows that changed since the frame
+        returned by the previous decode_frame_delta call.
+
+        When frames are requested in order, the rows the decoder XORed into
+        are the only candidates, so the delta costs little beyond the decode
+        itself. Any other order falls back to comparing whole frames. The
+        first call (and the first after reset_delta) sends the full frame.
+        Consecutive changed rows are merged into one full-width strip.
+
+        Returns a dict with:
+            index: the frame index
+            full: True if rects holds the whole frame as a single rect
+            rects: list of (x, y, pixels), pixels being an RGB uint8 array
+                   (height, 256, 3)
+        """
+        if index < 0 or index >= self.frame_count:
+            raise IndexError("Frame index %d out of range [0, %d)" % (index, self.frame_count))
+
+        skip_hidden = self._skip_hidden(skip_hidden)
+        hidden = self._hidden_layers() if skip_hidden else frozenset()
+        sequential = (self._native_ctx is None and self.prev_frame_index == index - 1
+                      and not (self._stale_layers - hidden))
+        pixels = self._decode_frame_indexed(index, skip_hidden)
+        colors = self._data[self._anim_data_start + self.offset_table[index]] & 0x1F
+
+        previous = self._delta_previous
+        self._delta_previous = (index, colors, pixels)
+        if previous is None:
+            return {"index": index, "full": True, "rects": [(0, 0, FRAME_PALETTE_ARRAY[pixels])]}
+
+        prev_index, prev_colors, prev_pixels = previous
+        if sequential and prev_index == index - 1 and prev_colors == colors \
+                and self._changed_rows is not None:
+            candidates = np.flatnonzero(self._changed_rows)
+        else:
+            candidates = np.arange(PPM_FRAME_HEIGHT)
+        changed = candidates[(pixels[candidates] != prev_pixels[candidates]).any(axis=1)]
+
+        rects = []
+        if changed.size:
+            # Split the changed rows into runs of consecutive rows
+            breaks = np.flatnonzero(np.diff(changed) != 1) + 1
+            for run in np.split(changed, breaks):
+                top, bottom = int(run[0]), int(run[-1]) + 1
+                rects.append((0, top, FRAME_PALETTE_ARRAY[pixels[top:bottom]]))
+        return {"index": index, "full": False, "rects": rects}
+
+    def reset_delta(self):
+        """Forget the previous frame so the next decode_frame_delta sends a full frame."""
+        self._delta_previous = None
 
     def get_frame_pixels(self, index):
         """Decode a frame and return a (192, 256) uint8 array with palette indices.
@@ -610,19 +1043,51 @@ class Parser:
         pixels[layers[1] > 0] = 2
         return pixels
 
-    def decode_frame(self, index):
-        """Decode a frame to an RGB numpy array (192, 256, 3) uint8.
+    def decode_frame_indexed(self, index, skip_hidden=None, region=None):
+        """Decode a frame to a (192, 256) uint8 array of FRAME_PALETTE indices.
 
-        Uses C acceleration when available.
+        Uses the frame cache and C acceleration when available. skip_hidden
+        and region behave as in decode_frame.
         """
+        skip_hidden = self._skip_hidden(skip_hidden)
+        if region is not None:
+            return self._decode_frame_indexed(index, skip_hidden, region)
+
+        cache = self.frame_cache
+        if cache is not None:
+            key = (self.animation_digest, index, "indexed" if skip_hidden else "indexed-all")
+            pixels = cache.get(key)
+            if pixels is None:
+                pixels = self._decode_frame_indexed(index, skip_hidden)
+                cache.put(key, pixels)
+            return pixels
+        return self._decode_frame_indexed(index, skip_hidden)
+
+    def _decode_frame_indexed(self, index, skip_hidden=True, region=None):
+        if region is None:
+            x, y, w, h = 0, 0, PPM_FRAME_WIDTH, PPM_FRAME_HEIGHT
+        else:
+            x, y, w, h = check_region(region, PPM_FRAME_WIDTH, PPM_FRAME_HEIGHT)
+
         # Try native C decode first
-        if self._native_ctx is not None:
-            result = native_ppm_decode_frame(self._native_ctx, index)
+        if self._native_usable(index, skip_hidden):
+            result = self._native_decode_frame(index)
             if result is not None:
-                return result
+                return rgb_to_indices(result[y:y + h, x:x + w], FRAME_PALETTE)
+        return self._decode_frame_indexed_python(index, skip_hidden, region)
 
-        # Pure Python fallback
-        layers = self._decode_frame_raw(index)
+    def _decode_frame_indexed_python(self, index, skip_hidden=True, region=None):
+        if region is None:
+            x, y, w, h = 0, 0, PPM_FRAME_WIDTH, PPM_FRAME_HEIGHT
+        else:
+            x, y, w, h = check_region(region, PPM_FRAME_WIDTH, PPM_FRAME_HEIGHT)
+
+        hidden = self._hidden_layers() if skip_hidden else frozenset()
+        rows = None
+        if region is not None:
+            rows = np.zeros(PPM_FRAME_HEIGHT, dtype=bool)
+            rows[y:y + h] = True
+        layers = self._decode_frame_raw(index, hidden, rows)[:, y:y + h, x:x + w]
 
         frame_pos = self._anim_data_start + self.offset_table[index]
         header = self._data[frame_pos]
@@ -630,37 +1095,127 @@ class Parser:
         layer_1_color = (header >> 1) & 3
         layer_2_color = (header >> 3) & 3
 
-        paper = PAPER_COLORS[paper_color]
-        inverse_paper = PAPER_COLORS[paper_color ^ 1]
+        # Pen colours 0 and 1 both mean "inverse of paper"
+        inverse_paper = paper_color ^ 1
+        if layer_1_color <= 1:
+            layer_1_color = inverse_paper
+        if layer_2_color <= 1:
+            layer_2_color = inverse_paper
+
+        pixels = np.full((h, w), paper_color, dtype=np.uint8)
 
-        output = np.zeros((PPM_FRAME_HEIGHT, PPM_FRAME_WIDTH, 3), dtype=np.uint8)
+        # Layer 1 drawn first, layer 2 on top
+        if 0 not in hidden:
+            pixels[layers[0] > 0] = layer_1_color
+        if 1 not in hidden:
+            pixels[layers[1] > 0] = layer_2_color
+        return pixels
 
-        # Fill with paper color
-        output[:, :, 0] = paper[0]
-        output[:, :, 1] = paper[1]
-        output[:, :, 2] = paper[2]
+    def decode_frame(self, index, skip_hidden=None, region=None, scale=1):
+        """Decode a frame to an RGB numpy array (192, 256, 3) uint8.
 
-        # Layer 1 drawn first
-        mask1 = layers[0] > 0
-        if layer_1_color <= 1:
-            color = inverse_paper
-        else:
-            color = LAYER_COLORS[layer_1_color]
-        output[mask1, 0] = color[0]
-        output[mask1, 1] = color[1]
-        output[mask1, 2] = color[2]
+        Uses C acceleration when available. With skip_hidden, a layer switched
+        off for the whole note (layer_1_visible / layer_2_visible) is neither
+        decoded nor drawn. The native decoder always renders both layers, so
+        by default (None) hidden layers are only skipped when decoding in pure
+        Python; skip_hidden=True decodes notes with a hidden layer in pure
+        Python even when libugomemo is available.
 
-        # Layer 2 drawn on top
-        mask2 = layers[1] > 0
-        if layer_2_color <= 1:
-            color = inverse_paper
-        else:
-            color = LAYER_COLORS[layer_2_color]
-        output[mask2, 0] = color[0]
-        output[mask2, 1] = color[1]
-        output[mask2, 2] = color[2]
+        region=(x, y, w, h) returns just that crop, shape (h, w, 3). The pure
+        Python decoder then only decodes the rows the crop depends on; the
+        frame cache is bypassed.
 
-        return output
+        scale enlarges the frame by an integer factor (nearest neighbour).
+        The palette indices are enlarged before the colour lookup, so there
+        is no full-size RGB intermediate.
+        """
+        skip_hidden = self._skip_hidden(skip_hidden)
+        scale = check_scale(scale)
+        if region is not None or scale != 1:
+            return indices_to_rgb(self.decode_frame_indexed(index, skip_hidden, region), FRAME_PALETTE_ARRAY, scale)
+
+        # Without a cache the native RGB output can be returned as-is
+        if self.frame_cache is None:
+            if self._native_usable(index, skip_hidden):
+                result = self._native_decode_frame(index)
+                if result is not None:
+                    return result
+            return FRAME_PALETTE_ARRAY[self._decode_frame_indexed_python(index, skip_hidden)]
+
+        return FRAME_PALETTE_ARRAY[self.decode_frame_indexed(index, skip_hidden)]
+
+    def _skip_hidden(self, skip_hidden):
+        """Resolve a skip_hidden argument: None (the default) skips hidden
+        layers only when frames are decoded in pure Python."""
+        return not self.uses_native if skip_hidden is None else skip_hidden
+
+    def _native_usable(self, index, skip_hidden):
+        """Whether frame index can come from the native decoder. It always
+        renders both layers, so not when skip_hidden would leave a hidden one
+        out; verify still compares the backends on such a frame."""
+        if self._native_ctx is None:
+            if self._native_reason is not None:
+                metrics.fallback("ppm.decode_frame", self._native_reason)
+            return False
+        if skip_hidden and self._hidden_layers():
+            metrics.fallback("ppm.decode_frame", "hidden layers")
+            verifier = self._verifier
+            if verifier is not None and verifier.wants(index):
+                self._native_decode_frame(index)
+            return False
+        return True
+
+    def _native_decode_frame(self, index):
+        """Decode a frame to RGB with libugomemo (None on failure), checking
+        it against the Python decoder if verify samples it."""
+        verifier = self._verifier
+        if verifier is not None and verifier.wants(index):
+            return verifier.check(
+                index,
+                lambda: native_ppm_decode_frame(self._native_ctx, index),
+                lambda: FRAME_PALETTE_ARRAY[self._decode_frame_indexed_python(index, skip_hidden=False)],
+            )
+        return native_ppm_decode_frame(self._native_ctx, index)
+
+    def decode_frames(self, start=0, stop=None, skip_hidden=None, scale=1):
+        """Decode frames start..stop-1 into one (N, 192 * scale, 256 * scale, 3) uint8 array.
+
+        Frames are decoded in order (so diffs are applied incrementally) and
+        written straight into the preallocated output; skip_hidden and scale
+        behave as in decode_frame.
+        """
+        count = self.frame_count
+        stop = count if stop is None else stop
+        if start < 0 or stop > count or start > stop:
+            raise IndexError("Frame range [%d, %d) out of range [0, %d)" % (start, stop, count))
+        scale = check_scale(scale)
+
+        frames = np.empty((stop - start, PPM_FRAME_HEIGHT * scale, PPM_FRAME_WIDTH * scale, 3), dtype=np.uint8)
+        for i, index in enumerate(range(start, stop)):
+            indices_to_rgb(self.decode_frame_indexed(index, skip_hidden), FRAME_PALETTE_ARRAY, scale, out=frames[i])
+        return frames
+
+    def export_gif(self, path, scale=1, loop=None, skip_hidden=None):
+        """Write the animation to path (or a binary file object) as a GIF.
+
+        Frames are written straight from palette indices, one at a time; see
+        flipnote.gif.write_gif.
+        """
+        write_gif(self, path, scale=scale, loop=loop, skip_hidden=skip_hidden)
+
+    def export_y4m(self, path, scale=1, chroma="420jpeg", skip_hidden=None):
+        """Stream the animation to path (or a file object / pipe) as YUV4MPEG2.
+
+        See flipnote.stream.write_y4m.
+        """
+        write_y4m(self, path, scale=scale, chroma=chroma, skip_hidden=skip_hidden)
+
+    def export_wav(self, path, track=0):
+        """Write an audio track to path (or a file object / pipe) as a WAV.
+
+        See flipnote.stream.write_wav.
+        """
+        write_wav(self, path, track)
 
     # -- Audio decoding -------------------------------------------------------
 
@@ -682,11 +1237,104 @@ class Parser:
             result = native_ppm_decode_track(self._native_ctx, track)
             if result is not None:
                 return result
+        elif self._native_reason is not None:
+            metrics.fallback("ppm.decode_audio", self._native_reason)
 
         # Pure Python fallback
         offset = self._track_offsets[track]
         return _decode_adpcm(self._data, offset, size)
 
 
+def _thumbnail_bytes(note):
+    """The raw thumbnail bytes of a Parser, a PPM held in memory, or a PPM file path."""
+    if isinstance(note, Parser):
+        data = note._data
+    elif isinstance(note, (bytes, bytearray, memoryview)):
+        data = note
+    else:
+        with builtins_open(note, "rb") as f:
+            data = f.read(PPM_THUMBNAIL_OFFSET + PPM_THUMBNAIL_SIZE)
+    if bytes(data[0:4]) != b"PARA":
+        raise ValueError("Invalid PPM magic: %r" % bytes(data[0:4]))
+    if len(data) < PPM_THUMBNAIL_OFFSET + PPM_THUMBNAIL_SIZE:
+        raise ValueError("PPM data too short for a thumbnail")
+    return data[PPM_THUMBNAIL_OFFSET:PPM_THUMBNAIL_OFFSET + PPM_THUMBNAIL_SIZE]
+
+
+def validate(data):
+    """Bounds-check a PPM file held in memory without decoding anything.
+
+    Checks the header sizes, every offset table entry and the audio track
+    layout against the file length. Returns a list of problem descriptions;
+    an empty list means the file is structurally sound.
+    """
+    size = len(data)
+    if size < PPM_ANIMATION_HEADER_OFFSET + 8:
+        return ["file too short (%d bytes) for the header and animation header" % size]
+    if bytes(data[0:4]) != b"PARA":
+        return ["invalid PPM magic: %r" % bytes(data[0:4])]
+
+    problems = []
+    for name, offset in (("root", 0x14), ("parent", 0x2A), ("current", 0x40)):
+        try:
+            bytes(data[offset:offset + 22]).decode("utf-16-le")
+        except UnicodeDecodeError:
+            problems.append("%s author name is not valid UTF-16" % name)
+
+    animation_size, sound_size, last_frame = struct.unpack_from("<IIH", data, 4)
+    frame_count = last_frame + 1
+
+    animation_end = PPM_ANIMATION_HEADER_OFFSET + animation_size
+    if animation_end > size:
+        problems.append("animation data (%d bytes) runs %d bytes past the end of the file"
+                        % (animation_size, animation_end - size))
+
+    table_size = struct.unpack_from("<H", data, PPM_ANIMATION_HEADER_OFFSET)[0]
+    if table_size != frame_count * 4:
+        problems.append("offset table has %d entries but the header says %d frames" % (table_size // 4, frame_count))
+
+    data_start = PPM_ANIMATION_HEADER_OFFSET + 8 + _round_up_mult_4(table_size)
+    if data_start > min(animation_end, size):
+        problems.append("offset table (%d bytes) runs past the animation data" % table_size)
+    else:
+        offsets = np.frombuffer(data, dtype="<u4", count=table_size // 4,
+                                offset=PPM_ANIMATION_HEADER_OFFSET + 8).astype(np.int64)
+        # Every frame needs at least its header byte and both line encoding tables
+        bad = np.flatnonzero(offsets + 97 > min(animation_end, size) - data_start)
+        if bad.size:
+            problems.append("%d frame offsets point outside the animation data (first: frame %d, offset 0x%X)"
+                            % (bad.size, bad[0], offsets[bad[0]]))
+
+    sound_header = _round_up_mult_4(animation_end + frame_count)
+    if sound_header + 0x20 > size:
+        problems.append("sound header at 0x%X is past the end of the file" % sound_header)
+    else:
+        tracks = struct.unpack_from("<IIII", data, sound_header)
+        if sum(tracks) > sound_size:
+            problems.append("audio tracks total %d bytes but the header gives %d" % (sum(tracks), sound_size))
+        if sound_header + 0x20 + sum(tracks) > size:
+            problems.append("audio tracks run %d bytes past the end of the file"
+                            % (sound_header + 0x20 + sum(tracks) - size))
+        frame_speed = 8 - data[sound_header + 16]
+        if not 0 <= frame_speed < len(FRAMERATES):
+            problems.append("invalid frame speed %d" % frame_speed)
+
+    return problems
+
+
+def decode_thumbnails(notes):
+    """Decode the thumbnails of many PPMs into one (N, 48, 64, 3) uint8 RGB array.
+
+    notes may mix Parser instances, PPM bytes and file paths; for paths only
+    the header and thumbnail are read. All thumbnails are decoded in a single
+    vectorized pass.
+    """
+    notes = list(notes)
+    raw = np.empty((len(notes), PPM_THUMBNAIL_SIZE), dtype=np.uint8)
+    for i, note in enumerate(notes):
+        raw[i] = np.frombuffer(_thumbnail_bytes(note), dtype=np.uint8)
+    return THUMBNAIL_PALETTE_ARRAY[_thumbnail_indices(raw)]
+
+
 # Keep Python's built-in open accessible for the classmethod
 builtins_open = open
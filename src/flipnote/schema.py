@@ -1,40 +1,56 @@
-from re import match
+import re
+from functools import lru_cache
 from textwrap import wrap
 from base64 import b32decode
 
+import numpy as np
+
 """
 This file contains functions relating to various schema within flipnotes.
+
+Each function has a batch variant (verifyPPMFSIDs, convertKWZFSIDsToPPM, ...)
+taking a sequence or a NumPy string array. Conversions are memoized, and the
+batch variants only convert each distinct value in their input once.
 """
 
 KWZ_FSID_trans = str.maketrans("CWMFJORDVEGBALKSNTHPYXQUIZ012345", "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567")
 
+# Number of distinct IDs / filenames each conversion remembers
+SCHEMA_CACHE_SIZE = 1 << 16
+
+PPM_FSID_PATTERN = re.compile("[0159][0-9A-F]{15}")
+KWZ_FSID_PATTERN = re.compile("(00|10|12|14)[0-9A-F]{14}[0159][0-9A-F](00)?")
+KWZ_FILENAME_PATTERN = re.compile(r"[a-z0-5]{28}(\.kwz)?")
+PPM_FILENAME_PATTERN = re.compile(r"[0-9A-F]{6}_[0-9A-F]{13}_[0-9]{3}(\.ppm)?")
+PPM_FILESYSTEM_FILENAME_PATTERN = re.compile(r"[0-9A-Z][0-9A-F]{5}_[0-9A-F]{13}_[0-9]{3}(\.ppm)?")
+
 
 def verifyPPMFSID(input_fsid):
     """
     Verifies that a PPM format FSID is valid via regex
     """
-    return match("[0159][0-9A-F]{15}", input_fsid) is not None
+    return PPM_FSID_PATTERN.match(input_fsid) is not None
 
 
 def verifyKWZFSID(input_fsid):
     """
     Verifies that a KWZ format FSID is valid via regex
     """
-    return match("(00|10|12|14)[0-9A-F]{14}[0159][0-9A-F](00)?", input_fsid) is not None
+    return KWZ_FSID_PATTERN.match(input_fsid) is not None
 
 
 def verifyKWZFilename(file_name):
     """
     Verifies that a KWZ format file name is valid via regex
     """
-    return match(r"[a-z0-5]{28}(\.kwz)?", file_name) is not None
+    return KWZ_FILENAME_PATTERN.match(file_name) is not None
 
 
 def verifyPPMFilename(name):
     """
     Verifies that a PPM format file name is valid via regex
     """
-    return match(r"[0-9A-F]{6}_[0-9A-F]{13}_[0-9]{3}(\.ppm)?", name) is not None
+    return PPM_FILENAME_PATTERN.match(name) is not None
 
 
 def verifyPPMFilesystemFilename(name):
@@ -42,7 +58,49 @@ def verifyPPMFilesystemFilename(name):
     Verifies that a PPM format filesystem file name is valid via regex
     Filenames in the filesystem (outside of file meta) have the first character used as a checksum
     """
-    return match(r"[0-9A-Z][0-9A-F]{5}_[0-9A-F]{13}_[0-9]{3}(\.ppm)?", name) is not None
+    return PPM_FILESYSTEM_FILENAME_PATTERN.match(name) is not None
+
+
+def _reverse_hex_bytes(hex_string):
+    """
+    Reverses the byte order of a hex string, e.g. "A1B2C3" -> "C3B2A1"
+    """
+    try:
+        return bytes.fromhex(hex_string)[::-1].hex().upper()
+    except ValueError:
+        # Odd length or trailing non-hex characters: reverse 2-character chunks as-is
+        return "".join(chunk[::-1] for chunk in wrap(hex_string[::-1], 2))
+
+
+@lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _kwz_fsid_to_ppm(input_fsid):
+    if not verifyKWZFSID(input_fsid):
+        return input_fsid
+    # Trim the first byte of the FSID
+    # FSIDs from KWZ files have an extra null(?) byte at the end, trim it if it exists
+    if len(input_fsid) == 20:
+        input_fsid = input_fsid[2:-2]
+    else:
+        input_fsid = input_fsid[2:]
+    return _reverse_hex_bytes(input_fsid)
+
+
+@lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _ppm_fsid_to_kwz(input_fsid):
+    if not verifyPPMFSID(input_fsid):
+        return input_fsid
+    return "00" + _reverse_hex_bytes(input_fsid) + "00"
+
+
+@lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _unpack_kwz_filename(input_filename, cleaned):
+    if not verifyKWZFilename(cleaned.lower()):
+        # Return without modification if verification fails
+        return input_filename
+    # Convert custom base-32 encoded string to the standard base-32 alphabet
+    translated = cleaned[:28].translate(KWZ_FSID_trans)
+    # Add padding to allow for decoding
+    return b32decode(translated + "====").hex().upper()
 
 
 def convertKWZFSIDToPPM(input_fsid):
@@ -52,29 +110,8 @@ def convertKWZFSIDToPPM(input_fsid):
     Any invalid input will be returned without modification.
     - e.g. if a PPM format FSID is used as the input or the length is invalid
     """
-    output_fsid = ""
-
     # Clean up input
-    input_fsid = str(input_fsid).strip().upper()
-
-    if verifyKWZFSID(input_fsid):
-        # Trim the first byte of the FSID
-        # FSIDs from KWZ files have an extra null(?) byte at the end, trim it if it exists
-        if len(input_fsid) == 20:
-            input_fsid = input_fsid[2:-2]
-        else:
-            input_fsid = input_fsid[2:]
-
-        # Invert the FSID then split into byte sized chunks
-        string_list = wrap(input_fsid[::-1], 2)
-
-        # Invert each byte and append to the output string
-        for i in range(len(string_list)):
-            output_fsid += string_list[i][::-1]
-    else:
-        output_fsid = input_fsid
-
-    return output_fsid
+    return _kwz_fsid_to_ppm(str(input_fsid).strip().upper())
 
 
 def convertPPMtoKWZ(input_fsid):
@@ -85,42 +122,101 @@ def convertPPMtoKWZ(input_fsid):
     - Once/if the purpose of this byte is discovered, it will be modified
     The trailing null byte is also included
     Any invalid input will be returned without modification.
-    - e.g. if a PPM format FSID is used as the input or the length is invalid
+    - e.g. if a KWZ format FSID is used as the input or the length is invalid
     """
+    # Clean up input
+    return _ppm_fsid_to_kwz(str(input_fsid).strip().upper())
+
 
+def unpackKWZFilename(input_filename):
+    """
+    Decodes a KWZ format filename to a string of its decoded hex bytes.
+    Any invalid input that doesn't match the filename regex will be returned without modification.
+    """
     # Clean up input
-    output_fsid = str(input_fsid).strip().upper()
+    return _unpack_kwz_filename(input_filename, str(input_filename).strip().upper())
 
-    if verifyPPMFSID(input_fsid):
-        # Invert the FSID then split into byte sized chunks
-        string_list = wrap(input_fsid[::-1], 2)
 
-        # Invert each byte and append to the output string
-        for i in range(len(string_list)):
-            output_fsid += string_list[i][::-1]
+def convertFSIDToInt(input_fsid):
+    """
+    Converts a PPM or KWZ format FSID to the 64-bit integer of its PPM form.
+    This is the same value as the parsers' *_author_id_int properties, so it can be used as a compact join key.
+    16 hex characters are read as a PPM FSID, 18 or 20 as a KWZ FSID; any other input returns None.
+    """
+    cleaned = str(input_fsid).strip()
+    try:
+        if len(cleaned) == 16:
+            return int(cleaned, 16)
+        if len(cleaned) in (18, 20):
+            # Drop the leading byte (and trailing null byte), the rest is little-endian
+            return int.from_bytes(bytes.fromhex(cleaned[2:18]), "little")
+    except ValueError:
+        pass
+    return None
 
-        output_fsid = "00" + output_fsid + "00"
 
-    return output_fsid
+def convertIntToPPMFSID(value):
+    """
+    Formats a 64-bit integer FSID (see convertFSIDToInt) as a PPM format FSID string
+    """
+    return "%016X" % value
 
 
-def unpackKWZFilename(input_filename):
+def _map_batch(func, values, dtype=None):
     """
-    Decodes a KWZ format filename to a string of its decoded hex bytes.
-    Any invalid input that doesn't match the filename regex will be returned without modification.
+    Applies func to each value: a list for sequences, an array of the same shape (and dtype, if given) for NumPy arrays.
+    Each distinct value is only passed to func once.
     """
-    # Clean up input
-    output_filename = str(input_filename).strip().upper()
+    is_array = isinstance(values, np.ndarray)
+    items = values.ravel().tolist() if is_array else list(values)
+    results = dict.fromkeys(items)
+    for value in results:
+        results[value] = func(value)
+    out = [results[value] for value in items]
+    if is_array:
+        return np.array(out, dtype=dtype).reshape(values.shape)
+    return out
 
-    if verifyKWZFilename(output_filename):
-        # Convert custom base-32 encoded string to the standard base-32 alphabet
-        translated = output_filename.translate(KWZ_FSID_trans)
 
-        # Add padding to allow for decoding
-        output_filename = b32decode(translated + "====").hex().upper()
-    else:
-        # Return without modification if verification fails
-        output_filename = input_filename
+def verifyPPMFSIDs(fsids):
+    """
+    Batch verifyPPMFSID: a list of bools, or a bool array for a NumPy array
+    """
+    return _map_batch(verifyPPMFSID, fsids)
+
+
+def verifyKWZFSIDs(fsids):
+    """
+    Batch verifyKWZFSID: a list of bools, or a bool array for a NumPy array
+    """
+    return _map_batch(verifyKWZFSID, fsids)
 
-    return output_filename
 
+def convertKWZFSIDsToPPM(fsids):
+    """
+    Batch convertKWZFSIDToPPM: a list of strings, or a string array for a NumPy array
+    """
+    return _map_batch(convertKWZFSIDToPPM, fsids)
+
+
+def convertPPMFSIDsToKWZ(fsids):
+    """
+    Batch convertPPMtoKWZ: a list of strings, or a string array for a NumPy array
+    """
+    return _map_batch(convertPPMtoKWZ, fsids)
+
+
+def unpackKWZFilenames(filenames):
+    """
+    Batch unpackKWZFilename: a list of strings, or a string array for a NumPy array
+    """
+    return _map_batch(unpackKWZFilename, filenames)
+
+
+def convertFSIDsToInt(fsids):
+    """
+    Batch convertFSIDToInt: a list of ints (None where invalid), or a uint64 array (0 where invalid) for a NumPy array
+    """
+    if isinstance(fsids, np.ndarray):
+        return _map_batch(lambda fsid: convertFSIDToInt(fsid) or 0, fsids, np.uint64)
+    return _map_batch(convertFSIDToInt, fsids)
@@ -0,0 +1,164 @@
+"""
+Streaming raw video (YUV4MPEG2) and audio (WAV) writers.
+
+Both write to a filename or any writable binary file object, including a
+pipe into an external encoder, one frame (or chunk of samples) at a time,
+so the consumer can start encoding while the note is still being decoded:
+
+    import subprocess
+    from flipnote.stream import write_y4m
+
+    enc = subprocess.Popen(["ffmpeg", "-i", "-", "out.mp4"], stdin=subprocess.PIPE)
+    write_y4m(parser, enc.stdin)
+    enc.stdin.close()
+
+Frames are converted to YUV through a lookup table built once from the
+note's palette, so the per-pixel work is a single table lookup per plane.
+"""
+
+import struct
+from fractions import Fraction
+
+import numpy as np
+
+from flipnote._palette import check_scale, upscale_indices
+
+# Samples per write when streaming audio
+WAV_CHUNK_SAMPLES = 16384
+
+
+def _output(path, write):
+    """Call write(fp) with path itself if it is a file object, else the opened file."""
+    if hasattr(path, "write"):
+        write(path)
+    else:
+        with open(path, "wb") as f:
+            write(f)
+
+
+# -- YUV4MPEG2 ----------------------------------------------------------------
+
+
+def yuv_palette(palette):
+    """Convert an (N, 3) RGB palette to an (N, 3) uint8 limited-range BT.601 YCbCr palette.
+
+    Y spans 16-235 and Cb/Cr 16-240, the range YUV4MPEG2 consumers assume.
+    """
+    rgb = np.asarray(palette, dtype=np.float64) / 255.0
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    y = 16.0 + 219.0 * (0.299 * r + 0.587 * g + 0.114 * b)
+    cb = 128.0 + 224.0 * (-0.168736 * r - 0.331264 * g + 0.5 * b)
+    cr = 128.0 + 224.0 * (0.5 * r - 0.418688 * g - 0.081312 * b)
+    return np.clip(np.rint(np.stack([y, cb, cr], axis=1)), 0, 255).astype(np.uint8)
+
+
+def _framerate_fraction(framerate):
+    fraction = Fraction(framerate).limit_denominator(1001)
+    if fraction <= 0:
+        fraction = Fraction(1)
+    return fraction.numerator, fraction.denominator
+
+
+class Y4MWriter:
+    """Write palette-indexed frames as a YUV4MPEG2 stream.
+
+    chroma is "420jpeg" (2x2 averaged chroma, the default most encoders
+    expect) or "444". Frame dimensions must be even for 4:2:0.
+    """
+
+    def __init__(self, fp, width, height, framerate, palette, chroma="420jpeg"):
+        if chroma not in ("420jpeg", "444"):
+            raise ValueError("chroma must be '420jpeg' or '444', got %r" % (chroma,))
+        if chroma == "420jpeg" and (width % 2 or height % 2):
+            raise ValueError("4:2:0 output needs even dimensions, got %dx%d" % (width, height))
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.chroma = chroma
+        self._lut = yuv_palette(palette)
+        # Chroma as uint16 so four samples can be summed before averaging
+        self._lut_wide = self._lut.astype(np.uint16)
+
+        num, den = _framerate_fraction(framerate)
+        fp.write(("YUV4MPEG2 W%d H%d F%d:%d Ip A1:1 C%s XCOLORRANGE=LIMITED\n" % (width, height, num, den, chroma)).encode("ascii"))
+
+    def write_frame(self, indices):
+        """Write one (height, width) frame of palette indices."""
+        if indices.shape != (self.height, self.width):
+            raise ValueError("Frame shape %r does not match %dx%d" % (indices.shape, self.width, self.height))
+
+        planes = [self._lut[:, 0][indices]]
+        if self.chroma == "444":
+            planes.append(self._lut[:, 1][indices])
+            planes.append(self._lut[:, 2][indices])
+        else:
+            h, w = self.height // 2, self.width // 2
+            for channel in (1, 2):
+                full = self._lut_wide[:, channel][indices]
+                total = full.reshape(h, 2, w, 2).sum(axis=(1, 3))
+                planes.append(((total + 2) >> 2).astype(np.uint8))
+
+        self.fp.write(b"FRAME\n")
+        for plane in planes:
+            self.fp.write(plane.tobytes())
+        flush = getattr(self.fp, "flush", None)
+        if flush is not None:
+            flush()
+
+
+def write_y4m(parser, path, scale=1, chroma="420jpeg", skip_hidden=None):
+    """Stream every frame of a parsed note as YUV4MPEG2 at the note's framerate.
+
+    Args:
+        parser: a PPM or KWZ parser
+        path: output filename or writable binary file object (e.g. a pipe)
+        scale: integer nearest-neighbour upscaling factor
+        chroma: "420jpeg" or "444"
+        skip_hidden: as in decode_frame
+    """
+    scale = check_scale(scale)
+
+    def write(fp):
+        writer = None
+        for index in range(parser.frame_count):
+            frame = upscale_indices(parser.decode_frame_indexed(index, skip_hidden), scale)
+            if writer is None:
+                height, width = frame.shape
+                writer = Y4MWriter(fp, width, height, parser.framerate, parser.indexed_palette, chroma)
+            writer.write_frame(frame)
+
+    _output(path, write)
+
+
+# -- WAV ----------------------------------------------------------------------
+
+
+def wav_header(sample_count, sample_rate, channels=1):
+    """44-byte RIFF/WAVE header for 16-bit PCM."""
+    data_size = sample_count * channels * 2
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16,
+        b"data", data_size,
+    )
+
+
+def write_wav(parser, path, track=0):
+    """Write one audio track of a parsed note as a mono 16-bit WAV.
+
+    The track comes from parser.decode_audio_track and is written in chunks
+    of WAV_CHUNK_SAMPLES, so a reader on the other end of a pipe can start
+    consuming right away.
+    """
+    samples = parser.decode_audio_track(track).astype("<i2", copy=False)
+
+    def write(fp):
+        fp.write(wav_header(len(samples), parser.audio_sample_rate))
+        for start in range(0, len(samples), WAV_CHUNK_SAMPLES):
+            fp.write(samples[start:start + WAV_CHUNK_SAMPLES].tobytes())
+        flush = getattr(fp, "flush", None)
+        if flush is not None:
+            flush()
+
+    _output(path, write)